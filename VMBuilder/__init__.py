@@ -48,13 +48,24 @@ def get_hypervisor(name):
     """
     Get Hypervisor subclass by name
 
+    The plugin providing it is imported first if it hasn't been yet.
+
     @type name: string
     @param name: Name of the Hypervisor subclass (defined by its .arg attribute)
     """
+    if name not in hypervisors:
+        VMBuilder.plugins.load_registered('hypervisor', name)
     if name in hypervisors:
         return hypervisors[name]
     else:
-        raise VMBuilderUserError('No such hypervisor. Available hypervisors: %s' % (' '.join(hypervisors.keys())))
+        raise VMBuilderUserError('No such hypervisor. Available hypervisors: %s' % (' '.join(available_hypervisors())))
+
+def available_hypervisors():
+    """
+    @rtype:  list
+    @return: The names of the registered and the indexed (not yet loaded) hypervisors
+    """
+    return sorted(set(hypervisors.keys() + VMBuilder.plugins.indexed_names('hypervisor')))
 
 def register_distro(cls):
     """
@@ -69,13 +80,24 @@ def get_distro(name):
     """
     Get Distro subclass by name
 
+    The plugin providing it is imported first if it hasn't been yet.
+
     @type name: string
     @param name: Name of the Distro subclass (defined by its .arg attribute)
     """
+    if name not in distros:
+        VMBuilder.plugins.load_registered('distro', name)
     if name in distros:
         return distros[name]
     else:
-        raise VMBuilderUserError('No such distro. Available distros: %s' % (' '.join(distros.keys())))
+        raise VMBuilderUserError('No such distro. Available distros: %s' % (' '.join(available_distros())))
+
+def available_distros():
+    """
+    @rtype:  list
+    @return: The names of the registered and the indexed (not yet loaded) distros
+    """
+    return sorted(set(distros.keys() + VMBuilder.plugins.indexed_names('distro')))
 
 def register_distro_plugin(cls):
     """
@@ -0,0 +1,289 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    On-disk caches shared between builds
+
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+
+def cache_key(*parts):
+    """
+    @rtype:  string
+    @return: a stable hex digest identifying the given parts
+    """
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+def file_checksum(filename):
+    """
+    @rtype:  string
+    @return: the sha1 hex digest of the contents of filename
+    """
+    digest = hashlib.sha1()
+    fp = open(filename, 'rb')
+    try:
+        while True:
+            data = fp.read(1024*1024)
+            if not data:
+                break
+            digest.update(data)
+    finally:
+        fp.close()
+    return digest.hexdigest()
+
+class CacheLock(object):
+    """
+    An flock(2) based lock on a file. Shared locks can be held by
+    several processes at once, an exclusive lock only by one.
+    """
+    def __init__(self, filename, exclusive=True):
+        self.fp = open(filename, 'a')
+        if exclusive:
+            fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX)
+        else:
+            fcntl.flock(self.fp.fileno(), fcntl.LOCK_SH)
+
+    def release(self):
+        if not self.fp.closed:
+            fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+            self.fp.close()
+
+class Cache(object):
+    """
+    A directory of cached files, keyed by L{cache_key}.
+
+    Every entry is stored together with its checksum, which is verified
+    before the entry is handed out again. Once the total size of the
+    entries exceeds L{max_size}, the least recently used ones are
+    evicted. Processes using the same directory coordinate through
+    L{lock}: readers hold a shared lock while they use an entry,
+    L{insert} and L{evict} take an exclusive one.
+
+    @type  directory: string
+    @param directory: Directory holding the cache (created if needed)
+    @type  max_size: number
+    @param max_size: Maximum total size of the entries (in megabytes)
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def lock(self, exclusive=True):
+        """
+        @rtype:  L{CacheLock}
+        @return: a lock on the cache directory. Call its release() method when done.
+        """
+        return CacheLock('%s/lock' % self.directory, exclusive)
+
+    def data_path(self, key):
+        return '%s/%s.data' % (self.directory, key)
+
+    def checksum_path(self, key):
+        return '%s/%s.sha1' % (self.directory, key)
+
+    def tmp_filename(self, suffix=''):
+        """
+        @rtype:  string
+        @return: a fresh filename inside the cache directory, suitable for
+                 building a new entry that will be passed to L{insert}
+        """
+        (fd, filename) = tempfile.mkstemp(suffix=suffix, prefix='.tmp', dir=self.directory)
+        os.close(fd)
+        return filename
+
+    def lookup(self, key):
+        """
+        Look up an entry. The caller should hold at least a shared
+        L{lock} for as long as it uses the returned file.
+
+        @rtype:  string
+        @return: the filename of the entry, or None if there is no
+                 (intact) entry for key
+        """
+        data = self.data_path(key)
+        if not os.path.exists(data):
+            return None
+        try:
+            expected = open(self.checksum_path(key)).read().strip()
+        except IOError:
+            expected = None
+        if expected != file_checksum(data):
+            logging.warning('Cache entry %s is corrupt, ignoring it' % (data,))
+            return None
+        # The checksum file's mtime is our LRU clock
+        os.utime(self.checksum_path(key), None)
+        return data
+
+    def insert(self, key, filename):
+        """
+        Move filename into the cache as the entry for key, replacing any
+        previous entry, and evict old entries if the cache has grown too
+        large. filename should come from L{tmp_filename} so that the move
+        is atomic.
+        """
+        checksum = file_checksum(filename)
+        lock = self.lock()
+        try:
+            os.rename(filename, self.data_path(key))
+            fp = open(self.checksum_path(key), 'w')
+            fp.write('%s\n' % checksum)
+            fp.close()
+            self.evict(keep=key)
+        finally:
+            lock.release()
+
+    def remove(self, key):
+        for path in [self.checksum_path(key), self.data_path(key)]:
+            try:
+                os.unlink(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def entries(self):
+        """
+        @rtype:  list
+        @return: (last use, size in bytes, key) tuples for all entries, least recently used first
+        """
+        retval = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.data'):
+                continue
+            key = name[:-len('.data')]
+            try:
+                last_use = os.stat(self.checksum_path(key)).st_mtime
+            except OSError:
+                last_use = 0
+            retval.append((last_use, os.stat(self.data_path(key)).st_size, key))
+        retval.sort()
+        return retval
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache fits in
+        L{max_size}. The caller must hold an exclusive L{lock}.
+
+        @type  keep: string
+        @param keep: key of an entry that must not be evicted
+        """
+        entries = self.entries()
+        total = sum([size for (last_use, size, key) in entries])
+        for (last_use, size, key) in entries:
+            if total <= self.max_size * 1024 * 1024:
+                break
+            if key == keep:
+                continue
+            logging.debug('Evicting cache entry %s (%d bytes)' % (key, size))
+            self.remove(key)
+            total -= size
+
+class PackagePool(Cache):
+    """
+    A pool of downloaded package files (.deb, .rpm) shared by builds.
+
+    A build gets a directory of its own (from L{checkout}) holding hard
+    links to every package in the pool, for the package manager to use
+    as its download cache. Afterwards, L{checkin} links the packages it
+    downloaded back into the pool. Package files are never modified in
+    place, so builds can't disturb each other, and evicting a package
+    from the pool doesn't affect builds that are using it.
+
+    @type  suffix: string
+    @param suffix: The file name suffix of package files (e.g. '.deb')
+    """
+    def __init__(self, directory, max_size, suffix):
+        super(PackagePool, self).__init__(directory, max_size)
+        self.suffix = suffix
+        self.pool = '%s/pool' % self.directory
+        if not os.path.isdir(self.pool):
+            os.makedirs(self.pool)
+
+    def packages(self, root):
+        """
+        @rtype:  list
+        @return: paths (relative to root) of the package files below root.
+                 Unfinished downloads (in partial/ directories) are skipped.
+        """
+        retval = []
+        for (dirpath, dirnames, filenames) in os.walk(root):
+            if 'partial' in dirnames:
+                dirnames.remove('partial')
+            for filename in filenames:
+                if filename.endswith(self.suffix):
+                    retval.append(os.path.relpath(os.path.join(dirpath, filename), root))
+        return retval
+
+    def link_packages(self, src, dest, names):
+        for name in names:
+            target = os.path.join(dest, name)
+            if os.path.exists(target):
+                continue
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            os.link(os.path.join(src, name), target)
+
+    def checkout(self):
+        """
+        @rtype:  string
+        @return: a new directory holding (hard links to) all the packages
+                 in the pool. Pass it to L{checkin} or remove it when done.
+        """
+        builddir = tempfile.mkdtemp(prefix='.build', dir=self.directory)
+        lock = self.lock(exclusive=False)
+        try:
+            names = self.packages(self.pool)
+            self.link_packages(self.pool, builddir, names)
+            for name in names:
+                os.utime(os.path.join(self.pool, name), None)
+        finally:
+            lock.release()
+        logging.debug('Checked out %d cached packages to %s' % (len(names), builddir))
+        return builddir
+
+    def checkin(self, builddir):
+        """
+        Adds the packages in builddir that are new to the pool, evicts
+        old ones if the pool has grown too large, and removes builddir.
+        """
+        lock = self.lock()
+        try:
+            names = [name for name in self.packages(builddir) if not os.path.exists(os.path.join(self.pool, name))]
+            self.link_packages(builddir, self.pool, names)
+            logging.debug('Added %d packages to the package cache' % len(names))
+            self.evict()
+        finally:
+            lock.release()
+        shutil.rmtree(builddir)
+
+    def entries(self):
+        retval = []
+        for name in self.packages(self.pool):
+            st = os.stat(os.path.join(self.pool, name))
+            retval.append((st.st_mtime, st.st_size, name))
+        retval.sort()
+        return retval
+
+    def remove(self, key):
+        os.unlink(os.path.join(self.pool, key))
@@ -0,0 +1,196 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Checkpoints, so that a failed build can be resumed
+import json
+import logging
+import os
+import os.path
+import shutil
+import stat
+import tempfile
+from   VMBuilder.cache import cache_key
+from   VMBuilder.util  import run_cmd
+
+# The stages that leave a checkpoint, in build order:
+#   bootstrap: the chroot after the bootstrap step
+#   chroot:    the finished chroot (after configure_os)
+#   install:   the disk and filesystem images after install_os
+STAGES = ['bootstrap', 'chroot', 'install']
+
+def settings_hash(contexts, *extra):
+    """
+    @type  contexts: list
+    @param contexts: The distro and hypervisor
+    @rtype:  string
+    @return: a digest of the contexts' settings and extra, the inputs of the build
+    """
+    parts = []
+    for context in contexts:
+        parts.append((context.arg, sorted([(name, setting.get_value()) for (name, setting) in context._config.items()])))
+    return cache_key(parts, extra)
+
+class Checkpoints(object):
+    """
+    The checkpoints of a build, kept in a directory: the state file,
+    a snapshot of the chroot (a tarball) and copies of the images.
+
+    The state file records which stages are done and the settings hash
+    of the build that did them. Checkpoints of a build with a different
+    hash are not used.
+
+    @type  directory: string
+    @param directory: Where to keep the checkpoints (created if needed)
+    @type  key: string
+    @param key: The build's L{settings_hash}
+    """
+    def __init__(self, directory, key):
+        self.directory = directory
+        self.key = key
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.state = self.read_state()
+        if self.state.get('key') != key:
+            if self.state.get('stages'):
+                logging.info('Settings changed since the checkpoints in %s were made, not using them' % directory)
+            self.reset()
+
+    def state_path(self):
+        return '%s/state.json' % self.directory
+
+    def chroot_path(self):
+        return '%s/chroot.tar' % self.directory
+
+    def images_dir(self):
+        return '%s/images' % self.directory
+
+    def read_state(self):
+        try:
+            fp = open(self.state_path())
+            try:
+                return json.load(fp)
+            finally:
+                fp.close()
+        except (IOError, ValueError):
+            return {}
+
+    def write_state(self):
+        (fd, tmpname) = tempfile.mkstemp(prefix='.tmp', dir=self.directory)
+        fp = os.fdopen(fd, 'w')
+        try:
+            json.dump(self.state, fp)
+        finally:
+            fp.close()
+        os.rename(tmpname, self.state_path())
+
+    def reset(self):
+        """
+        Forgets all checkpoints.
+        """
+        self.state = { 'key' : self.key, 'stages' : {} }
+        for path in [self.chroot_path(), self.images_dir()]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.unlink(path)
+        self.write_state()
+
+    def last_stage(self):
+        """
+        @rtype:  string
+        @return: the last stage that is done, or None
+        """
+        done = [stage for stage in STAGES if stage in self.state['stages']]
+        return done and done[-1] or None
+
+    def mark_done(self, stage, outputs=None):
+        """
+        Records that stage is done. The stage's files must be in place.
+        """
+        self.state['stages'][stage] = outputs or {}
+        self.write_state()
+        logging.info('Checkpoint: %s done' % stage)
+
+    def save_chroot(self, stage, chroot_dir, excludes=[]):
+        """
+        Snapshots chroot_dir as the result of stage, replacing the
+        snapshot of any earlier stage.
+
+        @type  excludes: list
+        @param excludes: Paths (in the chroot) to leave out
+        """
+        snapshot = '%s.tmp' % self.chroot_path()
+        args = ['--exclude=.%s' % path for path in excludes]
+        run_cmd('tar', '--numeric-owner', '--one-file-system', *(args + ['-cpf', snapshot, '-C', chroot_dir, '.']))
+        os.rename(snapshot, self.chroot_path())
+        self.mark_done(stage)
+
+    def restore_chroot(self, chroot_dir):
+        """
+        Restores the latest chroot snapshot into chroot_dir.
+
+        @rtype:  string
+        @return: the stage the snapshot was taken after, or None if there
+                 is none
+        """
+        stage = [stage for stage in ['chroot', 'bootstrap'] if stage in self.state['stages']]
+        if not stage or not os.path.exists(self.chroot_path()):
+            return None
+        logging.info('Resuming: restoring the chroot as it was after the %s stage' % stage[0])
+        run_cmd('tar', '--numeric-owner', '-xpf', self.chroot_path(), '-C', chroot_dir)
+        return stage[0]
+
+    def save_images(self, stage, filenames):
+        """
+        Copies the image files (copy-on-write if the filesystem can)
+        as the result of stage. Block devices are left alone.
+        """
+        if not os.path.isdir(self.images_dir()):
+            os.mkdir(self.images_dir())
+        saved = {}
+        for (index, filename) in enumerate(filenames):
+            if not stat.S_ISREG(os.stat(filename).st_mode):
+                continue
+            copy = '%s/%d-%s' % (self.images_dir(), index, os.path.basename(filename))
+            run_cmd('cp', '--reflink=auto', '--sparse=always', filename, copy)
+            saved[str(index)] = copy
+        self.mark_done(stage, { 'images' : saved })
+
+    def restore_images(self, stage, filenames):
+        """
+        Puts the images saved by L{save_images} back in place, under
+        their new names (filenames, in the same order as when saved).
+        """
+        saved = self.state['stages'][stage]['images']
+        for (index, filename) in enumerate(filenames):
+            if str(index) in saved:
+                logging.info('Resuming: restoring %s' % filename)
+                run_cmd('cp', '--reflink=auto', '--sparse=always', saved[str(index)], filename)
+
+    def remove(self):
+        """
+        Removes the checkpoints, once the build has succeeded. The
+        directory itself is only removed if nothing else is in it.
+        """
+        for path in [self.chroot_path(), self.images_dir(), self.state_path()]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.unlink(path)
+        if not os.listdir(self.directory):
+            os.rmdir(self.directory)
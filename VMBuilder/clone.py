@@ -0,0 +1,194 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Creating VMs as customized copies of an existing image
+import glob
+import logging
+import os
+import os.path
+import time
+from   VMBuilder.disk      import SECTOR_SIZE, detach_loop_device, qemu_img_path, read_partitions, read_superblock_uuid, wait_for
+from   VMBuilder.exception import VMBuilderException, VMBuilderUserError
+from   VMBuilder.hypervisor import STORAGE_DISK_IMAGE
+from   VMBuilder.qcow2     import QCOW_MAGIC
+from   VMBuilder.util      import run_cmd, tmpdir
+from   struct              import pack
+
+def image_format(filename):
+    """
+    @rtype:  string
+    @return: 'qcow2' or 'raw'
+    """
+    fp = open(filename, 'rb')
+    try:
+        magic = fp.read(4)
+    finally:
+        fp.close()
+    if magic == pack('>I', QCOW_MAGIC):
+        return 'qcow2'
+    return 'raw'
+
+def create_overlay(base, dest):
+    """
+    Creates dest as a copy-on-write copy of base: a qcow2 image using
+    base as its backing file, or for raw images a reflinked (or at least
+    sparse) copy.
+
+    @rtype:  string
+    @return: the format of dest
+    """
+    format = image_format(base)
+    if format == 'qcow2':
+        # Newer qemu-img refuses backing files of unspecified format
+        run_cmd(qemu_img_path(), 'create', '-f', 'qcow2', '-o', 'backing_file=%s,backing_fmt=qcow2' % os.path.abspath(base), dest)
+    else:
+        run_cmd('cp', '--reflink=auto', '--sparse=always', base, dest)
+    return format
+
+def nbd_device_free(device):
+    return open('/sys/block/%s/size' % os.path.basename(device)).read().strip() == '0'
+
+def attach_qcow2(context, filename):
+    """
+    Makes the contents of the qcow2 image filename available as a block
+    device using qemu-nbd.
+
+    @rtype:  string
+    @return: the block device
+    """
+    run_cmd('modprobe', 'nbd', ignore_fail=True)
+    for device in sorted(glob.glob('/dev/nbd[0-9]*')):
+        if not os.path.exists('/sys/block/%s' % os.path.basename(device)) or not nbd_device_free(device):
+            continue
+        run_cmd('qemu-nbd', '--connect=%s' % device, filename)
+        context.add_clean_cmd('qemu-nbd', '--disconnect', device, ignore_fail=True)
+        if not wait_for(lambda: not nbd_device_free(device)):
+            raise VMBuilderException('%s did not show up on %s' % (filename, device))
+        return device
+    raise VMBuilderUserError('No free nbd device found to attach %s to' % filename)
+
+def attach_root_filesystem(context, image):
+    """
+    Finds the root filesystem in image (a disk image with an MBR or GPT
+    partition table, or a filesystem image, given as a file or block
+    device) and attaches it to a loop device.
+
+    The root filesystem is the first one with an /etc/fstab.
+
+    @rtype:  string
+    @return: the loop device
+    """
+    try:
+        partitions = [(start * SECTOR_SIZE, count * SECTOR_SIZE) for (start, count) in read_partitions(image)]
+    except VMBuilderException:
+        # A filesystem image
+        partitions = [(0, None)]
+
+    mntdir = tmpdir()
+    try:
+        for (offset, size) in partitions:
+            cmd = ['losetup', '--find', '--show', '--offset', str(offset)]
+            if size:
+                cmd += ['--sizelimit', str(size)]
+            loopdev = run_cmd(*(cmd + [image])).strip()
+            try:
+                # Skips swap and anything that isn't a filesystem quickly
+                read_superblock_uuid(loopdev)
+                run_cmd('mount', '-o', 'ro', loopdev, mntdir)
+                is_root = os.path.exists('%s/etc/fstab' % mntdir)
+                run_cmd('umount', mntdir)
+                if is_root:
+                    context.add_clean_cb(lambda loopdev=loopdev: detach_loop_device(loopdev, ignore_fail=True))
+                    return loopdev
+            except VMBuilderException:
+                # Not a filesystem we can mount
+                pass
+            detach_loop_device(loopdev)
+    finally:
+        os.rmdir(mntdir)
+    raise VMBuilderUserError('Could not find a root filesystem in %s' % image)
+
+def check_hypervisor(hypervisor):
+    """
+    Raises a VMBuilderUserError unless hypervisor can run a clone: it
+    must use disk images, and run qcow2 ones, which means it runs raw
+    ones, too. Hypervisors that use filesystem images (Xen) need several
+    of them, and the others need their images converted.
+    """
+    if (hypervisor.preferred_storage != STORAGE_DISK_IMAGE or
+        getattr(hypervisor, 'filetype', None) != 'qcow2'):
+        raise VMBuilderUserError('%s VMs can not be cloned, only ones that run a qcow2 or raw disk image (e.g. kvm)' % hypervisor.name)
+
+def clone_image(hypervisor, base, destdir):
+    """
+    Creates a VM in destdir as a copy-on-write copy of the image base,
+    customized according to hypervisor's and its distro's settings.
+
+    The copy is edited offline: its root filesystem is mounted and the
+    configure_networking and customize_clone hooks run on it, just as
+    they would on a freshly built chroot. Only the root filesystem is
+    mounted, so customizations that live on other filesystems (e.g. a
+    separate /home) are not applied. Then the hypervisor deploys the
+    copy as it would a freshly built disk image (e.g. writing run.sh or
+    defining the libvirt domain).
+
+    Only hypervisors that run a single qcow2 or raw disk image as it
+    is are supported (see L{check_hypervisor}).
+
+    The distro's settings must have been checked already (see
+    L{VMBuilder.distro.Distro.check_settings}).
+
+    @rtype:  string
+    @return: the new image
+    """
+    check_hypervisor(hypervisor)
+    start = time.time()
+    distro = hypervisor.distro
+    dest = os.path.join(destdir, os.path.basename(base))
+    format = create_overlay(base, dest)
+
+    mntdir = tmpdir()
+    try:
+        if format == 'qcow2':
+            image = attach_qcow2(hypervisor, dest)
+        else:
+            image = dest
+        loopdev = attach_root_filesystem(hypervisor, image)
+        run_cmd('mount', loopdev, mntdir)
+        umount = hypervisor.add_clean_cmd('umount', mntdir, ignore_fail=True)
+
+        distro.set_chroot_dir(mntdir)
+        hypervisor.call_hooks('preflight_check')
+        hypervisor.nics = [hypervisor.NIC()]
+        # This runs the distro's configure_networking, too
+        hypervisor.call_hooks('configure_networking', hypervisor.nics)
+        distro.call_hooks('customize_clone')
+
+        hypervisor.cancel_cleanup(umount)
+        run_cmd('umount', mntdir)
+    finally:
+        hypervisor.cleanup()
+        os.rmdir(mntdir)
+
+    # The copy is already in destdir in a format the hypervisor runs,
+    # so it isn't converted (see VMBuilder.disk.Disk.convert)
+    hypervisor.add_disk(dest)
+    hypervisor.finalise(destdir)
+
+    logging.info('Cloned %s to %s in %.1f seconds' % (base, dest, time.time() - start))
+    return dest
@@ -0,0 +1,306 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Batch frontend: builds many VMs from one manifest
+#
+#    The manifest is an ini file with one section per VM. The section
+#    name is the VM's name (and default destination directory), the
+#    options are the command line options of the cli frontend without
+#    the leading dashes, plus 'distro' and 'hypervisor'. Options in
+#    the [DEFAULT] section apply to every VM:
+#
+#        [DEFAULT]
+#        distro = ubuntu
+#        hypervisor = kvm
+#        suite = lucid
+#        addpkg = openssh-server
+#
+#        [web1]
+#        hostname = web1
+#        ip = 10.0.0.11
+#
+#    VMs whose chroots would come out the same share a single chroot,
+#    which is built once. Each VM then gets a copy of it, which is
+#    installed on its disk images in a worker process of its own.
+import ConfigParser
+import logging
+import multiprocessing
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import VMBuilder
+import VMBuilder.util as util
+from   VMBuilder.cache import cache_key
+from   VMBuilder.contrib.cli import CLI
+from   VMBuilder.exception import VMBuilderUserError
+
+# Settings that only affect what happens after the chroot is built (or
+# that are applied to each VM's copy of it), so VMs that differ only in
+# these can share a chroot.
+PER_VM_SETTINGS = ['hostname', 'domain', 'ip', 'mask', 'net', 'bcast',
+                   'gw', 'dns', 'mac', 'bridge', 'ssh-key', 'ssh-user-key']
+
+# Manifest options that aren't settings
+LAYOUT_OPTIONS = { 'rootsize' : 4096,
+                   'swapsize' : 1024,
+                   'optsize' : 0,
+                   'part' : None,
+                   'raw' : None }
+FRONTEND_OPTIONS = ['distro', 'hypervisor', 'destdir'] + LAYOUT_OPTIONS.keys()
+
+def build_vm_worker(args):
+    """
+    multiprocessing entry point for L{Batch.build_vm}
+    """
+    (batch, name, spec, chroot_dir) = args
+    start = time.time()
+    try:
+        batch.build_vm(name, spec, chroot_dir)
+        return (name, None, time.time() - start)
+    except Exception, e:
+        logging.exception('Building %s failed' % name)
+        return (name, str(e) or e.__class__.__name__, time.time() - start)
+
+class Batch(CLI):
+    arg = 'batch'
+
+    def main(self):
+        optparser = optparse.OptionParser()
+        optparser.set_usage('%prog MANIFEST [options]')
+        optparser.add_option('--debug',
+                             action='callback',
+                             callback=self.set_verbosity,
+                             help='Show debug information')
+        optparser.add_option('--verbose',
+                             '-v',
+                             action='callback',
+                             callback=self.set_verbosity,
+                             help='Show progress information')
+        optparser.add_option('--jobs',
+                             '-j',
+                             type='int',
+                             default=multiprocessing.cpu_count(),
+                             help=('Install up to JOBS VMs at a time '
+                                   '[default: %default]'))
+        optparser.add_option('--overwrite',
+                             '-o',
+                             action='store_true',
+                             help='Replace existing destination directories')
+        optparser.add_option('--tmp',
+                             '-t',
+                             metavar='DIR',
+                             dest='tmp_root',
+                             default=tempfile.gettempdir(),
+                             help=('Use TMP as temporary working space '
+                                   '[default: %default]'))
+        (self.batch_options, args) = optparser.parse_args(sys.argv[1:])
+        if len(args) != 1:
+            optparser.error('You need to specify the manifest')
+        if os.geteuid() != 0:
+            raise VMBuilderUserError('Must run as root')
+        if self.batch_options.jobs < 1:
+            raise VMBuilderUserError('--jobs must be at least 1')
+
+        specs = self.read_manifest(args[0])
+        results = self.build(specs)
+        self.print_summary(results)
+        if [result for result in results if result[1]]:
+            sys.exit(1)
+
+    def read_manifest(self, filename):
+        """
+        @rtype:  list
+        @return: (name, options) tuples, one per VM in the manifest
+        """
+        confparser = ConfigParser.SafeConfigParser()
+        if not confparser.read([filename]):
+            raise VMBuilderUserError('Could not read manifest %s' % filename)
+        specs = []
+        for name in confparser.sections():
+            spec = dict(confparser.items(name))
+            for option in ['distro', 'hypervisor']:
+                if not spec.get(option):
+                    raise VMBuilderUserError('No %s given for %s' % (option, name))
+            specs.append((name, spec))
+        if not specs:
+            raise VMBuilderUserError('%s does not list any VMs' % filename)
+        return specs
+
+    def apply_settings(self, context, spec, exclude=[]):
+        for (key, value) in spec.iteritems():
+            if key in exclude or key in FRONTEND_OPTIONS:
+                continue
+            if context.has_setting(key):
+                context.set_setting_fuzzy(key, value)
+
+    def chroot_key(self, spec):
+        """
+        @rtype:  string
+        @return: a key that is the same for all VMs that can share a chroot
+        """
+        distro = VMBuilder.get_distro(spec['distro'])()
+        shared = [(key, value) for (key, value) in sorted(spec.items())
+                  if distro.has_setting(key) and key not in PER_VM_SETTINGS]
+        # The chroot needs an ssh server if any of its VMs gets a key
+        wants_ssh = bool(spec.get('ssh-key') or spec.get('ssh-user-key'))
+        return cache_key(spec['distro'], shared, wants_ssh)
+
+    def build_chroot(self, spec):
+        """
+        Builds the chroot shared by the VMs with the same L{chroot_key} as spec.
+
+        @rtype:  string
+        @return: the chroot directory
+        """
+        distro = VMBuilder.get_distro(spec['distro'])()
+        self.apply_settings(distro, spec, exclude=PER_VM_SETTINGS)
+        if spec.get('ssh-key') or spec.get('ssh-user-key'):
+            distro.set_setting('addpkg', distro.get_setting('addpkg') + ['openssh-server'])
+        chroot_dir = util.tmpdir(tmp_root=self.batch_options.tmp_root)
+        distro.set_chroot_dir(chroot_dir)
+        try:
+            distro.build_chroot()
+        except:
+            util.run_cmd('rm', '-rf', '--one-file-system', chroot_dir)
+            raise
+        return chroot_dir
+
+    def build_vm(self, name, spec, chroot_dir):
+        """
+        Installs a copy of chroot_dir on name's disk images, configured
+        according to spec.
+        """
+        distro = VMBuilder.get_distro(spec['distro'])()
+        hypervisor = VMBuilder.get_hypervisor(spec['hypervisor'])(distro)
+        hypervisor.register_hook('fix_ownership', self.fix_ownership)
+        distro.overwrite = hypervisor.overwrite = self.batch_options.overwrite
+        self.apply_settings(distro, spec)
+        self.apply_settings(hypervisor, spec)
+
+        destdir = spec.get('destdir') or name
+        if os.path.exists(destdir):
+            if self.batch_options.overwrite:
+                shutil.rmtree(destdir)
+            else:
+                raise VMBuilderUserError('%s already exists' % destdir)
+
+        clone = util.tmpdir(tmp_root=self.batch_options.tmp_root)
+        try:
+            self.clone_chroot(distro, chroot_dir, clone)
+            distro.check_settings()
+            self.install_authorized_keys(distro)
+
+            # set_disk_layout takes its input from the cli options
+            self.options = optparse.Values(dict(LAYOUT_OPTIONS, tmp_root=self.batch_options.tmp_root))
+            for option in LAYOUT_OPTIONS:
+                if spec.get(option):
+                    setattr(self.options, option, spec[option])
+            if self.options.raw:
+                self.options.raw = self.options.raw.split(',')
+            self.set_disk_layout(optparse.OptionParser(), hypervisor)
+
+            hypervisor.install_os()
+            os.mkdir(destdir)
+            self.fix_ownership(destdir)
+            hypervisor.finalise(destdir)
+        finally:
+            util.run_cmd('rm', '-rf', '--one-file-system', clone)
+
+    def clone_chroot(self, distro, chroot_dir, clone):
+        """
+        Copies the shared chroot_dir to the empty directory clone, and
+        makes it distro's chroot. The copy gets ssh host keys and machine
+        ids of its own, so the VMs of a group don't share them.
+        """
+        util.run_cmd('cp', '-a', '--reflink=auto', '%s/.' % chroot_dir, clone)
+        distro.set_chroot_dir(clone)
+        distro.reset_machine_identity()
+
+    def install_authorized_keys(self, distro):
+        """
+        Installs the VM's ssh keys, which the shared chroot was built without.
+        """
+        ssh_key = distro.get_setting('ssh-key')
+        if ssh_key:
+            distro.install_file('/root/.ssh/authorized_keys', source=ssh_key, mode=0644)
+            os.chmod('%s/root/.ssh' % distro.chroot_dir, 0700)
+
+        ssh_user_key = distro.get_setting('ssh-user-key')
+        if ssh_user_key:
+            user = distro.get_setting('user')
+            distro.install_file('/home/%s/.ssh/authorized_keys' % user, source=ssh_user_key, mode=0644)
+            os.chmod('%s/home/%s/.ssh' % (distro.chroot_dir, user), 0700)
+            distro.run_in_target('chown', '-R', '%s:%s' % ((user,)*2), '/home/%s/.ssh/' % (user))
+
+    def build(self, specs):
+        """
+        Builds the shared chroots (one at a time), then installs the
+        VMs, up to --jobs at a time.
+
+        @rtype:  list
+        @return: (name, error or None, seconds) tuples, in manifest order
+        """
+        groups = {}
+        for (name, spec) in specs:
+            groups.setdefault(self.chroot_key(spec), []).append((name, spec))
+        logging.info('Building %d VMs from %d shared chroots' % (len(specs), len(groups)))
+
+        results = {}
+        chroots = []
+        work = []
+        try:
+            for members in groups.values():
+                start = time.time()
+                try:
+                    chroot_dir = self.build_chroot(members[0][1])
+                except Exception, e:
+                    logging.exception('Building the chroot for %s failed' % ', '.join([name for (name, spec) in members]))
+                    for (name, spec) in members:
+                        results[name] = (name, 'chroot: %s' % e, time.time() - start)
+                    continue
+                chroots.append(chroot_dir)
+                logging.info('Built the chroot for %s in %.1f seconds' %
+                             (', '.join([name for (name, spec) in members]), time.time() - start))
+                work += [(self, name, spec, chroot_dir) for (name, spec) in members]
+
+            if work:
+                pool = multiprocessing.Pool(min(self.batch_options.jobs, len(work)))
+                try:
+                    for result in pool.imap_unordered(build_vm_worker, work):
+                        results[result[0]] = result
+                        logging.info('%s %s after %.1f seconds' % (result[0], result[1] and 'failed' or 'finished', result[2]))
+                    pool.close()
+                finally:
+                    pool.terminate()
+                    pool.join()
+        finally:
+            for chroot_dir in chroots:
+                util.run_cmd('rm', '-rf', '--one-file-system', chroot_dir)
+        return [results[name] for (name, spec) in specs]
+
+    def print_summary(self, results):
+        width = max([len(name) for (name, error, elapsed) in results] + [4])
+        print '%-*s  %-6s  %8s' % (width, 'VM', 'Result', 'Seconds')
+        for (name, error, elapsed) in results:
+            print '%-*s  %-6s  %8.1f%s' % (width, name, error and 'FAILED' or 'OK', elapsed,
+                                           error and '  %s' % error or '')
+        failed = len([result for result in results if result[1]])
+        print '%d built, %d failed' % (len(results) - failed, failed)
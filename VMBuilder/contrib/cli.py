@@ -27,6 +27,10 @@ import VMBuilder
 import VMBuilder.util as util
 from   VMBuilder.disk import parse_size
 import VMBuilder.hypervisor
+import VMBuilder.profiler
+from   VMBuilder.scheduler import Stage, run_stages
+from   VMBuilder.checkpoint import Checkpoints, settings_hash
+from   VMBuilder.clone import check_hypervisor, clone_image
 from   VMBuilder.exception import VMBuilderUserError, VMBuilderException
 
 class CLI(object):
@@ -63,6 +67,39 @@ class CLI(object):
                              '-o',
                              action='store_true',
                              help='Configuration file')
+            group.add_option('--unsafe-io',
+                             action='store_true',
+                             help=('Skip fsync() while installing packages and '
+                                   'sync once at the end instead. Much faster, '
+                                   'but the build is lost if the host crashes.'))
+            group.add_option('--profile',
+                             metavar='PATH',
+                             help=('Write a profile of the build (time spent in '
+                                   'each hook and command) to PATH. It can be '
+                                   'loaded into chrome://tracing.'))
+            group.add_option('--parallel-stages',
+                             action='store_true',
+                             help=('Create and format the disk images while '
+                                   'the chroot is being built.'))
+            group.add_option('--checkpoint-dir',
+                             metavar='DIR',
+                             help=('Keep checkpoints of the build in DIR: the '
+                                   'chroot after bootstrapping and after '
+                                   'configuring it, and the images after '
+                                   'installing the chroot on them. They are '
+                                   'removed once the build succeeds.'))
+            group.add_option('--resume',
+                             action='store_true',
+                             help=('Continue a failed build from its last '
+                                   'checkpoint in --checkpoint-dir, if it was '
+                                   'made with the same settings.'))
+            group.add_option('--clone-from',
+                             metavar='IMAGE',
+                             help=('Instead of building from scratch, make a '
+                                   'copy-on-write copy of IMAGE (a raw or qcow2 '
+                                   'disk image or a filesystem image built '
+                                   'earlier) and apply the hostname, network, '
+                                   'user and ssh key settings to it.'))
             group.add_option('--config',
                              '-c',
                              type='str',
@@ -153,7 +190,11 @@ class CLI(object):
             if os.geteuid() != 0:
                 raise VMBuilderUserError('Must run as root')
 
+            if self.options.profile:
+                VMBuilder.profiler.start()
+
             distro.overwrite = hypervisor.overwrite = self.options.overwrite
+            distro.unsafe_io = hypervisor.unsafe_io = self.options.unsafe_io
             destdir = self.options.destdir or ('%s-%s' % (distro.arg,
                                                           hypervisor.arg))
 
@@ -188,14 +229,43 @@ class CLI(object):
                 option = option.replace('_', '-')
                 if val:
                     if (distro.has_setting(option) and
-                        distro.get_setting_default(option) != val):
+                        not self.is_default(distro, option, val)):
                         distro.set_setting_fuzzy(option, val)
                     elif (hypervisor.has_setting(option) and
-                          hypervisor.get_setting_default(option) != val):
+                          not self.is_default(hypervisor, option, val)):
                         hypervisor.set_setting_fuzzy(option, val)
 
+            if self.options.clone_from:
+                check_hypervisor(hypervisor)
+                distro.check_settings()
+                os.mkdir(destdir)
+                self.fix_ownership(destdir)
+                self.fix_ownership(clone_image(hypervisor, self.options.clone_from, destdir))
+                return
+
+            checkpoints = None
+            if self.options.checkpoint_dir:
+                checkpoints = Checkpoints(self.options.checkpoint_dir,
+                                          settings_hash([distro, hypervisor],
+                                                        self.options.rootsize,
+                                                        self.options.optsize,
+                                                        self.options.swapsize,
+                                                        self.options.raw,
+                                                        self.options.part))
+                if not self.options.resume:
+                    checkpoints.reset()
+                distro.checkpoints = checkpoints
+            elif self.options.resume:
+                raise VMBuilderUserError('--resume needs --checkpoint-dir')
+            # install_os is resumed as a whole: if it finished, only the
+            # images need to be put back.
+            resume_install = (checkpoints and not self.options.only_chroot and
+                              checkpoints.last_stage() == 'install')
+
             chroot_dir = None
-            if self.options.existing_chroot:
+            if resume_install:
+                distro.check_settings()
+            elif self.options.existing_chroot:
                 distro.set_chroot_dir(self.options.existing_chroot)
                 distro.call_hooks('preflight_check')
             else:
@@ -213,28 +283,53 @@ class CLI(object):
                 else:
                     chroot_dir = util.tmpdir(tmp_root=self.options.tmp_root)
                 distro.set_chroot_dir(chroot_dir)
-                distro.build_chroot()
+                if self.options.parallel_stages and not self.options.only_chroot:
+                    # The disk layout depends on the distro's settings,
+                    # but not on the chroot.
+                    distro.check_settings()
+                else:
+                    distro.build_chroot()
 
             if self.options.only_chroot:
+                distro.disable_unsafe_io()
                 print 'Chroot can be found in %s' % distro.chroot_dir
                 sys.exit(0)
 
             self.set_disk_layout(optparser, hypervisor)
-            hypervisor.install_os()
+            images = [image.filename for image in hypervisor.images()]
+            if resume_install:
+                checkpoints.restore_images('install', images)
+            elif self.options.parallel_stages and not self.options.existing_chroot:
+                # The preflight checks include the distro's, which change
+                # its state, so they can't run alongside the chroot stage.
+                hypervisor.call_hooks('preflight_check')
+                run_stages([Stage('chroot', distro.populate_chroot),
+                            Stage('disks', hypervisor.prepare_disks, cleanup=hypervisor.cleanup),
+                            Stage('install', hypervisor.install_os, after=['chroot', 'disks'])])
+            else:
+                hypervisor.install_os()
+            if checkpoints and not resume_install:
+                checkpoints.save_images('install', images)
 
             os.mkdir(destdir)
             self.fix_ownership(destdir)
             hypervisor.finalise(destdir)
+            if VMBuilder.profiler.profiler:
+                VMBuilder.profiler.profiler.measure_images(destdir)
             # If chroot_dir is not None, it means we created it,
             # and if we reach here, it means the user didn't pass
             # --only-chroot. Hence, we need to remove it to clean
             # up after ourselves.
             if chroot_dir is not None and tmpfs_mount_point is None:
                 util.run_cmd('rm', '-rf', '--one-file-system', chroot_dir)
+            if checkpoints:
+                checkpoints.remove()
         except VMBuilderException, e:
             logging.error(e)
             raise
         finally:
+            if VMBuilder.profiler.profiler:
+                VMBuilder.profiler.stop(self.options.profile)
             if tmpfs_mount_point is not None:
                 util.clean_up_tmpfs(tmpfs_mount_point)
                 util.run_cmd('rmdir', tmpfs_mount_point)
@@ -252,6 +347,19 @@ class CLI(object):
             (uid, gid) = pwd.getpwnam(os.environ['SUDO_USER'])[2:4]
             os.chown(filename, uid, gid)
 
+    def is_default(self, context, option, val):
+        """
+        @rtype:  bool
+        @return: Whether val is option's default (so it need not be set).
+                 Lazy defaults aren't given to optparse (see
+                 L{add_settings_from_context}), so an option with a lazy
+                 default that has a value was given by the user, and its
+                 default is left uncomputed.
+        """
+        if context._config[option].has_lazy_default():
+            return False
+        return context.get_setting_default(option) == val
+
     def add_settings_from_context(self, optparser, context):
         setting_groups = set([setting.setting_group for setting
                                                 in context._config.values()])
@@ -267,7 +375,11 @@ class CLI(object):
                         setting.help += " Config option: %s" % setting.name
                 if setting.metavar:
                     kwargs['metavar'] = setting.metavar
-                if setting.get_default():
+                if setting.has_lazy_default():
+                    # Don't compute it just to build the option parser
+                    if setting.help:
+                        kwargs['help'] = setting.help.replace('%default', str(setting.default))
+                elif setting.get_default():
                     kwargs['default'] = setting.get_default()
                 if type(setting) == VMBuilder.plugins.Plugin.BooleanSetting:
                     kwargs['action'] = 'store_true'
@@ -438,7 +550,7 @@ class UVB(CLI):
 
     def suite_help(self):
         return ('Suite. Valid options: %s' %
-                        " ".join(VMBuilder.plugins.ubuntu.distro.Ubuntu.suites))
+                        " ".join(VMBuilder.get_distro('ubuntu').suites))
 
     def handle_args(self, optparser, args):
         if len(args) < 2:
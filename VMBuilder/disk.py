@@ -20,15 +20,19 @@
 
 import fcntl
 import logging
+import multiprocessing
 import os
 import os.path
 import re
 import stat
 import string
 import time
-from   VMBuilder.util      import run_cmd 
+import uuid
+import zlib
+import VMBuilder.qcow2
+from   VMBuilder.util      import run_cmd, run_parallel, tmp_filename
 from   VMBuilder.exception import VMBuilderUserError, VMBuilderException
-from   struct              import unpack
+from   struct              import pack, unpack
 
 TYPE_EXT2 = 0
 TYPE_EXT3 = 1
@@ -36,6 +40,27 @@ TYPE_XFS = 2
 TYPE_SWAP = 3
 TYPE_EXT4 = 4
 
+SECTOR_SIZE = 512
+
+# Partitions are aligned to 1MB, except for one starting at the very
+# beginning of the disk, which only skips the first track.
+SECTORS_PER_MB = 1024*1024 / SECTOR_SIZE
+FIRST_TRACK_SECTORS = 63
+
+# MBR can't address more than 2**32 sectors (2TB). Larger disks get a GPT.
+MBR_MAX_SECTORS = 2**32 - 1
+
+MBR_PARTITION_TYPES = { TYPE_EXT2: 0x83, TYPE_EXT3: 0x83, TYPE_EXT4: 0x83, TYPE_XFS: 0x83, TYPE_SWAP: 0x82 }
+MBR_PROTECTIVE_TYPE = 0xee
+
+GPT_LINUX_DATA = uuid.UUID('0fc63daf-8483-4772-8e79-3d69d8477de4')
+GPT_LINUX_SWAP = uuid.UUID('0657fd6d-a4ab-43c4-84e5-0933c84b4f4f')
+GPT_PARTITION_TYPES = { TYPE_EXT2: GPT_LINUX_DATA, TYPE_EXT3: GPT_LINUX_DATA, TYPE_EXT4: GPT_LINUX_DATA, TYPE_XFS: GPT_LINUX_DATA, TYPE_SWAP: GPT_LINUX_SWAP }
+GPT_ENTRIES = 128
+GPT_ENTRY_SIZE = 128
+GPT_HEADER_SIZE = 92
+GPT_ENTRIES_SECTORS = GPT_ENTRIES * GPT_ENTRY_SIZE / SECTOR_SIZE
+
 class Disk(object):
     """
     Virtual disk.
@@ -103,18 +128,49 @@ class Disk(object):
 
     def partition(self):
         """
-        Partitions the disk image. First adds a partition table and then
-        adds the individual partitions.
+        Partitions the disk image. Computes the layout of all the
+        partitions and writes the whole partition table in one go: an MBR
+        or, for disks of 2TB and larger, a protective MBR plus a GPT (with
+        its backup copy at the end of the disk).
+
+        Once this returns, each partition's L{offset<Disk.Partition.offset>}
+        and L{nbytes<Disk.Partition.nbytes>} are set.
 
         Should only be called once and only after you've added all partitions.
         """
-
-        logging.info('Adding partition table to disk image: %s' % self.filename)
-        run_cmd('parted', '--script', self.filename, 'mklabel', 'msdos')
-
-        # Partition the disk 
-        for part in self.partitions:
-            part.create(self)
+        fp = open(self.filename, 'r+b')
+        try:
+            fp.seek(0, 2)
+            sectors = fp.tell() / SECTOR_SIZE
+            gpt = sectors > MBR_MAX_SECTORS
+            if gpt:
+                last_usable = sectors - GPT_ENTRIES_SECTORS - 2
+            else:
+                last_usable = sectors - 1
+
+            layout = []
+            for part in self.partitions:
+                (first, last) = part.sectors()
+                last = min(last, last_usable)
+                if last < first:
+                    raise VMBuilderUserError('Partition %s does not fit on %s' % (part.mntpnt, self.filename))
+                part.offset = first * SECTOR_SIZE
+                part.nbytes = (last - first + 1) * SECTOR_SIZE
+                layout.append((part, first, last))
+
+            if gpt:
+                logging.info('Adding GPT partition table to disk image: %s' % self.filename)
+                (primary, backup) = gpt_partition_table(layout, sectors)
+                fp.seek(0)
+                fp.write(primary)
+                fp.seek((sectors - len(backup) / SECTOR_SIZE) * SECTOR_SIZE)
+                fp.write(backup)
+            else:
+                logging.info('Adding MBR partition table to disk image: %s' % self.filename)
+                fp.seek(0)
+                fp.write(mbr_partition_table(layout))
+        finally:
+            fp.close()
 
     def map_partitions(self):
         """
@@ -123,24 +179,17 @@ class Disk(object):
         Once this has returned succesfully, each partition's map device
         is set as its L{filename<Disk.Partition.filename>} attribute.
 
-        Call this after L{partition}.
+        Call this after L{partition}, which works out where the
+        partitions are. Each partition gets a loop device of its own,
+        set up with the partition's offset and size.
         """
         logging.info('Creating loop devices corresponding to the created partitions')
         self.vm.add_clean_cb(lambda : self.unmap(ignore_fail=True))
-        kpartx_output = run_cmd('kpartx', '-av', self.filename)
-        parts = []
-        for line in kpartx_output.split('\n'):
-            if line == "" or line.startswith("gpt:") or line.startswith("dos:"):
-                continue
-            if line.startswith("add"):
-                parts.append(line)
-                continue
-            logging.error('Skipping unknown line in kpartx output (%s)' % line)
-        mapdevs = []
-        for line in parts:
-            mapdevs.append(line.split(' ')[2])
-        for (part, mapdev) in zip(self.partitions, mapdevs):
-            part.set_filename('/dev/mapper/%s' % mapdev)
+        for part in self.partitions:
+            if part.offset is None:
+                raise VMBuilderException('Partition %s has no known offset. Did you forget to call .partition()?' % part.mntpnt)
+            loopdev = run_cmd('losetup', '--find', '--show', '--offset', str(part.offset), '--sizelimit', str(part.nbytes), self.filename).strip()
+            part.set_filename(loopdev)
 
     def mkfs(self):
         """
@@ -170,26 +219,9 @@ class Disk(object):
 
         Unsets L{Partition}s' and L{Filesystem}s' filename attribute
         """
-        # first sleep to give the loopback devices a chance to settle down
-        time.sleep(3)
-
-        tries = 0
-        max_tries = 3
-        while tries < max_tries:
-            try:
-                run_cmd('kpartx', '-d', self.filename, ignore_fail=False)
-                break
-            except:
-                pass
-            tries += 1
-            time.sleep(3)
-
-            if tries >= max_tries:
-                # try it one last time
-                logging.info("Could not unmap '%s' after '%d' attempts. Final attempt" % (self.filename, tries))
-        run_cmd('kpartx', '-d', self.filename, ignore_fail=ignore_fail)
-
         for part in self.partitions:
+            if part.filename:
+                detach_loop_device(part.filename, ignore_fail=ignore_fail)
             part.set_filename(None)
 
     def add_part(self, begin, length, type, mntpnt):
@@ -217,7 +249,7 @@ class Disk(object):
         part = self.Partition(disk=self, begin=begin, end=end, type=str_to_type(type), mntpnt=mntpnt)
         self.partitions.append(part)
 
-        # We always keep the partitions in order, so that the output from kpartx matches our understanding
+        # We always keep the partitions in order, so that the partition table entries follow the disk layout
         self.partitions.sort(cmp=lambda x,y: x.begin - y.begin)
 
     def convert(self, destdir, format):
@@ -235,20 +267,31 @@ class Disk(object):
             # We don't convert preallocated disk images. That would be silly.
             return self.filename
 
+        destfile = self.converted_filename(destdir, format)
+        convert_image(*self.convert_args(destfile, format))
+        self.set_converted(destfile, format)
+        return destfile
+
+    def converted_filename(self, destdir, format):
+        """
+        @rtype:  string
+        @return: the name L{convert} gives the converted image
+        """
         filename = os.path.basename(self.filename)
         if '.' in filename:
             filename = filename[:filename.rindex('.')]
-        destfile = '%s/%s.%s' % (destdir, filename, format)
+        return '%s/%s.%s' % (destdir, filename, format)
 
-        logging.info('Converting %s to %s, format %s' % (self.filename, format, destfile))
-        if format == 'vdi':
-            run_cmd(vbox_manager_path(), 'convertfromraw', '-format', 'VDI', self.filename, destfile)
-        else:
-            run_cmd(qemu_img_path(), 'convert', '-O', format, self.filename, destfile)
-        os.unlink(self.filename)
+    def convert_args(self, destfile, format):
+        """
+        @rtype:  tuple
+        @return: the arguments for L{convert_image} to convert the disk to destfile
+        """
+        return (self.filename, destfile, format, self.vm.get_setting('convert-engine'), self.vm.get_setting('punch-holes'))
+
+    def set_converted(self, destfile, format):
         self.filename = os.path.abspath(destfile)
         self.format_type = format
-        return destfile
 
     class Partition(object):
         def __init__(self, disk, begin, end, type, mntpnt):
@@ -270,6 +313,12 @@ class Disk(object):
             self.filename = None
             "The filename of this partition (the map device)"
 
+            self.offset = None
+            "The byte offset of the partition inside the disk image (set by L{Disk.partition})"
+
+            self.nbytes = None
+            "The size of the partition in bytes (set by L{Disk.partition})"
+
             self.fs = Filesystem(vm=self.disk.vm, type=self.type, mntpnt=self.mntpnt)
             "The enclosed filesystem"
 
@@ -277,27 +326,40 @@ class Disk(object):
             self.filename = filename
             self.fs.filename = filename
 
-        def parted_fstype(self):
+        def sectors(self):
             """
-            @rtype: string
-            @return: the filesystem type of the partition suitable for passing to parted
+            @rtype:  tuple
+            @return: the first and last sector of the partition. A partition
+                     at the beginning of the disk starts after the first track.
             """
-            return { TYPE_EXT2: 'ext2', TYPE_EXT3: 'ext2', TYPE_EXT4: 'ext2', TYPE_XFS: 'ext2', TYPE_SWAP: 'linux-swap(new)' }[self.type]
-
-        def create(self, disk):
-            """Adds partition to the disk image (does not mkfs or anything like that)"""
-            logging.info('Adding type %d partition to disk image: %s' % (self.type, disk.filename))
-	    if self.begin == 0:
-		logging.info('Partition at beginning of disk - reserving first cylinder')
-		partition_start = "63s"
-	    else:
-	    	partition_start = self.begin
-            run_cmd('parted', '--script', '--', disk.filename, 'mkpart', 'primary', self.parted_fstype(), partition_start, self.end)
+            if self.begin == 0:
+                first = FIRST_TRACK_SECTORS
+            else:
+                first = self.begin * SECTORS_PER_MB
+            return (first, (self.end + 1) * SECTORS_PER_MB - 1)
 
         def mkfs(self):
             """Adds Filesystem object"""
             self.fs.mkfs()
 
+        def populate(self, srcdir):
+            """
+            Builds the partition's filesystem from the contents of srcdir in
+            a scratch image and writes it into the disk image at the
+            partition's offset. Needs neither loop devices nor mounts.
+            """
+            scratch = tmp_filename(tmp_root=os.path.dirname(os.path.abspath(self.disk.filename)))
+            fp = open(scratch, 'w')
+            fp.truncate(self.nbytes)
+            fp.close()
+            try:
+                self.fs.filename = scratch
+                self.fs.populate(srcdir)
+                copy_into(scratch, self.disk.filename, self.offset, sparse=not self.disk.preallocated)
+            finally:
+                self.fs.filename = self.filename
+                os.unlink(scratch)
+
         def get_grub_id(self):
             """The name of the partition as known by grub"""
             return '(hd%d,%d)' % (self.disk.get_index(), self.get_index())
@@ -336,7 +398,15 @@ class Filesystem(object):
         self.preallocated = False
         "Whether the file existed already (True if it did, False if we had to create it)."
 
+        self.uuid = None
+        "The UUID of the filesystem (known once it has been created)"
+
     def create(self):
+        self.create_image()
+        self.mkfs()
+
+    def create_image(self):
+        """Creates the (empty) image file, making up a filename if none was given"""
         logging.info('Creating filesystem: %s, size: %d, dummy: %s' % (self.mntpnt, self.size, repr(self.dummy)))
         if not os.path.exists(self.filename):
             logging.info('Not preallocated, so we create it.')
@@ -357,20 +427,58 @@ class Filesystem(object):
                 self.filename += '.img'
                 logging.info('A name wasn\'t specified either, so we make one up: %s' % self.filename)
             run_cmd(qemu_img_path(), 'create', '-f', 'raw', self.filename, '%dM' % self.size)
-        self.mkfs()
 
     def mkfs(self):
+        self.format()
+        self.read_uuid()
+
+    def format(self):
+        """
+        Runs mkfs on the filesystem. Where mkfs lets us choose the UUID,
+        we make one up (unless L{uuid} is set already) and pass it along.
+        """
         if not self.filename:
             raise VMBuilderException('We can\'t mkfs if filename is not set. Did you forget to call .create()?')
         if not self.dummy:
-            cmd = self.mkfs_fstype() + [self.filename]
+            cmd = self.mkfs_fstype()
+            if self.type != TYPE_XFS:
+                if not self.uuid:
+                    self.uuid = str(uuid.uuid4())
+                cmd += ['-U', self.uuid]
+            cmd += [self.filename]
+            start = time.time()
             run_cmd(*cmd)
-            # Let udev have a chance to extract the UUID for us
-            run_cmd('udevadm', 'settle')
-            if os.path.exists("/sbin/vol_id"):
-                self.uuid = run_cmd('vol_id', '--uuid', self.filename).rstrip()
-            elif os.path.exists("/sbin/blkid"):
-                self.uuid = run_cmd('blkid', '-c', '/dev/null', '-sUUID', '-ovalue', self.filename).rstrip()
+            logging.debug('mkfs of %s (%s) took %.1f seconds' % (self.filename, self.mntpnt, time.time() - start))
+
+    def read_uuid(self):
+        """
+        Sets L{uuid} to the UUID of the (formatted) filesystem, unless
+        we chose it ourselves in L{format}, in which case it is known already.
+        """
+        if not self.dummy and not self.uuid:
+            self.uuid = read_superblock_uuid(self.filename)
+
+    def populate(self, srcdir):
+        """
+        Creates the filesystem with the contents of srcdir already in it,
+        without mounting it (using mke2fs -d). Only ext2/3/4 and swap are
+        supported. The filesystem gets L{uuid} as its UUID.
+        """
+        if not self.filename:
+            raise VMBuilderException('We can\'t populate if filename is not set. Did you forget to call .create_image()?')
+        if self.dummy:
+            return
+        if self.type == TYPE_SWAP:
+            cmd = ['mkswap', '-U', self.uuid, self.filename]
+        elif self.type in [TYPE_EXT2, TYPE_EXT3, TYPE_EXT4]:
+            cmd = self.mkfs_fstype() + ['-U', self.uuid]
+            if srcdir:
+                logging.info('Populating %s filesystem from %s' % (self.mntpnt, srcdir))
+                cmd += ['-d', srcdir]
+            cmd += [self.filename]
+        else:
+            raise VMBuilderUserError('%s filesystems can not be populated directly' % self.fstab_fstype())
+        run_cmd(*cmd)
 
     def mkfs_fstype(self):
         map = { TYPE_EXT2: ['mkfs.ext2', '-F'], TYPE_EXT3: ['mkfs.ext3', '-F'], TYPE_EXT4: ['mkfs.ext4', '-F'], TYPE_XFS: ['mkfs.xfs'], TYPE_SWAP: ['mkswap'] }
@@ -430,6 +538,231 @@ class Filesystem(object):
         except ValueError:
             self.type = str_to_type(type)
 
+def chs(lba):
+    """
+    @rtype:  string
+    @return: the 3 byte CHS address of lba (255 heads, 63 sectors per
+             track), as stored in an MBR partition entry
+    """
+    (cylinder, rest) = divmod(lba, 255 * 63)
+    (head, sector) = divmod(rest, 63)
+    if cylinder > 1023:
+        (cylinder, head, sector) = (1023, 254, 62)
+    return pack('<BBB', head, (sector + 1) | ((cylinder >> 2) & 0xc0), cylinder & 0xff)
+
+def mbr_entry(parttype, first, last):
+    return pack('<B3sB3sII', 0, chs(first), parttype, chs(last), first, last - first + 1)
+
+def mbr_sector(entries):
+    """
+    @rtype:  string
+    @return: an MBR sector (with a random disk signature) holding entries
+    """
+    mbr = '\0' * 440 + os.urandom(4) + '\0\0'
+    mbr += ''.join(entries) + '\0' * 16 * (4 - len(entries))
+    return mbr + '\x55\xaa'
+
+def mbr_partition_table(layout):
+    """
+    @type  layout: list
+    @param layout: (partition, first sector, last sector) tuples
+    @rtype:  string
+    @return: the first sectors of a disk with an MBR describing layout.
+             Everything up to the first possible partition start is
+             cleared, wiping any GPT left behind by an earlier label.
+    """
+    if len(layout) > 4:
+        raise VMBuilderUserError('An MBR partition table can hold at most 4 partitions')
+    entries = [mbr_entry(MBR_PARTITION_TYPES[part.type], first, last) for (part, first, last) in layout]
+    return mbr_sector(entries) + '\0' * (FIRST_TRACK_SECTORS - 1) * SECTOR_SIZE
+
+def gpt_header(current, backup, entries_lba, sectors, disk_guid, entries_crc):
+    header = pack('<8sIIIIQQQQ16sQIII', 'EFI PART', 0x10000, GPT_HEADER_SIZE, 0, 0,
+                  current, backup, 2 + GPT_ENTRIES_SECTORS, sectors - GPT_ENTRIES_SECTORS - 2,
+                  disk_guid, entries_lba, GPT_ENTRIES, GPT_ENTRY_SIZE, entries_crc)
+    crc = zlib.crc32(header) & 0xffffffff
+    header = header[:16] + pack('<I', crc) + header[20:]
+    return header + '\0' * (SECTOR_SIZE - GPT_HEADER_SIZE)
+
+def gpt_partition_table(layout, sectors):
+    """
+    @type  layout: list
+    @param layout: (partition, first sector, last sector) tuples
+    @type  sectors: number
+    @param sectors: size of the disk in sectors
+    @rtype:  tuple
+    @return: the protective MBR, primary GPT header and entries (to go
+             at the start of the disk), and the backup entries and header
+             (to go at the end of the disk)
+    """
+    if len(layout) > GPT_ENTRIES:
+        raise VMBuilderUserError('A GPT partition table can hold at most %d partitions' % GPT_ENTRIES)
+    entries = ''
+    for (part, first, last) in layout:
+        entries += pack('<16s16sQQQ72s', GPT_PARTITION_TYPES[part.type].bytes_le, uuid.uuid4().bytes_le,
+                        first, last, 0, 'primary'.encode('utf-16-le'))
+    entries += '\0' * (GPT_ENTRIES * GPT_ENTRY_SIZE - len(entries))
+    entries_crc = zlib.crc32(entries) & 0xffffffff
+    disk_guid = uuid.uuid4().bytes_le
+
+    protective = mbr_sector([mbr_entry(MBR_PROTECTIVE_TYPE, 1, min(sectors - 1, MBR_MAX_SECTORS))])
+    primary = protective + gpt_header(1, sectors - 1, 2, sectors, disk_guid, entries_crc) + entries
+    backup = entries + gpt_header(sectors - 1, 1, sectors - GPT_ENTRIES_SECTORS - 1, sectors, disk_guid, entries_crc)
+    return (primary, backup)
+
+def wait_for(condition, timeout=30, first_delay=0.01, max_delay=1):
+    """
+    Polls condition with exponentially growing delays until it returns
+    True or timeout seconds have passed.
+
+    @rtype:  boolean
+    @return: whether condition became True in time
+    """
+    deadline = time.time() + timeout
+    delay = first_delay
+    while not condition():
+        if time.time() >= deadline:
+            return False
+        time.sleep(min(delay, max(deadline - time.time(), 0)))
+        delay = min(delay * 2, max_delay)
+    return True
+
+def loop_device_attached(loopdev):
+    """
+    @rtype:  boolean
+    @return: whether loopdev still has a backing file
+    """
+    return os.path.exists('/sys/block/%s/loop/backing_file' % os.path.basename(loopdev))
+
+def detach_loop_device(loopdev, ignore_fail=False):
+    """
+    Detaches loopdev and waits until the kernel has released it. A
+    device that has only just been unmounted can still be busy for a
+    moment, so failed attempts are retried (with growing delays) rather
+    than after a fixed sleep.
+    """
+    def detach():
+        if not loop_device_attached(loopdev):
+            return True
+        run_cmd('losetup', '-d', loopdev, ignore_fail=True)
+        return not loop_device_attached(loopdev)
+
+    if not wait_for(detach):
+        msg = 'Could not detach %s' % loopdev
+        if not ignore_fail:
+            raise VMBuilderException(msg)
+        logging.warning(msg)
+
+# (offset, magic, offset of the UUID) of the superblocks we know about
+EXT_SUPERBLOCK = (1024 + 0x38, '\x53\xef', 1024 + 0x68)
+XFS_SUPERBLOCK = (0, 'XFSB', 32)
+SWAP_UUID_OFFSET = 1024 + 12
+SWAP_MAGIC = 'SWAPSPACE2'
+
+def read_superblock_uuid(filename):
+    """
+    Reads the UUID straight from the superblock of the ext2/3/4, xfs or
+    swap filesystem in filename (a file or block device).
+
+    @rtype:  string
+    @return: the UUID, formatted the way blkid does
+    """
+    fp = open(filename, 'rb')
+    try:
+        head = fp.read(65536)
+    finally:
+        fp.close()
+
+    for (offset, magic, uuid_offset) in [EXT_SUPERBLOCK, XFS_SUPERBLOCK]:
+        if head[offset:offset+len(magic)] == magic:
+            return str(uuid.UUID(bytes=head[uuid_offset:uuid_offset+16]))
+
+    # The swap signature sits at the end of the first page, and mkswap
+    # uses the page size of the host it ran on.
+    for pagesize in [4096, 8192, 16384, 65536]:
+        if head[pagesize-len(SWAP_MAGIC):pagesize] == SWAP_MAGIC:
+            return str(uuid.UUID(bytes=head[SWAP_UUID_OFFSET:SWAP_UUID_OFFSET+16]))
+
+    raise VMBuilderException('Could not find a known filesystem superblock in %s' % filename)
+
+def read_mbr_partitions(filename):
+    """
+    @rtype:  list
+    @return: (start sector, number of sectors) tuples for the used
+             primary partitions in the MBR of filename, ordered by start
+    """
+    fp = open(filename, 'rb')
+    try:
+        mbr = fp.read(SECTOR_SIZE)
+    finally:
+        fp.close()
+    if len(mbr) != SECTOR_SIZE or mbr[510:512] != '\x55\xaa':
+        raise VMBuilderException('%s does not contain an MBR partition table' % filename)
+    entries = []
+    for i in range(4):
+        (parttype, start, count) = unpack('<4xB3xII', mbr[446 + 16*i:446 + 16*(i+1)])
+        if parttype != 0:
+            entries.append((start, count))
+    entries.sort()
+    return entries
+
+def read_partitions(filename):
+    """
+    Like L{read_mbr_partitions}, but for a disk with a protective MBR
+    (as L{Disk.partition} writes for disks of 2TB and larger), the
+    partitions in its GPT.
+
+    @rtype:  list
+    @return: (start sector, number of sectors) tuples for the used
+             partitions of filename, ordered by start
+    """
+    entries = read_mbr_partitions(filename)
+    fp = open(filename, 'rb')
+    try:
+        mbr = fp.read(SECTOR_SIZE)
+        if ord(mbr[446 + 4]) != MBR_PROTECTIVE_TYPE:
+            return entries
+        header = fp.read(SECTOR_SIZE)
+        if header[:8] != 'EFI PART':
+            raise VMBuilderException('%s has a protective MBR, but no GPT' % filename)
+        (entries_lba, count, size) = unpack('<QII', header[72:88])
+        fp.seek(entries_lba * SECTOR_SIZE)
+        table = fp.read(count * size)
+    finally:
+        fp.close()
+    entries = []
+    for i in range(len(table) / size):
+        (parttype, first, last) = unpack('<16s16xQQ', table[i*size:i*size + 48])
+        if parttype != '\0' * 16:
+            entries.append((first, last - first + 1))
+    entries.sort()
+    return entries
+
+def copy_into(src, dest, offset, sparse=True):
+    """
+    Writes the contents of the file src into the file (or block device)
+    dest, starting at byte offset. If sparse is True, all-zero blocks are
+    skipped rather than written, which is only correct if dest is known
+    to contain zeros there (e.g. a freshly created sparse image).
+    """
+    blocksize = 1024*1024
+    zeros = '\0' * blocksize
+    infp = open(src, 'rb')
+    outfp = open(dest, 'r+b')
+    try:
+        pos = offset
+        while True:
+            data = infp.read(blocksize)
+            if not data:
+                break
+            if not (sparse and data == zeros[:len(data)]):
+                outfp.seek(pos)
+                outfp.write(data)
+            pos += len(data)
+    finally:
+        infp.close()
+        outfp.close()
+
 def parse_size(size_str):
     """Takes a size like qemu-img would accept it and returns the size in MB"""
     try:
@@ -486,6 +819,74 @@ def create_partitions(vm):
     for disk in vm.disks:
         disk.create(vm.workdir)
 
+def convert_image(filename, destfile, format, engine='qemu-img', punch_holes=False):
+    """
+    Converts the raw image filename to destfile in the given format
+    (as understood by qemu-img or vdi) and removes filename.
+
+    @type  engine: string
+    @param engine: 'native' to write qcow2 images with L{VMBuilder.qcow2}
+    """
+    logging.info('Converting %s to %s, format %s' % (filename, format, destfile))
+    if format == 'vdi':
+        run_cmd(vbox_manager_path(), 'convertfromraw', '-format', 'VDI', filename, destfile, capture=False)
+    elif format == 'qcow2' and engine == 'native':
+        VMBuilder.qcow2.convert(filename, destfile, punch_holes=punch_holes)
+    else:
+        run_cmd(qemu_img_path(), 'convert', '-O', format, filename, destfile, capture=False)
+    os.unlink(filename)
+
+def convert_worker(task):
+    """Runs L{convert_image} in a L{convert_disks} worker process"""
+    (index, args) = task
+    convert_image(*args)
+    return index
+
+def convert_disks(disks, destdir, format, jobs):
+    """
+    Converts disks like L{Disk.convert} does, running up to jobs
+    conversions at a time in separate processes. If one of them fails,
+    the others are stopped and its exception is raised.
+
+    @rtype:  list
+    @return: the names of the converted images, in the order of disks
+    """
+    tasks = []
+    for (index, disk) in enumerate(disks):
+        if not disk.preallocated:
+            destfile = disk.converted_filename(destdir, format)
+            tasks.append((index, disk.convert_args(destfile, format)))
+    if jobs <= 1 or len(tasks) <= 1:
+        return [disk.convert(destdir, format) for disk in disks]
+
+    logging.info('Converting %d disk images, up to %d at a time' % (len(tasks), jobs))
+    pool = multiprocessing.Pool(min(jobs, len(tasks)))
+    try:
+        for index in pool.imap_unordered(convert_worker, tasks):
+            logging.debug('Finished converting %s' % disks[index].filename)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    imgs = [disk.filename for disk in disks]
+    for (index, args) in tasks:
+        imgs[index] = args[1]
+        disks[index].set_converted(args[1], format)
+    return imgs
+
+def mkfs_all(filesystems, jobs):
+    """
+    Formats filesystems, running up to jobs mkfs processes at a time,
+    and then finds out the UUIDs that weren't chosen up front.
+    """
+    logging.info('Creating file systems')
+    run_parallel([fs.format for fs in filesystems], jobs)
+    for fs in filesystems:
+        fs.read_uuid()
+
 def get_ordered_filesystems(vm):
     """Returns filesystems (self hosted as well as contained in partitions
     in an order suitable for mounting them"""
@@ -18,12 +18,38 @@
 #
 #    Distro super class
 
+import glob
 import logging
 import os
+import shutil
+import time
+import uuid
 
 from   VMBuilder.util    import run_cmd, call_hooks
 import VMBuilder.plugins
 
+# Where to look for libeatmydata on the host, in order of preference
+EATMYDATA_PATHS = ['/usr/lib/libeatmydata/libeatmydata.so',
+                   '/usr/lib/*/libeatmydata.so',
+                   '/usr/lib/libeatmydata.so',
+                   '/usr/lib64/libeatmydata.so']
+
+# Files holding a machine's unique id (dbus's, and systemd's)
+MACHINE_ID_FILES = ['/var/lib/dbus/machine-id', '/etc/machine-id']
+
+DPKG_UNSAFE_IO_CONF = '/etc/dpkg/dpkg.cfg.d/vmbuilder-unsafe-io'
+
+def find_eatmydata():
+    """
+    @rtype:  string
+    @return: the path of libeatmydata on the host, or None if it isn't installed
+    """
+    for pattern in EATMYDATA_PATHS:
+        matches = sorted(glob.glob(pattern))
+        if matches:
+            return matches[0]
+    return None
+
 class Context(VMBuilder.plugins.Plugin):
     def __init__(self):
         self._config = {}
@@ -36,6 +62,10 @@ class Context(VMBuilder.plugins.Plugin):
                               os.path.dirname(__file__) + '/plugins/%s/templates',
                               '/etc/vmbuilder/%s']
         self.overwrite = False
+        # Skip fsync() while installing, see Distro.enable_unsafe_io
+        self.unsafe_io = False
+        # Extra environment for commands run in (or populating) the chroot
+        self.cmd_env = {}
 
     # Cleanup 
     def cleanup(self):
@@ -71,19 +101,157 @@ class Context(VMBuilder.plugins.Plugin):
 
 class Distro(Context):
     def __init__(self):
+        VMBuilder.plugins.load_registered('distro_plugin')
         self.plugin_classes = VMBuilder._distro_plugins
         super(Distro, self).__init__()
+        self.bootstrap_restored = False
+        # Files put in the chroot by enable_unsafe_io
+        self.unsafe_io_files = []
+        self.unsafe_io_start = None
+        # Set while the caching proxy plugin's proxy runs
+        self.build_proxy = None
+        # A VMBuilder.checkpoint.Checkpoints, if the build keeps checkpoints
+        self.checkpoints = None
 
     def set_chroot_dir(self, chroot_dir):
         self.chroot_dir = chroot_dir 
 
     def build_chroot(self):
+        self.check_settings()
+        self.populate_chroot()
+
+    def check_settings(self):
         self.call_hooks('preflight_check')
         self.call_hooks('set_defaults')
-        self.call_hooks('bootstrap')
-        self.call_hooks('configure_os')
+
+    def populate_chroot(self):
+        """
+        Bootstraps and configures the chroot. Call L{check_settings} first.
+        """
+        # Plugins (e.g. the bootstrap cache) may populate the chroot
+        # here, in which case we skip the bootstrap step.
+        if self.unsafe_io:
+            self.enable_unsafe_io()
+        self.call_hooks('start_caching_proxy')
+        # When resuming, continue after the last checkpointed stage
+        resumed = self.checkpoints and self.checkpoints.restore_chroot(self.chroot_dir)
+        if not resumed:
+            self.call_hooks('restore_bootstrap')
+            if not self.bootstrap_restored:
+                self.call_hooks('bootstrap')
+                self.call_hooks('store_bootstrap')
+            self.save_checkpoint('bootstrap')
+        if self.unsafe_io:
+            self.enable_dpkg_unsafe_io()
+        if resumed != 'chroot':
+            self.call_hooks('configure_os')
+            self.save_checkpoint('chroot')
 	self.cleanup()
+
+    def save_checkpoint(self, stage):
+        """
+        Snapshots the chroot as the result of stage, if the build keeps
+        checkpoints.
+        """
+        if self.checkpoints:
+            self.checkpoints.save_chroot(stage, self.chroot_dir, excludes=self.unsafe_io_files)
         
+    def get_build_proxy(self):
+        """
+        @rtype:  string
+        @return: The HTTP proxy to download through during the build: the
+                 caching proxy while it runs, else the proxy setting
+        """
+        if self.build_proxy:
+            return self.build_proxy
+        if self.has_setting('proxy'):
+            return self.get_setting('proxy')
+        return None
+
+    def enable_unsafe_io(self):
+        """
+        Turn fsync() and friends into no-ops for the bootstrap tool and
+        everything run in the chroot by preloading libeatmydata. Nothing
+        is lost unless the host crashes: the build ends with a single
+        sync (see L{disable_unsafe_io}) instead of one per package.
+        """
+        lib = find_eatmydata()
+        if not lib:
+            logging.warning('libeatmydata not found (install eatmydata), '
+                            'only dpkg will skip fsync()')
+            return
+        # The bootstrap tool runs both on the host and in the chroot,
+        # so the library has to be at the same path in both places.
+        target = '%s%s' % (self.chroot_dir, lib)
+        if not os.path.exists(target):
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            shutil.copy(lib, target)
+            self.unsafe_io_files.append(lib)
+        self.cmd_env['LD_PRELOAD'] = lib
+        self.unsafe_io_start = time.time()
+
+    def enable_dpkg_unsafe_io(self):
+        """
+        Tell dpkg to skip its own syncs, if it is new enough to know how.
+        This also covers chroots libeatmydata can't be preloaded into.
+        """
+        if not os.path.exists('%s/usr/bin/dpkg' % self.chroot_dir):
+            return
+        if 'unsafe-io' not in self.run_in_target('dpkg', '--force-help', ignore_fail=True):
+            logging.debug('dpkg in the chroot does not support --force-unsafe-io')
+            return
+        self.install_file(DPKG_UNSAFE_IO_CONF, 'force-unsafe-io\n')
+        self.unsafe_io_files.append(DPKG_UNSAFE_IO_CONF)
+        if self.unsafe_io_start is None:
+            self.unsafe_io_start = time.time()
+
+    def disable_unsafe_io(self):
+        """
+        Remove what L{enable_unsafe_io} put in the chroot and go back to
+        normal I/O.
+
+        @rtype:  number
+        @return: the number of seconds spent with unsafe I/O enabled
+        """
+        for path in self.unsafe_io_files:
+            fullpath = '%s%s' % (self.chroot_dir, path)
+            if os.path.exists(fullpath):
+                os.unlink(fullpath)
+        self.unsafe_io_files = []
+        self.cmd_env.pop('LD_PRELOAD', None)
+        if self.unsafe_io_start is None:
+            return 0
+        elapsed = time.time() - self.unsafe_io_start
+        self.unsafe_io_start = None
+        return elapsed
+
+    def reset_machine_identity(self):
+        """
+        Gives a copy of a chroot or image an identity of its own: new
+        ssh host keys (of the types it had) and new machine ids. Copies
+        that shared them could not be told apart by ssh clients, making
+        it easy to impersonate one of them.
+        """
+        for key in glob.glob('%s/etc/ssh/ssh_host_*key' % self.chroot_dir):
+            name = os.path.basename(key)
+            if name == 'ssh_host_key':
+                keytype = 'rsa1'
+            else:
+                keytype = name[len('ssh_host_'):-len('_key')]
+            os.unlink(key)
+            if os.path.exists('%s.pub' % key):
+                os.unlink('%s.pub' % key)
+            logging.debug('Generating a new %s ssh host key' % keytype)
+            self.run_in_target('ssh-keygen', '-q', '-N', '', '-t', keytype, '-f', '/etc/ssh/%s' % name)
+
+        for path in MACHINE_ID_FILES:
+            fullpath = '%s%s' % (self.chroot_dir, path)
+            if os.path.exists(fullpath) and not os.path.islink(fullpath):
+                fp = open(fullpath, 'w')
+                fp.write('%s\n' % uuid.uuid4().hex)
+                fp.close()
+
     def has_xen_support(self):
         """Install the distro into destdir"""
         raise NotImplemented('Distro subclasses need to implement the has_xen_support method')
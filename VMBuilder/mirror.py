@@ -0,0 +1,170 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Picking the fastest of several mirrors
+import httplib
+import json
+import logging
+import os
+import os.path
+import socket
+import tempfile
+import time
+import urllib2
+from   VMBuilder.cache     import cache_key
+from   VMBuilder.exception import VMBuilderUserError
+from   VMBuilder.util      import run_parallel
+
+# How long a probe may take (in seconds), connecting and reading included
+PROBE_TIMEOUT = 5
+# How much of the probed file to read to measure throughput
+PROBE_BYTES = 256 * 1024
+# Mirrors are ranked by the estimated time to fetch a file of this size
+SCORE_BYTES = 1024 * 1024
+# How long a ranking stays valid (in seconds)
+DEFAULT_TTL = 3600
+
+def probe(url, timeout=PROBE_TIMEOUT, max_bytes=PROBE_BYTES):
+    """
+    Fetches (the first max_bytes of) url.
+
+    @rtype:  tuple
+    @return: (seconds to the first byte, bytes per second after it), or
+             None if url could not be fetched
+    """
+    start = time.time()
+    try:
+        fp = urllib2.urlopen(url, timeout=timeout)
+        try:
+            received = len(fp.read(1))
+            first_byte = time.time()
+            while received < max_bytes and time.time() - start < timeout:
+                data = fp.read(min(64 * 1024, max_bytes - received))
+                if not data:
+                    break
+                received += len(data)
+        finally:
+            fp.close()
+    except (IOError, socket.error, httplib.HTTPException), e:
+        logging.debug('Probing %s failed: %s' % (url, e))
+        return None
+    end = time.time()
+    return (first_byte - start, received / max(end - first_byte, 0.001))
+
+def score(ttfb, throughput):
+    """
+    @rtype:  number
+    @return: the estimated time (in seconds) to fetch L{SCORE_BYTES}
+             from a mirror with the given probe results. Lower is better.
+    """
+    return ttfb + SCORE_BYTES / throughput
+
+def rank_mirrors(candidates, path, timeout=PROBE_TIMEOUT):
+    """
+    Probes path on each of the candidate mirrors, all at once.
+
+    @type  candidates: list
+    @param candidates: Base URLs of the mirrors
+    @type  path: string
+    @param path: A small file every mirror has (e.g. an index file),
+                 relative to the base URL
+    @rtype:  list
+    @return: (score, mirror) tuples of the mirrors that could be reached,
+             best first
+    """
+    def prober(mirror):
+        return lambda: probe('%s/%s' % (mirror.rstrip('/'), path.lstrip('/')), timeout)
+
+    results = run_parallel([prober(mirror) for mirror in candidates], len(candidates))
+    ranking = []
+    for (mirror, result) in zip(candidates, results):
+        if result is None:
+            logging.info('Mirror %s could not be reached' % mirror)
+            continue
+        (ttfb, throughput) = result
+        logging.debug('Mirror %s: %.3f seconds to first byte, %d bytes/second' % (mirror, ttfb, throughput))
+        ranking.append((score(ttfb, throughput), mirror))
+    ranking.sort()
+    return ranking
+
+class RankingCache(object):
+    """
+    Remembers mirror rankings on disk, so builds started shortly after
+    each other don't all probe the mirrors.
+
+    @type  directory: string
+    @param directory: Directory holding the rankings (created if needed)
+    @type  ttl: number
+    @param ttl: How long a ranking stays valid (in seconds)
+    """
+    def __init__(self, directory, ttl=DEFAULT_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def path(self, candidates, path):
+        return '%s/%s.json' % (self.directory, cache_key(sorted(candidates), path))
+
+    def lookup(self, candidates, path):
+        """
+        @rtype:  list
+        @return: the ranking of candidates (see L{rank_mirrors}), or None
+                 if there is no valid one
+        """
+        try:
+            fp = open(self.path(candidates, path))
+            try:
+                entry = json.load(fp)
+            finally:
+                fp.close()
+        except (IOError, ValueError):
+            return None
+        if not 0 <= time.time() - entry['time'] < self.ttl:
+            return None
+        return [tuple(item) for item in entry['ranking']]
+
+    def store(self, candidates, path, ranking):
+        (fd, tmpname) = tempfile.mkstemp(prefix='.tmp', dir=self.directory)
+        fp = os.fdopen(fd, 'w')
+        try:
+            json.dump({ 'time' : time.time(), 'ranking' : ranking }, fp)
+        finally:
+            fp.close()
+        os.rename(tmpname, self.path(candidates, path))
+
+def select_mirror(candidates, path, cache=None, timeout=PROBE_TIMEOUT):
+    """
+    Picks the best of the candidate mirrors (see L{rank_mirrors}).
+
+    @type  cache: L{RankingCache}
+    @param cache: Where to look up and store the ranking (optional)
+    @rtype:  string
+    @return: the best mirror's base URL
+    """
+    ranking = cache and cache.lookup(candidates, path)
+    if ranking:
+        logging.debug('Using cached mirror ranking')
+    else:
+        ranking = rank_mirrors(candidates, path, timeout)
+        if not ranking:
+            raise VMBuilderUserError('None of the mirrors could be reached: %s' % ' '.join(candidates))
+        if cache:
+            cache.store(candidates, path, ranking)
+    logging.info('Using mirror %s' % ranking[0][1])
+    return ranking[0][1]
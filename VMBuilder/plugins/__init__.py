@@ -16,17 +16,102 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import logging
 import os
 import re
 import shutil
+import sys
 
 import VMBuilder
 import VMBuilder.util as util
 from VMBuilder.exception import VMBuilderException
 
+INDEX_HEADER = '''#
+#    Generated by VMBuilder.plugins.write_plugin_index(). Do not edit.
+#
+#    Maps each plugin package to what it registers when imported:
+#    (kind, name) tuples, where kind is 'distro' or 'hypervisor' (and
+#    name is the registered class's .arg) or 'distro_plugin' or
+#    'hypervisor_plugin' (and name is the plugin class's name).
+#
+'''
+
 def load_plugins():
+    """
+    Imports the plugins that aren't listed in the plugin index
+    (L{VMBuilder.plugins.index}). Indexed plugins are imported when
+    they are needed, by L{load_registered}.
+    """
+    from VMBuilder.plugins.index import PLUGIN_INDEX
     for plugin in find_plugins():
-        exec "import %s" % plugin
+        if plugin not in PLUGIN_INDEX:
+            exec "import %s" % plugin
+
+def load_registered(kind, name=None):
+    """
+    Imports the indexed plugins that register a kind (see INDEX_HEADER)
+    named name (or any name).
+    """
+    from VMBuilder.plugins.index import PLUGIN_INDEX
+    for plugin in sorted(PLUGIN_INDEX.keys()):
+        if plugin in sys.modules:
+            continue
+        for (k, n) in PLUGIN_INDEX[plugin]:
+            if k == kind and (name is None or n == name):
+                logging.debug('Loading plugin %s' % plugin)
+                __import__(plugin)
+                break
+
+def indexed_names(kind):
+    """
+    @rtype:  list
+    @return: The names of the indexed plugins' registrations of the given kind
+    """
+    from VMBuilder.plugins.index import PLUGIN_INDEX
+    return [n for registrations in PLUGIN_INDEX.values() for (k, n) in registrations if k == kind]
+
+def generate_plugin_index():
+    """
+    Imports all plugins and finds out what each of them registers.
+
+    @rtype:  dict
+    @return: The plugin index (see INDEX_HEADER)
+    """
+    index = {}
+    for plugin in find_plugins():
+        __import__(plugin)
+        index[plugin] = []
+
+    def add(kind, name, cls):
+        plugin = '.'.join(cls.__module__.split('.')[:3])
+        if plugin in index:
+            index[plugin].append((kind, name))
+
+    for (kind, registry) in [('distro', VMBuilder.distros), ('hypervisor', VMBuilder.hypervisors)]:
+        for (name, cls) in registry.items():
+            add(kind, name, cls)
+    for (kind, registry) in [('distro_plugin', VMBuilder._distro_plugins), ('hypervisor_plugin', VMBuilder._hypervisor_plugins)]:
+        for cls in registry:
+            add(kind, cls.__name__, cls)
+    for registrations in index.values():
+        registrations.sort()
+    return index
+
+def write_plugin_index(filename='%s/index.py' % os.path.dirname(__file__)):
+    """
+    Regenerates the plugin index. Run this after adding a plugin or
+    changing what a plugin registers.
+    """
+    index = generate_plugin_index()
+    fp = open(filename, 'w')
+    try:
+        fp.write(INDEX_HEADER)
+        fp.write('PLUGIN_INDEX = {\n')
+        for plugin in sorted(index.keys()):
+            fp.write('    %r : %r,\n' % (plugin, index[plugin]))
+        fp.write('}\n')
+    finally:
+        fp.close()
 
 def find_plugins():
     retval = []
@@ -83,8 +168,24 @@ class Plugin(object):
         return self.install_file(path, VMBuilder.util.render_template(self.__module__.split('.')[2], self.context, tmplname, context), mode=mode)
 
     def run_in_target(self, *args, **kwargs):
+        cmd_env = getattr(self.context, 'cmd_env', None)
+        if cmd_env:
+            env = dict(cmd_env)
+            env.update(kwargs.get('env', {}))
+            kwargs['env'] = env
         return util.run_cmd('chroot', self.chroot_dir, *args, **kwargs)
 
+    def run_batch_in_target(self, commands):
+        """
+        Runs several commands in the chroot, launching chroot only once.
+        See L{VMBuilder.util.ChrootSession.run_batch}.
+        """
+        session = util.ChrootSession(self.chroot_dir, env=getattr(self.context, 'cmd_env', {}))
+        try:
+            return session.run_batch(commands)
+        finally:
+            session.close()
+
     def call_hooks(self, *args, **kwargs):
         return util.call_hooks(self.context, *args, **kwargs)
 
@@ -165,7 +266,7 @@ class Plugin(object):
             if self.value_set:
                 return self.value
             else:
-                return self.default
+                return self.get_default()
 
         def do_check_value(self, value):
             """
@@ -174,6 +275,7 @@ class Plugin(object):
             if self.valid_options is not None:
                 if value not in self.valid_options:
                     raise VMBuilderException('%r is not a valid option for %s. Valid options are: %s' % (value, self.name, ' '.join(self.valid_options)))
+                return value
             else:
                 return self.check_value(value)
 
@@ -193,10 +295,21 @@ class Plugin(object):
 
         def get_default(self):
             """
-            Return the default value.
+            Return the default value. A L{util.LazyDefault} is computed
+            now, and replaced by its value.
             """
+            if self.has_lazy_default():
+                self.default = self.default.func()
             return self.default
 
+        def has_lazy_default(self):
+            """
+            @rtype:  bool
+            @return: Whether the default is a L{util.LazyDefault} that
+                     hasn't been computed yet
+            """
+            return isinstance(self.default, util.LazyDefault)
+
         def set_default(self, value):
             """
             Set a new default value.
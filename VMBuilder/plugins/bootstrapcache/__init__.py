@@ -0,0 +1,88 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from   VMBuilder       import register_distro_plugin, Plugin
+from   VMBuilder.cache import Cache, cache_key
+from   VMBuilder.util  import run_cmd
+
+import logging
+import os
+
+class BootstrapCache(Plugin):
+    """
+    Plugin to reuse snapshots of freshly bootstrapped chroots across builds
+    """
+    name = 'Bootstrap cache plugin'
+
+    # The settings that determine what the bootstrap step produces
+    key_settings = ['suite', 'arch', 'variant', 'mirror', 'install-mirror', 'components', 'iso']
+
+    def register_options(self):
+        group = self.setting_group('Bootstrap cache')
+        group.add_setting('bootstrap-cache', metavar='DIR', help='Keep snapshots of bootstrapped chroots in DIR and restore them instead of bootstrapping again when the distro, suite, arch, variant, mirror and components match.')
+        group.add_setting('bootstrap-cache-size', type='int', metavar='SIZE', default=4096, help='Maximum size (in MB) of the bootstrap cache. Least recently used snapshots are evicted first. [default: %default]')
+
+    def get_cache(self):
+        directory = self.context.get_setting('bootstrap-cache')
+        if not directory:
+            return None
+        return Cache(directory, self.context.get_setting('bootstrap-cache-size'))
+
+    def get_key(self):
+        parts = [self.context.arg]
+        for name in self.key_settings:
+            if self.context.has_setting(name):
+                parts.append((name, self.context.get_setting(name)))
+        return cache_key(*parts)
+
+    def restore_bootstrap(self):
+        cache = self.get_cache()
+        if not cache:
+            return
+
+        key = self.get_key()
+        lock = cache.lock(exclusive=False)
+        try:
+            snapshot = cache.lookup(key)
+            if not snapshot:
+                logging.info('No cached bootstrap found (key: %s)' % key)
+                return
+            logging.info('Restoring bootstrapped chroot from cache (key: %s)' % key)
+            run_cmd('tar', '--numeric-owner', '-xpf', snapshot, '-C', self.context.chroot_dir)
+        finally:
+            lock.release()
+        self.context.bootstrap_restored = True
+
+    def store_bootstrap(self):
+        cache = self.get_cache()
+        if not cache:
+            return
+
+        key = self.get_key()
+        logging.info('Storing bootstrapped chroot in cache (key: %s)' % key)
+        snapshot = cache.tmp_filename('.tar')
+        try:
+            # Leave out what --unsafe-io put in the chroot
+            excludes = ['--exclude=.%s' % path for path in self.context.unsafe_io_files]
+            run_cmd('tar', '--numeric-owner', '--one-file-system', *(excludes + ['-cpf', snapshot, '-C', self.context.chroot_dir, '.']))
+            cache.insert(key, snapshot)
+        finally:
+            if os.path.exists(snapshot):
+                os.unlink(snapshot)
+
+register_distro_plugin(BootstrapCache)
@@ -0,0 +1,66 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from   VMBuilder       import register_distro_plugin, Plugin
+from   VMBuilder.proxy import CachingProxy, ContentStore
+
+import os
+
+class CachingProxyPlugin(Plugin):
+    """
+    Plugin to run a caching HTTP proxy for the package downloads of the
+    build, keeping packages and repository metadata on the host for
+    later builds
+    """
+    name = 'Caching proxy plugin'
+
+    proxy = None
+
+    def register_options(self):
+        group = self.setting_group('Caching proxy')
+        group.add_setting('caching-proxy', metavar='DIR', help='Download packages through a caching proxy run by vmbuilder, which keeps them (and repository metadata) in DIR for later builds. Downloads go through --proxy, if given.')
+        group.add_setting('caching-proxy-size', type='int', metavar='SIZE', default=4096, help='Maximum size (in MB) of the caching proxy\'s store. Least recently used files are evicted first. [default: %default]')
+
+    def start_caching_proxy(self):
+        """
+        Starts the proxy and makes it the distro's build proxy (see
+        L{VMBuilder.distro.Distro.get_build_proxy}).
+        """
+        directory = self.context.get_setting('caching-proxy')
+        if not directory or self.proxy:
+            return
+        upstream = self.context.has_setting('proxy') and self.context.get_setting('proxy') or None
+        store = ContentStore(os.path.join(directory, self.context.arg), self.context.get_setting('caching-proxy-size'))
+        self.proxy = CachingProxy(store, upstream)
+        self.proxy.start()
+        self.context.build_proxy = self.proxy.url
+        self.context.add_clean_cb(self.stop_caching_proxy)
+
+    def stop_caching_proxy(self):
+        """
+        Stops the proxy. The distro writes its final package manager
+        config after this, without it.
+        """
+        if not self.proxy:
+            return
+        self.context.cancel_cleanup(self.stop_caching_proxy)
+        self.proxy.stop()
+        self.proxy = None
+        self.context.build_proxy = None
+
+register_distro_plugin(CachingProxyPlugin)
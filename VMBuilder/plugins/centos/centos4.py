@@ -25,8 +25,11 @@ import socket
 import tempfile
 import VMBuilder
 import VMBuilder.disk as disk
+from   VMBuilder.exception import VMBuilderException
 from   VMBuilder.util import run_cmd
 
+DEFAULT_MIRROR = 'http://mirror.bytemark.co.uk/centos'
+
 class Centos4(suite.Suite):
     grubroot = "/usr/share/grub"
     # FIXME: do we need i586 kernel support?
@@ -58,6 +61,8 @@ mirror.amd64 = %s/4/os/x86_64/CentOS/RPMS/
     def install(self, destdir):
         self.destdir = destdir
 
+        self.vm.call_hooks('start_caching_proxy')
+
         logging.debug("Launching Rinse")
         self.rinse()
 
@@ -72,8 +77,9 @@ mirror.amd64 = %s/4/os/x86_64/CentOS/RPMS/
         logging.debug("Setting up Yum proxy")
         self.install_yum_proxy()
 
-        logging.debug("Installing core packages")
-        self.install_core()
+        logging.debug("Mounting package cache")
+        self.install_yum_keepcache(True)
+        self.vm.call_hooks('mount_package_cache', '/var/cache/yum', '.rpm')
 
         logging.debug("Installing fstab")
         self.install_fstab()
@@ -81,6 +87,9 @@ mirror.amd64 = %s/4/os/x86_64/CentOS/RPMS/
         logging.debug("Creating devices")
         self.create_devices()
 
+        logging.debug("Installing packages")
+        self.install_packages()
+
         if self.vm.hypervisor.needs_bootloader:
             logging.debug("Installing grub")
             self.install_grub()
@@ -101,10 +110,6 @@ mirror.amd64 = %s/4/os/x86_64/CentOS/RPMS/
             logging.debug("Updating initrd")
             self.update_initrd()
 
-
-        logging.debug("Installing extra packages")
-        self.install_extras()
-
         logging.debug("Creating initial user")
         self.create_initial_user()
 
@@ -120,7 +125,15 @@ mirror.amd64 = %s/4/os/x86_64/CentOS/RPMS/
         logging.debug("Setting up final Yum config")
         self.install_yum_conf(final=True)
 
-        logging.debug("cleaning apt")
+        logging.debug("Unmounting package cache")
+        self.vm.call_hooks('unmount_package_cache')
+        self.install_yum_keepcache(False)
+
+        logging.debug("Setting up final Yum proxy")
+        self.vm.call_hooks('stop_caching_proxy')
+        self.install_yum_proxy(final=True)
+
+        logging.debug("cleaning yum")
         self.run_in_target('yum', 'clean', 'all');
 
         logging.debug("Force SELinux autorelabel")
@@ -205,18 +218,6 @@ mirror.amd64 = %s/4/os/x86_64/CentOS/RPMS/
         # FIXME: missing static ip configuration in template
         self.install_from_template('/etc/sysconfig/network-scripts/ifcfg-eth0', 'ifcfg-eth0')
 
-    def install_extras(self):
-        if not self.vm.addpkg and not self.vm.removepkg:
-            return
-
-        cmd = ['yum', '-y', 'remove']
-        cmd += self.vm.removepkg or []
-        self.run_in_target(*cmd)
-
-        cmd = ['yum', '-y', 'install']
-        cmd += self.vm.addpkg or []
-        self.run_in_target(*cmd)
-        
     def unmount_volatile(self):
         for mntpnt in glob.glob('%s/lib/modules/*/volatile' % self.destdir):
             logging.debug("Unmounting %s" % mntpnt)
@@ -242,15 +243,77 @@ mirror.amd64 = %s/4/os/x86_64/CentOS/RPMS/
         else:
             self.install_from_template('/etc/yum.repos.d/CentOS-Base.repo', 'base.repo', { })
 
-    def install_core(self):
-        self.run_in_target('yum', '-y', 'clean', 'all')
-        self.run_in_target('yum', '-y', 'groupinstall', 'core')
-
-    def install_yum_proxy(self):
-        if self.vm.proxy is not None:
-            fp = open('%s/etc/yum.conf' % self.destdir, 'a')
-            fp.write('proxy=%s' % self.vm.proxy)
-            fp.close()
+    def install_packages(self):
+        """
+        Installs the core group, grub and the kernel (if the hypervisor
+        needs a boot loader) in a single yum transaction, removes the
+        unwanted packages and installs the extra ones. The extra
+        packages join the first transaction unless there is something
+        to remove: then they are installed afterwards, as they always
+        were, so that the removal can't take away their dependencies.
+        """
+        # Only throw away the metadata, so cached packages get reused
+        self.run_in_target('yum', '-y', 'clean', 'metadata', 'dbcache')
+
+        wanted = []
+        if self.vm.hypervisor.needs_bootloader:
+            wanted += ['grub', self.kernel_name()]
+        extras = self.vm.addpkg or []
+        if not self.vm.removepkg:
+            wanted += extras
+            extras = []
+
+        cmds = ['groupinstall core']
+        if wanted:
+            cmds += ['install %s' % ' '.join(wanted)]
+        cmds += ['run']
+        self.run_in_target('yum', '-y', 'shell', stdin='\n'.join(cmds) + '\n', capture=False)
+        # yum shell reports failed transactions, but still exits with 0
+        self.check_installed(wanted)
+
+        if self.vm.removepkg:
+            self.run_in_target('yum', '-y', 'remove', *self.vm.removepkg)
+        if extras:
+            self.run_in_target('yum', '-y', 'install', *extras)
+
+    def check_installed(self, packages):
+        """
+        Raises a VMBuilderException unless all of packages (names or
+        capabilities) are installed in the chroot.
+        """
+        if not packages:
+            return
+        output = self.run_in_target('rpm', '-q', '--whatprovides', ignore_fail=True, *packages)
+        missing = [line.split()[-1] for line in output.splitlines() if line.startswith('no package provides ')]
+        missing += [line.split()[1] for line in output.splitlines() if line.endswith(' is not installed')]
+        if missing:
+            raise VMBuilderException('yum failed to install %s' % ', '.join(missing))
+
+    def install_yum_proxy(self, final=False):
+        """
+        Points yum at the build's proxy or, for the final config, at the
+        --proxy one (if any)
+        """
+        if final:
+            proxy = self.vm.get_setting('proxy')
+        else:
+            proxy = self.vm.get_build_proxy()
+        yum_conf = '%s/etc/yum.conf' % self.destdir
+        lines = [line for line in open(yum_conf).read().splitlines() if not line.startswith('proxy=')]
+        if proxy:
+            lines.append('proxy=%s' % proxy)
+        fp = open(yum_conf, 'w')
+        fp.write('\n'.join(lines) + '\n')
+        fp.close()
+
+    def install_yum_keepcache(self, keep):
+        """Tells yum whether to keep downloaded packages in /var/cache/yum"""
+        yumconf = '%s/etc/yum.conf' % self.destdir
+        lines = [line for line in open(yumconf).read().split('\n') if not line.startswith('keepcache=')]
+        lines.insert(lines.index('[main]') + 1, 'keepcache=%d' % (keep and 1 or 0))
+        fp = open(yumconf, 'w')
+        fp.write('\n'.join(lines))
+        fp.close()
 
     def install_fstab(self):
         if self.vm.hypervisor.preferred_storage == VMBuilder.hypervisor.STORAGE_FS_IMAGE:
@@ -273,12 +336,11 @@ mirror.amd64 = %s/4/os/x86_64/CentOS/RPMS/
         else:
             self.vm.install_file('/etc/rpm/platform', 'i686-redhat-linux')
 
-        # Let's select a mirror for installation
-        if not self.vm.install_mirror:
-            if self.vm.mirror:
-                self.vm.install_mirror = self.vm.mirror
-            else:
-                self.vm.install_mirror = 'http://mirror.bytemark.co.uk/centos'
+        # Let's select a mirror for installation: --install-mirror (which
+        # the mirror selection plugin fills in), --mirror or the default
+        self.vm.install_mirror = (self.vm.get_setting('install-mirror') or
+                                  self.vm.get_setting('mirror') or
+                                  DEFAULT_MIRROR)
 
         # Create temporary rinse config file so we can force a mirror
         # Of course, rinse will only use the mirror to download the
@@ -290,20 +352,21 @@ mirror.amd64 = %s/4/os/x86_64/CentOS/RPMS/
 
         self.vm.add_clean_cmd('umount', '%s/proc' % self.destdir, ignore_fail=True)
         cmd = ['/usr/sbin/rinse', '--config', rinse_conf_name, '--arch', self.vm.arch, '--distribution', self.vm.suite, '--directory', self.destdir ]
-        run_cmd(*cmd)
+        env = dict(self.vm.context.cmd_env)
+        proxy = self.vm.get_build_proxy()
+        if proxy:
+            env['http_proxy'] = proxy
+        run_cmd(*cmd, env=env, capture=False)
 
     def install_kernel(self):
-        self.run_in_target('yum', '-y', 'install', self.kernel_name())
-
-        # Get the kernel version
+        # The kernel was installed by install_packages. Get its version
         self.kernel_version = self.run_in_target('rpm', '-q', '--qf', '%{V}-%{R}', self.kernel_name())
 
     def update_initrd(self):
         self.run_in_target('mkinitrd', '-f', '/boot/initrd-' + self.kernel_version + '.img', self.kernel_version)
 
     def install_grub(self):
-        self.run_in_target('yum', '-y', 'install', 'grub')
-
+        # grub was installed by install_packages. Put its stage files in place
         run_cmd('rsync', '-a', '%s%s/%s/' % (self.destdir, self.grubroot, self.vm.arch == 'amd64' and 'x86_64-redhat' or 'i386-redhat'), '%s/boot/grub/' % self.destdir)
 
     def selinux_autorelabel(self):
@@ -313,11 +376,11 @@ mirror.amd64 = %s/4/os/x86_64/CentOS/RPMS/
         import VMBuilder.plugins.xen
 
         if isinstance(self.vm.hypervisor, VMBuilder.plugins.xen.Xen):
-            self.run_in_target('mknod', '/dev/xvda', 'b', '202', '0')
-            self.run_in_target('mknod', '/dev/xvda1', 'b', '202', '1')
-            self.run_in_target('mknod', '/dev/xvda2', 'b', '202', '2')
-            self.run_in_target('mknod', '/dev/xvda3', 'b', '202', '3')
-            self.run_in_target('mknod', '/dev/xvc0', 'c', '204', '191')
+            self.run_batch_in_target([['mknod', '/dev/xvda', 'b', '202', '0'],
+                                      ['mknod', '/dev/xvda1', 'b', '202', '1'],
+                                      ['mknod', '/dev/xvda2', 'b', '202', '2'],
+                                      ['mknod', '/dev/xvda3', 'b', '202', '3'],
+                                      ['mknod', '/dev/xvc0', 'c', '204', '191']])
 
     def install_from_template(self, *args, **kwargs):
         return self.vm.distro.install_from_template(*args, **kwargs)
@@ -325,6 +388,9 @@ mirror.amd64 = %s/4/os/x86_64/CentOS/RPMS/
     def run_in_target(self, *args, **kwargs):
         return self.vm.distro.run_in_target(*args, **kwargs)
 
+    def run_batch_in_target(self, commands):
+        return self.vm.distro.run_batch_in_target(commands)
+
     def copy_to_target(self, infile, destpath):
         logging.debug("Copying %s on host to %s in guest" % (infile, destpath))
         dir = '%s/%s' % (self.destdir, os.path.dirname(destpath))
@@ -23,9 +23,16 @@ import types
 import shutil
 import VMBuilder
 from   VMBuilder           import register_distro, Distro
-from   VMBuilder.util      import run_cmd
+from   VMBuilder.util      import run_cmd, host_arch, LazyDefault, memoize
 from   VMBuilder.exception import VMBuilderUserError, VMBuilderException
 
+@memoize
+def generate_locale(lang):
+    """
+    Runs locale-gen for lang on the host, once per process.
+    """
+    run_cmd('locale-gen', '%s' % lang)
+
 class Centos(Distro):
     name = 'Centos'
     arg = 'centos'
@@ -44,8 +51,7 @@ class Centos(Distro):
         group.add_setting('removepkg', action='append', metavar='PKG', help='Remove PKG from the guest (can be specfied multiple times)')
 
         group = self.setting_group('General OS options')
-        self.host_arch = run_cmd('dpkg', '--print-architecture').rstrip()
-        group.add_setting('arch', extra_args=['-a'], default=self.host_arch, help='Specify the target architecture.  Valid options: amd64 i386 (defaults to host arch)')
+        group.add_setting('arch', extra_args=['-a'], default=LazyDefault(host_arch, 'the host architecture'), help='Specify the target architecture.  Valid options: amd64 i386 (defaults to host arch)')
         group.add_setting('hostname', default='centos', help='Set NAME as the hostname of the guest. Default: centos. Also uses this name as the VM name.')
 
         group = self.setting_group('Installation options')
@@ -92,10 +98,10 @@ class Centos(Distro):
         self.suite = getattr(mod, mysuite.replace('-','').capitalize())(self)
 
         myarch = self.get_setting("arch")
-        if myarch not in self.valid_archs[self.host_arch] or  \
+        if myarch not in self.valid_archs[host_arch()] or  \
             not self.suite.check_arch_validity(myarch):
             raise VMBuilderUserError('%s is not a valid architecture. Valid architectures are: %s' % (myarch, 
-                                                                                                      ' '.join(self.valid_archs[self.host_arch])))
+                                                                                                      ' '.join(self.valid_archs[host_arch()])))
 
         #myhypervisor = self.get_setting('hypervisor')
         #if myhypervisor.name == 'Xen':
@@ -106,7 +112,7 @@ class Centos(Distro):
         mylang = self.get_setting("lang")
         if mylang:
             try:
-                run_cmd('locale-gen', '%s' % mylang)
+                generate_locale(mylang)
             except VMBuilderException, e:
                 msg = "locale-gen does not recognize your locale '%s'" % mylang
                 raise VMBuilderUserError(msg)
@@ -144,7 +150,7 @@ class Centos(Distro):
                 run_cmd('umount', os.path.join(tmpdir, disk))
         shutil.rmtree(tmpdir)
 
-    def install_bootloader(self, chroot_dir, disks):
+    def setup_bootloader(self, chroot_dir, disks):
         tmpdir = '/tmp/vmbuilder-grub'
         os.makedirs('%s%s' % (chroot_dir, tmpdir))
         self.add_clean_cb(self.install_bootloader_cleanup)
@@ -168,7 +174,7 @@ class Centos(Distro):
         # compatible with an older BIOS. We work around this below by
         # setting the geometry with bogus values:
         #
-        self.run_in_target('grub', '--device-map=%s' % devmapfile, '--batch',  stdin='''root (hd0,0)
+        run_cmd('chroot', chroot_dir, 'grub', '--device-map=%s' % devmapfile, '--batch',  stdin='''root (hd0,0)
 geometry (hd0) 800 800 800
 setup (hd0)
 EOT''')
@@ -0,0 +1,26 @@
+#
+#    Generated by VMBuilder.plugins.write_plugin_index(). Do not edit.
+#
+#    Maps each plugin package to what it registers when imported:
+#    (kind, name) tuples, where kind is 'distro' or 'hypervisor' (and
+#    name is the registered class's .arg) or 'distro_plugin' or
+#    'hypervisor_plugin' (and name is the plugin class's name).
+#
+PLUGIN_INDEX = {
+    'VMBuilder.plugins.bootstrapcache' : [('distro_plugin', 'BootstrapCache')],
+    'VMBuilder.plugins.cachingproxy' : [('distro_plugin', 'CachingProxyPlugin')],
+    'VMBuilder.plugins.centos' : [('distro', 'centos')],
+    'VMBuilder.plugins.ec2' : [],
+    'VMBuilder.plugins.firstscripts' : [('distro_plugin', 'Firstscripts')],
+    'VMBuilder.plugins.kvm' : [('hypervisor', 'kvm'), ('hypervisor', 'qemu')],
+    'VMBuilder.plugins.libvirt' : [('hypervisor_plugin', 'Libvirt')],
+    'VMBuilder.plugins.mirrorselect' : [('distro_plugin', 'MirrorSelect')],
+    'VMBuilder.plugins.network' : [('distro_plugin', 'NetworkDistroPlugin'), ('hypervisor_plugin', 'NetworkHypervisorPlugin')],
+    'VMBuilder.plugins.packagecache' : [('distro_plugin', 'PackageCache')],
+    'VMBuilder.plugins.postinst' : [('distro_plugin', 'postinst')],
+    'VMBuilder.plugins.storage' : [('hypervisor_plugin', 'Storage')],
+    'VMBuilder.plugins.ubuntu' : [('distro', 'ubuntu')],
+    'VMBuilder.plugins.virtualbox' : [('hypervisor', 'vbox')],
+    'VMBuilder.plugins.vmware' : [('hypervisor', 'esxi'), ('hypervisor', 'vmserver'), ('hypervisor', 'vmw6')],
+    'VMBuilder.plugins.xen' : [('hypervisor', 'xen')],
+}
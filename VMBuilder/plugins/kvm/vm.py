@@ -37,8 +37,7 @@ class KVM(Hypervisor):
         self.imgs = []
         self.cmdline = ['kvm', '-m', str(self.context.get_setting('mem'))]
         self.cmdline += ['-smp', str(self.context.get_setting('cpus'))]
-        for disk in disks:
-            img_path = disk.convert(destdir, self.filetype)
+        for img_path in self.convert_disks(disks, destdir, self.filetype):
             self.imgs.append(img_path)
             self.call_hooks('fix_ownership', img_path)
             self.cmdline += ['-drive', 'file=%s' % os.path.basename(img_path)]
@@ -0,0 +1,66 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from   VMBuilder        import register_distro_plugin, Plugin
+from   VMBuilder.mirror import RankingCache, select_mirror, DEFAULT_TTL, PROBE_TIMEOUT
+
+import logging
+
+class MirrorSelect(Plugin):
+    """
+    Plugin to install from the fastest of several mirrors
+    """
+    name = 'Mirror selection plugin'
+
+    def register_options(self):
+        group = self.setting_group('Mirror selection')
+        group.add_setting('mirror-candidates', type='list', metavar='URL', help='Probe the mirror at URL (can be specified multiple times) and install from the fastest one, unless --install-mirror is given.')
+        group.add_setting('mirror-ranking-cache', metavar='DIR', help='Remember the ranking of the mirror candidates in DIR and reuse it in later builds.')
+        group.add_setting('mirror-ranking-ttl', type='int', metavar='SECONDS', default=DEFAULT_TTL, help='How long a remembered mirror ranking stays valid. [default: %default]')
+        group.add_setting('mirror-probe-timeout', type='int', metavar='SECONDS', default=PROBE_TIMEOUT, help='How long probing a mirror may take. [default: %default]')
+
+    def probe_path(self):
+        """
+        @rtype:  string
+        @return: a small file every mirror of the distro's suite has,
+                 relative to the mirror's base URL
+        """
+        suite = self.context.get_setting('suite')
+        if self.context.arg == 'centos':
+            basearch = self.context.get_setting('arch') == 'amd64' and 'x86_64' or 'i386'
+            return '%s/os/%s/repodata/repomd.xml' % (suite.replace('centos-', ''), basearch)
+        return 'dists/%s/Release' % suite
+
+    def preflight_check(self):
+        candidates = self.context.get_setting('mirror-candidates')
+        if not candidates:
+            return
+        if self.context.get_setting('install-mirror'):
+            logging.debug('--install-mirror given, not probing the mirror candidates')
+            return
+        if self.context.has_setting('iso') and self.context.get_setting('iso'):
+            return
+
+        cache = None
+        directory = self.context.get_setting('mirror-ranking-cache')
+        if directory:
+            cache = RankingCache(directory, self.context.get_setting('mirror-ranking-ttl'))
+        mirror = select_mirror(candidates, self.probe_path(), cache, self.context.get_setting('mirror-probe-timeout'))
+        self.context.set_setting('install-mirror', mirror)
+
+register_distro_plugin(MirrorSelect)
@@ -26,6 +26,7 @@ import socket
 from   VMBuilder           import register_hypervisor_plugin, register_distro_plugin
 from   VMBuilder.plugins   import Plugin
 from   VMBuilder.exception import VMBuilderUserError
+from   VMBuilder.util      import LazyDefault, memoize
 
 def validate_mac(mac):
     valid_mac_address = re.compile("^([0-9a-f]{2}:){5}([0-9a-f]{2})$", re.IGNORECASE)
@@ -64,11 +65,18 @@ def calculate_broadcast_address_from_ip_and_netmask(net, mask):
 def guess_gw_from_ip(ip):
     return ip + 0x01000000
 
+@memoize
+def host_domain():
+    """
+    @rtype:  string
+    @return: The domain part of the host's fully qualified name
+    """
+    return '.'.join(socket.gethostbyname_ex(socket.gethostname())[0].split('.')[1:]) or "defaultdomain"
+
 class NetworkDistroPlugin(Plugin):
     def register_options(self):
         group = self.setting_group('Network')
-        domainname = '.'.join(socket.gethostbyname_ex(socket.gethostname())[0].split('.')[1:]) or "defaultdomain"
-        group.add_setting('domain', metavar='DOMAIN', default=domainname, help='Set DOMAIN as the domain name of the guest [default: %default].')
+        group.add_setting('domain', metavar='DOMAIN', default=LazyDefault(host_domain, "the host's domain"), help='Set DOMAIN as the domain name of the guest [default: %default].')
 
     def preflight_check(self):
         domain = self.context.get_setting('domain')
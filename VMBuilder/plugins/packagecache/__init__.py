@@ -0,0 +1,81 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from   VMBuilder       import register_distro_plugin, Plugin
+from   VMBuilder.cache import PackagePool
+from   VMBuilder.util  import run_cmd
+
+import logging
+import os
+import shutil
+
+class PackageCache(Plugin):
+    """
+    Plugin to share downloaded packages between builds through a package
+    cache on the host, which is bind mounted into the chroot while the
+    package manager runs
+    """
+    name = 'Package cache plugin'
+
+    def register_options(self):
+        group = self.setting_group('Package cache')
+        group.add_setting('package-cache', metavar='DIR', help='Keep downloaded packages in DIR and reuse them in later builds.')
+        group.add_setting('package-cache-size', type='int', metavar='SIZE', default=4096, help='Maximum size (in MB) of the package cache. Least recently used packages are evicted first. [default: %default]')
+
+    def mount_package_cache(self, path, suffix):
+        """
+        Bind mounts a directory with the cached packages on path (inside
+        the chroot), for the package manager to use as its cache.
+
+        @type  suffix: string
+        @param suffix: The file name suffix of the packages (e.g. '.deb')
+        """
+        directory = self.context.get_setting('package-cache')
+        if not directory:
+            return
+
+        self.pool = PackagePool(os.path.join(directory, self.context.arg), self.context.get_setting('package-cache-size'), suffix)
+        self.builddir = self.pool.checkout()
+        self.mntpnt = '%s%s' % (self.context.chroot_dir, path)
+        if not os.path.isdir(self.mntpnt):
+            os.makedirs(self.mntpnt)
+        logging.info('Mounting package cache on %s' % path)
+        run_cmd('mount', '--bind', self.builddir, self.mntpnt)
+        self.context.add_clean_cb(self.package_cache_cleanup)
+
+    def unmount_package_cache(self):
+        """
+        Unmounts the package cache and adds the packages downloaded
+        during the build to it.
+        """
+        if not getattr(self, 'builddir', None):
+            return
+        self.context.cancel_cleanup(self.package_cache_cleanup)
+        run_cmd('umount', self.mntpnt)
+        self.pool.checkin(self.builddir)
+        self.builddir = None
+
+    def package_cache_cleanup(self):
+        # The build failed, so the downloads may be incomplete. Don't
+        # add them to the cache.
+        self.context.cancel_cleanup(self.package_cache_cleanup)
+        run_cmd('umount', self.mntpnt, ignore_fail=True)
+        shutil.rmtree(self.builddir, ignore_errors=True)
+        self.builddir = None
+
+register_distro_plugin(PackageCache)
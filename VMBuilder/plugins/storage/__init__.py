@@ -0,0 +1,57 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from   VMBuilder           import register_hypervisor_plugin, Plugin, VMBuilderUserError
+import VMBuilder.disk
+import os
+import stat
+
+class Storage(Plugin):
+    """
+    Plugin holding the settings that control how the target disk images
+    and filesystems are populated
+    """
+    name = 'Storage plugin'
+
+    def register_options(self):
+        group = self.setting_group('Storage options')
+        group.add_setting('storage-pipeline', metavar='PIPELINE', default='mount', valid_options=['mount', 'direct'], help='How the target filesystems are populated. "mount" formats and loop mounts them and copies the chroot in. "direct" builds ext2/3/4 filesystems straight from the chroot (mke2fs -d) and writes them into the images, without loop devices or mounts. [default: %default]')
+        group.add_setting('copy-jobs', type='int', metavar='NUM', default=1, help='Copy the chroot to the target filesystems using up to NUM parallel rsync processes, split by top-level directory and by mount point. [default: %default]')
+        group.add_setting('convert-engine', metavar='ENGINE', default='qemu-img', valid_options=['qemu-img', 'native'], help='How disk images are converted to qcow2. "native" streams only the allocated, non-zero clusters of the raw image into the qcow2 file without running qemu-img. [default: %default]')
+        group.add_setting('convert-jobs', type='int', metavar='NUM', default=1, help='Convert up to NUM disk images at the same time, each in its own process. [default: %default]')
+        group.add_setting('punch-holes', type='bool', default=False, help='With --convert-engine native, free the parts of the raw image that have been converted as we go, so that the raw and qcow2 images together take up little more space than the raw image alone. [default: %default]')
+        group.add_setting('mkfs-jobs', type='int', metavar='NUM', default=4, help='Create up to NUM of the target filesystems at the same time. [default: %default]')
+
+    def preflight_check(self):
+        for setting in ['copy-jobs', 'mkfs-jobs', 'convert-jobs']:
+            if self.context.get_setting(setting) < 1:
+                raise VMBuilderUserError('--%s must be at least 1' % setting)
+
+        if self.context.get_setting('punch-holes') and self.context.get_setting('convert-engine') != 'native':
+            raise VMBuilderUserError('--punch-holes only works with --convert-engine native')
+
+        if self.context.get_setting('storage-pipeline') == 'direct':
+            direct_types = [VMBuilder.disk.TYPE_EXT2, VMBuilder.disk.TYPE_EXT3, VMBuilder.disk.TYPE_EXT4, VMBuilder.disk.TYPE_SWAP]
+            for fs in VMBuilder.disk.get_ordered_filesystems(self.context):
+                if fs.type not in direct_types and not fs.dummy:
+                    raise VMBuilderUserError('The direct storage pipeline only supports ext2, ext3, ext4 and swap, not %s (%s)' % (fs.fstab_fstype(), fs.mntpnt))
+            for disk in self.context.disks:
+                if disk.preallocated and not stat.S_ISREG(os.stat(disk.filename).st_mode):
+                    raise VMBuilderUserError('The direct storage pipeline can only write to disk image files, not %s' % disk.filename)
+
+register_hypervisor_plugin(Storage)
@@ -78,14 +78,16 @@ class Dapper(suite.Suite):
     def install_authorized_keys(self):
         ssh_key = self.context.get_setting('ssh-key')
         if ssh_key:
-            os.mkdir('%s/root/.ssh' % self.context.chroot_dir, 0700)
+            if not os.path.isdir('%s/root/.ssh' % self.context.chroot_dir):
+                os.mkdir('%s/root/.ssh' % self.context.chroot_dir, 0700)
             shutil.copy(ssh_key, '%s/root/.ssh/authorized_keys' % self.context.chroot_dir)
             os.chmod('%s/root/.ssh/authorized_keys' % self.context.chroot_dir, 0644)
 
         user = self.context.get_setting('user')
         ssh_user_key = self.context.get_setting('ssh-user-key')
         if ssh_user_key:
-            os.mkdir('%s/home/%s/.ssh' % (self.context.chroot_dir, user), 0700)
+            if not os.path.isdir('%s/home/%s/.ssh' % (self.context.chroot_dir, user)):
+                os.mkdir('%s/home/%s/.ssh' % (self.context.chroot_dir, user), 0700)
             shutil.copy(ssh_user_key, '%s/home/%s/.ssh/authorized_keys' % (self.context.chroot_dir, user))
             os.chmod('%s/home/%s/.ssh/authorized_keys' % (self.context.chroot_dir, user), 0644)
             self.run_in_target('chown', '-R', '%s:%s' % ((user,)*2), '/home/%s/.ssh/' % (user)) 
@@ -135,21 +137,29 @@ class Dapper(suite.Suite):
             logging.info('Locking %s' % (user, ))
             self.run_in_target('usermod', '-L', user)
 
+    def user_exists(self, user):
+        for line in open('%s/etc/passwd' % self.context.chroot_dir):
+            if line.split(':')[0] == user:
+                return True
+        return False
+
     def create_initial_user(self):
         uid  = self.context.get_setting('uid')
         name = self.context.get_setting('name')
         user = self.context.get_setting('user')
         if uid:
-            self.run_in_target('adduser', '--disabled-password', '--uid', uid, '--gecos', name, user)
+            cmds = [['adduser', '--disabled-password', '--uid', uid, '--gecos', name, user]]
         else:
-            self.run_in_target('adduser', '--disabled-password', '--gecos', name, user)
+            cmds = [['adduser', '--disabled-password', '--gecos', name, user]]
 
-        self.run_in_target('addgroup', '--system', 'admin')
-        self.run_in_target('adduser', user, 'admin')
+        cmds += [['addgroup', '--system', 'admin'],
+                 ['adduser', user, 'admin']]
 
-        self.install_from_template('/etc/sudoers', 'sudoers')
         for group in ['adm', 'audio', 'cdrom', 'dialout', 'floppy', 'video', 'plugdev', 'dip', 'netdev', 'powerdev', 'lpadmin', 'scanner']:
-            self.run_in_target('adduser', user, group, ignore_fail=True)
+            cmds.append((['adduser', user, group], { 'ignore_fail' : True }))
+        self.run_batch_in_target(cmds)
+
+        self.install_from_template('/etc/sudoers', 'sudoers')
 
         self.update_passwords()
 
@@ -240,10 +250,18 @@ class Dapper(suite.Suite):
         # final vm is going to be on).
         self.run_in_target('apt-get', 'update', ignore_fail=final)
 
-    def install_apt_proxy(self):
-        proxy = self.context.get_setting('proxy')
+    def install_apt_proxy(self, final=False):
+        if final:
+            proxy = self.context.get_setting('proxy')
+        else:
+            proxy = self.context.get_build_proxy()
         if proxy is not None:
             self.context.install_file('/etc/apt/apt.conf', '// Proxy added by vmbuilder\nAcquire::http { Proxy "%s"; };' % proxy)
+        elif final:
+            # Drop the build's proxy (see the caching proxy plugin)
+            apt_conf = '%s/etc/apt/apt.conf' % self.context.chroot_dir
+            if os.path.exists(apt_conf) and open(apt_conf).read().startswith('// Proxy added by vmbuilder'):
+                os.unlink(apt_conf)
 
     def install_fstab(self, disks, filesystems):
         self.install_from_template('/etc/fstab', 'dapper_fstab', { 'parts' : disk.get_ordered_partitions(disks), 'prefix' : self.disk_prefix })
@@ -261,9 +279,10 @@ class Dapper(suite.Suite):
 
         suite = self.context.get_setting('suite')
         cmd += [suite, self.context.chroot_dir, self.debootstrap_mirror()]
-        kwargs = { 'env' : { 'DEBIAN_FRONTEND' : 'noninteractive' } }
+        kwargs = { 'env' : { 'DEBIAN_FRONTEND' : 'noninteractive' }, 'capture' : False }
+        kwargs['env'].update(self.context.cmd_env)
 
-        proxy = self.context.get_setting('proxy')
+        proxy = self.context.get_build_proxy()
         if proxy:
             kwargs['env']['http_proxy'] = proxy
         run_cmd(*cmd, **kwargs)
@@ -300,7 +319,9 @@ class Dapper(suite.Suite):
         return (mirror, updates_mirror, security_mirror)
 
     def install_kernel(self, destdir):
-        run_cmd('chroot', destdir, 'apt-get', '--force-yes', '-y', 'install', self.kernel_name(), env={ 'DEBIAN_FRONTEND' : 'noninteractive' })
+        env = { 'DEBIAN_FRONTEND' : 'noninteractive' }
+        env.update(self.context.cmd_env)
+        run_cmd('chroot', destdir, 'apt-get', '--force-yes', '-y', 'install', self.kernel_name(), env=env)
 
     def install_grub(self, chroot_dir):
         self.install_from_template('/etc/kernel-img.conf', 'kernelimg', { 'updategrub' : self.updategrub })
@@ -326,6 +347,9 @@ class Dapper(suite.Suite):
     def run_in_target(self, *args, **kwargs):
         return self.context.run_in_target(*args, **kwargs)
 
+    def run_batch_in_target(self, commands):
+        return self.context.run_batch_in_target(commands)
+
     def copy_to_target(self, infile, destpath):
         logging.debug("Copying %s on host to %s in guest" % (infile, destpath))
         dir = '%s/%s' % (self.destdir, os.path.dirname(destpath))
@@ -22,7 +22,7 @@ import shutil
 import stat
 import VMBuilder
 from   VMBuilder           import register_distro, Distro
-from   VMBuilder.util      import run_cmd
+from   VMBuilder.util      import run_cmd, host_arch, LazyDefault
 from   VMBuilder.exception import VMBuilderUserError, VMBuilderException
 
 class Ubuntu(Distro):
@@ -46,8 +46,7 @@ class Ubuntu(Distro):
         group.add_setting('seedfile', metavar="SEEDFILE", help='Seed the debconf database with the contents of this seed file before installing packages')
 
         group = self.setting_group('General OS options')
-        self.host_arch = run_cmd('dpkg', '--print-architecture').rstrip()
-        group.add_setting('arch', extra_args=['-a'], default=self.host_arch, help='Specify the target architecture.  Valid options: amd64 i386 lpia (defaults to host arch)')
+        group.add_setting('arch', extra_args=['-a'], default=LazyDefault(host_arch, 'the host architecture'), help='Specify the target architecture.  Valid options: amd64 i386 lpia (defaults to host arch)')
         group.add_setting('hostname', default='ubuntu', help='Set NAME as the hostname of the guest. Default: ubuntu. Also uses this name as the VM name.')
 
         group = self.setting_group('Installation options')
@@ -105,10 +104,10 @@ class Ubuntu(Distro):
         self.suite = getattr(mod, suite.capitalize())(self)
 
         arch = self.get_setting('arch') 
-        if arch not in self.valid_archs[self.host_arch] or  \
+        if arch not in self.valid_archs[host_arch()] or  \
             not self.suite.check_arch_validity(arch):
             raise VMBuilderUserError('%s is not a valid architecture. Valid architectures are: %s' % (arch,
-                                                                                                      ' '.join(self.valid_archs[self.host_arch])))
+                                                                                                      ' '.join(self.valid_archs[host_arch()])))
 
         components = self.get_setting('components')
         if not components:
@@ -142,6 +141,7 @@ class Ubuntu(Distro):
         self.suite.create_devices()
         self.suite.prevent_daemons_starting()
         self.suite.mount_dev_proc()
+        self.setup_package_cache()
         self.suite.install_extras()
         self.suite.create_initial_user()
         self.suite.install_authorized_keys()
@@ -149,6 +149,9 @@ class Ubuntu(Distro):
         self.suite.set_locale()
         self.suite.update()
         self.suite.install_sources_list(final=True)
+        self.call_hooks('unmount_package_cache')
+        self.call_hooks('stop_caching_proxy')
+        self.suite.install_apt_proxy(final=True)
         self.suite.run_in_target('apt-get', 'clean');
         self.suite.unmount_volatile()
         self.suite.unmount_proc()
@@ -157,6 +160,13 @@ class Ubuntu(Distro):
         self.suite.unprevent_daemons_starting()
         self.suite.create_manifest()
 
+    def setup_package_cache(self):
+        archives = '/var/cache/apt/archives'
+        self.call_hooks('mount_package_cache', archives, '.deb')
+        partial = '%s%s/partial' % (self.chroot_dir, archives)
+        if not os.path.isdir(partial):
+            os.makedirs(partial)
+
     def configure_networking(self, nics):
         self.suite.config_host_and_domainname()
         self.suite.config_interfaces(nics)
@@ -164,6 +174,19 @@ class Ubuntu(Distro):
     def configure_mounting(self, disks, filesystems):
         self.suite.install_fstab(disks, filesystems)
 
+    def customize_clone(self):
+        """
+        Applies the per-VM user and ssh key settings to a copy of an
+        existing image (see L{VMBuilder.clone}), and gives it ssh host
+        keys of its own.
+        """
+        self.reset_machine_identity()
+        if self.suite.user_exists(self.context.get_setting('user')):
+            self.suite.update_passwords()
+        else:
+            self.suite.create_initial_user()
+        self.suite.install_authorized_keys()
+
     def install(self, destdir):
         self.destdir = destdir
         self.suite.install(destdir)
@@ -189,6 +212,10 @@ class Ubuntu(Distro):
         self.suite.install_kernel(destdir)
 
     def install_bootloader(self, chroot_dir, disks):
+        self.suite.install_grub(chroot_dir)
+        self.suite.install_menu_lst(disks)
+
+    def setup_bootloader(self, chroot_dir, disks):
         root_dev = VMBuilder.disk.bootpart(disks).get_grub_id()
 
         tmpdir = '/tmp/vmbuilder-grub'
@@ -209,11 +236,9 @@ class Ubuntu(Distro):
             devmap.write("(hd%d) %s\n" % (id, new_filename))
         devmap.close()
         run_cmd('cat', '%s%s' % (chroot_dir, devmapfile))
-        self.suite.install_grub(chroot_dir)
-        self.run_in_target('grub', '--device-map=%s' % devmapfile, '--batch',  stdin='''root %s
+        run_cmd('chroot', chroot_dir, 'grub', '--device-map=%s' % devmapfile, '--batch',  stdin='''root %s
 setup (hd0)
 EOT''' % root_dev) 
-        self.suite.install_menu_lst(disks)
         self.install_bootloader_cleanup(chroot_dir)
 
     def xen_kernel_version(self):
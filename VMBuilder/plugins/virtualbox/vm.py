@@ -38,10 +38,7 @@ class VirtualBox(Hypervisor):
         group.add_setting('vbox-disk-format', metavar='FORMAT', default='vdi', help='Desired disk format. Valid options are: vdi vmdk. [default: %default]')
 
     def convert(self, disks, destdir):
-        self.imgs = []
-        for disk in disks:
-            img_path = disk.convert(destdir, self.context.get_setting('vbox-disk-format'))
-            self.imgs.append(img_path)
+        self.imgs = self.convert_disks(disks, destdir, self.context.get_setting('vbox-disk-format'))
 
     def deploy(self,destdir):
         hostname = self.context.distro.get_setting('hostname')
@@ -19,10 +19,10 @@
 from   VMBuilder import register_hypervisor, Hypervisor
 import VMBuilder
 import VMBuilder.hypervisor
+from   VMBuilder.util import place_image
 import os
 import os.path
 import stat
-from shutil import move
 from math import floor
 
 class VMWare(Hypervisor):
@@ -38,8 +38,7 @@ class VMWare(Hypervisor):
 
     def convert(self, disks, destdir):
         self.imgs = []
-        for disk in self.get_disks():
-            img_path = disk.convert(destdir, self.filetype)
+        for img_path in self.convert_disks(self.get_disks(), destdir, self.filetype):
             self.imgs.append(img_path)
             self.call_hooks('fix_ownership', img_path)
 
@@ -102,7 +101,7 @@ class VMWareEsxi(VMWare):
             flat = '%s/%s-flat.vmdk' % (destdir, diskfilename)
             self.vmdks.append(diskfilename)
 
-            move(disk.filename, flat)
+            place_image(disk.filename, flat)
 
             self.call_hooks('fix_ownership', flat)
 
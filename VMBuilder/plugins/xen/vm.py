@@ -17,10 +17,9 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 from   VMBuilder      import register_hypervisor, Hypervisor
-from   VMBuilder.util import run_cmd
+from   VMBuilder.util import place_image
 import VMBuilder
 import VMBuilder.hypervisor
-import logging
 import os.path
 
 class Xen(Hypervisor):
@@ -40,10 +39,8 @@ class Xen(Hypervisor):
         for filesystem in filesystems:
             if not filesystem.preallocated:
                 destfile = '%s/%s' % (destdir, os.path.basename(filesystem.filename))
-                logging.info('Moving %s to %s' % (filesystem.filename, destfile))
-                run_cmd('cp', '--sparse=always', filesystem.filename, destfile)
+                place_image(filesystem.filename, destfile)
                 self.call_hooks('fix_ownership', destfile)
-                os.unlink(filesystem.filename)
                 filesystem.filename = os.path.abspath(destfile)
                 destimages.append(destfile)
 
@@ -0,0 +1,188 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Build profiling
+import json
+import logging
+import os
+import os.path
+import resource
+import threading
+import time
+
+# How many of the slowest commands the report lists
+TOP_COMMANDS = 20
+
+# The active Profiler, if any. util.call_hooks and util.run_cmd report to it.
+profiler = None
+
+def start():
+    """
+    Start profiling the build.
+
+    @rtype:  L{Profiler}
+    @return: the new active profiler
+    """
+    global profiler
+    profiler = Profiler()
+    return profiler
+
+def stop(path):
+    """
+    Stop profiling and write the report to path.
+    """
+    global profiler
+    if profiler is None:
+        return
+    profiler.write(path)
+    profiler = None
+
+def children_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+class Profiler(object):
+    """
+    Records how long each hook (per plugin) and each command takes.
+
+    The report written by L{write} is a JSON object that can be loaded
+    into a Chrome trace viewer (chrome://tracing) as is: its traceEvents
+    hold one complete event per hook call and command. Its summary holds
+    the totals, the time spent in each hook and the slowest commands.
+
+    Commands are tagged with the innermost hook running in the same
+    thread. The CPU time of a command is the growth of RUSAGE_CHILDREN
+    while it ran, so it also counts other children finishing meanwhile
+    when commands run in parallel.
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self.start_cpu = children_cpu_time()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.events = []
+        self.commands = []
+        self.images = {}
+
+    def hook_stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def timestamp(self, t):
+        """
+        @rtype:  number
+        @return: t in microseconds since the start of the build, as trace events want it
+        """
+        return int((t - self.start_time) * 1000000)
+
+    def add_event(self, name, category, start, end, args):
+        event = { 'name' : name,
+                  'cat' : category,
+                  'ph' : 'X',
+                  'ts' : self.timestamp(start),
+                  'dur' : self.timestamp(end) - self.timestamp(start),
+                  'pid' : os.getpid(),
+                  'tid' : threading.current_thread().ident,
+                  'args' : args }
+        self.lock.acquire()
+        try:
+            self.events.append(event)
+        finally:
+            self.lock.release()
+        return event
+
+    def call(self, category, hook, owner, func, *args, **kwargs):
+        """
+        Calls func(*args, **kwargs) as owner's implementation of hook,
+        timing it.
+
+        @type  category: string
+        @param category: 'hook' for a whole hook call, 'plugin' for a
+                         single plugin's implementation
+        """
+        stack = self.hook_stack()
+        stack.append((hook, owner))
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stack.pop()
+            self.add_event(hook, category, start, time.time(),
+                           { 'hook' : hook, 'plugin' : owner })
+
+    def record_command(self, argv, start, start_cpu, status):
+        """
+        Records a command that was started at start, when the CPU time
+        of children was start_cpu, and has just exited with status.
+        """
+        end = time.time()
+        stack = self.hook_stack()
+        (hook, plugin) = stack and stack[-1] or (None, None)
+        event = self.add_event(os.path.basename(argv[0]), 'command', start, end,
+                               { 'argv' : argv,
+                                 'hook' : hook,
+                                 'plugin' : plugin,
+                                 'status' : status,
+                                 'cpu' : round(children_cpu_time() - start_cpu, 3) })
+        self.lock.acquire()
+        try:
+            self.commands.append((end - start, event))
+        finally:
+            self.lock.release()
+
+    def measure_images(self, directory):
+        """
+        Records the size of the image files in directory.
+        """
+        for (dirpath, dirnames, filenames) in os.walk(directory):
+            for filename in filenames:
+                st = os.stat(os.path.join(dirpath, filename))
+                self.images[os.path.join(dirpath, filename)] = { 'size' : st.st_size,
+                                                                 'allocated' : st.st_blocks * 512 }
+
+    def summary(self):
+        hooks = {}
+        for event in self.events:
+            if event['cat'] == 'hook':
+                hooks[event['name']] = hooks.get(event['name'], 0) + event['dur'] / 1000000.0
+        slowest = sorted(self.commands, key=lambda x:x[0], reverse=True)[:TOP_COMMANDS]
+        return { 'wall_time' : round(time.time() - self.start_time, 3),
+                 'children_cpu_time' : round(children_cpu_time() - self.start_cpu, 3),
+                 'commands' : len(self.commands),
+                 'command_time' : round(sum([duration for (duration, event) in self.commands]), 3),
+                 'hooks' : hooks,
+                 'images' : self.images,
+                 'image_bytes_written' : sum([image['allocated'] for image in self.images.values()]),
+                 'slowest_commands' : [{ 'argv' : event['args']['argv'],
+                                         'hook' : event['args']['hook'],
+                                         'plugin' : event['args']['plugin'],
+                                         'time' : round(duration, 3),
+                                         'cpu' : event['args']['cpu'] } for (duration, event) in slowest] }
+
+    def write(self, path):
+        summary = self.summary()
+        fp = open(path, 'w')
+        try:
+            json.dump({ 'traceEvents' : self.events,
+                        'displayTimeUnit' : 'ms',
+                        'summary' : summary }, fp, indent=1)
+        finally:
+            fp.close()
+        logging.info('Build profile written to %s: %.1f seconds, %.1f seconds of CPU time in %d commands' %
+                     (path, summary['wall_time'], summary['children_cpu_time'], summary['commands']))
@@ -0,0 +1,307 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    A caching HTTP proxy for the package downloads of a build
+import BaseHTTPServer
+import errno
+import httplib
+import json
+import logging
+import os
+import os.path
+import posixpath
+import shutil
+import socket
+import SocketServer
+import tempfile
+import threading
+import urllib2
+import urlparse
+from   VMBuilder.cache import Cache, cache_key, file_checksum
+
+# Files that never change once published: served from the store as is
+PACKAGE_SUFFIXES = ('.deb', '.udeb', '.rpm')
+# Repository indexes: revalidated with the mirror on every request
+METADATA_PREFIXES = ('Release', 'InRelease', 'Packages', 'Sources', 'Translation-', 'repomd.xml')
+
+CHUNK_SIZE = 64 * 1024
+
+def classify(url):
+    """
+    @rtype:  string
+    @return: 'package', 'metadata' or None (not cached) for url
+    """
+    path = urlparse.urlsplit(url).path
+    name = posixpath.basename(path)
+    if name.endswith(PACKAGE_SUFFIXES):
+        return 'package'
+    if name.startswith(METADATA_PREFIXES) or '/repodata/' in path:
+        return 'metadata'
+    return None
+
+class ContentStore(Cache):
+    """
+    The files fetched through a L{CachingProxy}, stored under the sha1
+    of their contents (so a file published under several URLs, e.g. by
+    different mirrors, is stored once), plus for every URL the key of
+    its contents and the validators (ETag, Last-Modified) needed to
+    revalidate it. Least recently used contents are evicted once the
+    store exceeds max_size (in megabytes).
+    """
+    def __init__(self, directory, max_size):
+        super(ContentStore, self).__init__(directory, max_size)
+        self.urls = '%s/urls' % self.directory
+        if not os.path.isdir(self.urls):
+            os.makedirs(self.urls)
+
+    def url_path(self, url):
+        return '%s/%s.json' % (self.urls, cache_key(url))
+
+    def get_meta(self, url):
+        """
+        @rtype:  dict
+        @return: what L{put} stored about url, or None
+        """
+        try:
+            fp = open(self.url_path(url))
+            try:
+                return json.load(fp)
+            finally:
+                fp.close()
+        except (IOError, ValueError):
+            return None
+
+    def open(self, meta):
+        """
+        @rtype:  file
+        @return: the stored contents described by meta (from L{get_meta}),
+                 opened for reading, or None if they have been evicted
+        """
+        lock = self.lock(exclusive=False)
+        try:
+            filename = self.lookup(meta['object'])
+            # Once open, the file stays readable even if it is evicted
+            return filename and open(filename, 'rb')
+        finally:
+            lock.release()
+
+    def put(self, url, filename, headers):
+        """
+        Moves filename (from L{tmp_filename}) into the store as the
+        contents of url.
+
+        @type  headers: dict
+        @param headers: the response headers for url
+        """
+        meta = { 'object' : file_checksum(filename),
+                 'content_type' : headers.get('content-type'),
+                 'etag' : headers.get('etag'),
+                 'last_modified' : headers.get('last-modified') }
+        self.insert(meta['object'], filename)
+        (fd, tmpname) = tempfile.mkstemp(prefix='.tmp', dir=self.urls)
+        fp = os.fdopen(fd, 'w')
+        try:
+            json.dump(meta, fp)
+        finally:
+            fp.close()
+        os.rename(tmpname, self.url_path(url))
+
+class ProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        self.server.proxy.handle(self)
+
+    def log_message(self, format, *args):
+        logging.debug('Caching proxy: %s' % (format % args))
+
+class ProxyServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class CachingProxy(object):
+    """
+    A forward HTTP proxy on localhost that keeps packages and
+    repository metadata in a L{ContentStore}. Packages are served from
+    the store without asking the mirror again. Metadata is revalidated
+    with a conditional request, and served from the store if it hasn't
+    changed. Everything else is passed through.
+
+    @type  store: L{ContentStore}
+    @param store: Where to keep the files
+    @type  upstream: string
+    @param upstream: URL of a proxy to fetch through (optional)
+    """
+    def __init__(self, store, upstream=None):
+        self.store = store
+        self.opener = urllib2.build_opener(urllib2.ProxyHandler(upstream and { 'http' : upstream } or {}))
+        self.server = None
+        self.lock = threading.Lock()
+        self.stats = { 'hits' : 0, 'revalidated' : 0, 'misses' : 0, 'uncached' : 0 }
+
+    def start(self):
+        """
+        Starts serving in a thread of its own.
+        """
+        self.server = ProxyServer(('127.0.0.1', 0), ProxyRequestHandler)
+        self.server.proxy = self
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={ 'poll_interval' : 0.1 }, name='caching proxy')
+        self.thread.daemon = True
+        self.thread.start()
+        logging.info('Caching proxy listening on %s' % self.url)
+
+    def stop(self):
+        if not self.server:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+        logging.info('Caching proxy: %(hits)d hits, %(revalidated)d revalidated, '
+                     '%(misses)d misses, %(uncached)d not cacheable' % self.stats)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server.server_port
+
+    def count(self, stat):
+        self.lock.acquire()
+        try:
+            self.stats[stat] += 1
+        finally:
+            self.lock.release()
+
+    def handle(self, request):
+        url = request.path
+        if not url.startswith('http://'):
+            request.send_error(501, 'Only http:// URLs can be proxied')
+            return
+        kind = classify(url)
+        if kind is None:
+            self.count('uncached')
+            self.forward(request, url)
+            return
+
+        meta = self.store.get_meta(url)
+        fp = meta and self.store.open(meta)
+        if fp and kind == 'package':
+            self.count('hits')
+            self.send_file(request, fp, meta)
+            return
+
+        headers = {}
+        if fp:
+            if meta['etag']:
+                headers['If-None-Match'] = meta['etag']
+            if meta['last_modified']:
+                headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            response = self.opener.open(urllib2.Request(url, headers=headers))
+        except urllib2.HTTPError, e:
+            if e.code == 304 and fp:
+                self.count('revalidated')
+                self.send_file(request, fp, meta)
+                return
+            response = e
+        except (IOError, socket.error, httplib.HTTPException), e:
+            response = None
+            error = str(e)
+        if fp:
+            fp.close()
+        if response is None:
+            request.send_error(502, error)
+            return
+        if response.code != 200:
+            self.relay(request, response)
+            return
+        self.count('misses')
+        self.fetch(request, url, response)
+
+    def forward(self, request, url):
+        try:
+            response = self.opener.open(url)
+        except urllib2.HTTPError, e:
+            response = e
+        except (IOError, socket.error, httplib.HTTPException), e:
+            request.send_error(502, str(e))
+            return
+        self.relay(request, response)
+
+    def send_headers(self, request, code, content_type, length):
+        request.send_response(code)
+        if content_type:
+            request.send_header('Content-Type', content_type)
+        if length is not None:
+            request.send_header('Content-Length', str(length))
+        request.end_headers()
+
+    def send_file(self, request, fp, meta):
+        try:
+            self.send_headers(request, 200, meta['content_type'], os.fstat(fp.fileno()).st_size)
+            shutil.copyfileobj(fp, request.wfile, CHUNK_SIZE)
+        finally:
+            fp.close()
+
+    def relay(self, request, response):
+        """
+        Passes response (or error response) on to the client as is.
+        """
+        try:
+            self.send_headers(request, response.code, response.info().get('content-type'),
+                              response.info().get('content-length'))
+            shutil.copyfileobj(response, request.wfile, CHUNK_SIZE)
+        finally:
+            response.close()
+
+    def fetch(self, request, url, response):
+        """
+        Passes response on to the client while storing it. It is only
+        added to the store if it arrived completely. If the client goes
+        away, the download still finishes, for the next build.
+        """
+        info = response.info()
+        length = info.get('content-length')
+        tmpname = self.store.tmp_filename()
+        client = request.wfile
+        try:
+            try:
+                self.send_headers(request, 200, info.get('content-type'), length)
+                fp = open(tmpname, 'wb')
+                received = 0
+                try:
+                    while True:
+                        data = response.read(CHUNK_SIZE)
+                        if not data:
+                            break
+                        fp.write(data)
+                        received += len(data)
+                        if client:
+                            try:
+                                client.write(data)
+                            except socket.error:
+                                client = None
+                finally:
+                    fp.close()
+            finally:
+                response.close()
+            if length is None or int(length) == received:
+                self.store.put(url, tmpname, info)
+        finally:
+            try:
+                os.unlink(tmpname)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
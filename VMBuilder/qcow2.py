@@ -0,0 +1,187 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Streaming raw to qcow2 conversion
+import ctypes
+import errno
+import logging
+import os
+import time
+from   struct              import pack
+from   VMBuilder.util      import data_extents, libc
+
+QCOW_MAGIC = 0x514649fb
+QCOW_VERSION = 2
+QCOW_OFLAG_COPIED = 1 << 63
+
+CLUSTER_BITS = 16
+CLUSTER_SIZE = 1 << CLUSTER_BITS
+L2_ENTRIES = CLUSTER_SIZE / 8
+REFCOUNTS_PER_BLOCK = CLUSTER_SIZE / 2
+
+# Not exposed by the os module
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+# How much of the source to convert between hole punches
+PUNCH_INTERVAL = 64 * 1024 * 1024
+
+def div_round_up(x, y):
+    return (x + y - 1) / y
+
+def punch_hole(fd, offset, length):
+    """
+    Deallocates length bytes of fd from offset on, keeping its size.
+
+    @rtype:  boolean
+    @return: False if the filesystem doesn't support punching holes
+    """
+    c = libc()
+    c.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+    if c.fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        err = ctypes.get_errno()
+        if err in [errno.EOPNOTSUPP, errno.ENOSYS]:
+            return False
+        raise OSError(err, os.strerror(err))
+    return True
+
+class Qcow2Writer(object):
+    """
+    Writes a qcow2 (version 2) image one cluster at a time.
+
+    Data clusters are appended in the order they are written. The
+    metadata (L2 tables, L1 table and refcounts) is kept in memory and
+    written after the data by L{close}, which also writes the header.
+
+    @type  filename: string
+    @param filename: The qcow2 image to create
+    @type  size: number
+    @param size: The virtual size of the image (in bytes)
+    """
+    def __init__(self, filename, size):
+        self.size = size
+        self.fp = open(filename, 'wb')
+        self.l2_tables = {}
+        self.next_cluster = 1 # cluster 0 holds the header
+        self.fp.seek(self.next_cluster * CLUSTER_SIZE)
+
+    def write_cluster(self, index, data):
+        """
+        Stores data as the contents of guest cluster number index.
+        Clusters must be written in ascending order.
+        """
+        if len(data) < CLUSTER_SIZE:
+            data += '\0' * (CLUSTER_SIZE - len(data))
+        self.fp.write(data)
+        l2 = self.l2_tables.setdefault(index / L2_ENTRIES, [0] * L2_ENTRIES)
+        l2[index % L2_ENTRIES] = (self.next_cluster * CLUSTER_SIZE) | QCOW_OFLAG_COPIED
+        self.next_cluster += 1
+
+    def sync(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def close(self):
+        l1_size = div_round_up(div_round_up(self.size, CLUSTER_SIZE), L2_ENTRIES)
+        l1 = [0] * l1_size
+        for index in sorted(self.l2_tables.keys()):
+            l1[index] = (self.next_cluster * CLUSTER_SIZE) | QCOW_OFLAG_COPIED
+            self.fp.write(pack('>%dQ' % L2_ENTRIES, *self.l2_tables[index]))
+            self.next_cluster += 1
+
+        l1_offset = self.next_cluster * CLUSTER_SIZE
+        l1_clusters = max(1, div_round_up(l1_size * 8, CLUSTER_SIZE))
+        self.fp.write(pack('>%dQ' % l1_size, *l1))
+        self.fp.write('\0' * (l1_clusters * CLUSTER_SIZE - l1_size * 8))
+        self.next_cluster += l1_clusters
+
+        # The refcount blocks and table need refcounts themselves
+        refblocks = 0
+        table_clusters = 0
+        while True:
+            total = self.next_cluster + refblocks + table_clusters
+            needed_refblocks = div_round_up(total, REFCOUNTS_PER_BLOCK)
+            needed_table_clusters = div_round_up(needed_refblocks * 8, CLUSTER_SIZE)
+            if (needed_refblocks, needed_table_clusters) == (refblocks, table_clusters):
+                break
+            (refblocks, table_clusters) = (needed_refblocks, needed_table_clusters)
+
+        refblocks_start = self.next_cluster
+        for block in range(refblocks):
+            used = min(total - block * REFCOUNTS_PER_BLOCK, REFCOUNTS_PER_BLOCK)
+            self.fp.write(pack('>%dH' % used, *([1] * used)))
+            self.fp.write('\0' * (CLUSTER_SIZE - used * 2))
+        table = [(refblocks_start + block) * CLUSTER_SIZE for block in range(refblocks)]
+        refcount_table_offset = (refblocks_start + refblocks) * CLUSTER_SIZE
+        self.fp.write(pack('>%dQ' % refblocks, *table))
+        self.fp.write('\0' * (table_clusters * CLUSTER_SIZE - refblocks * 8))
+
+        self.fp.seek(0)
+        self.fp.write(pack('>IIQIIQIIQQIIQ', QCOW_MAGIC, QCOW_VERSION, 0, 0, CLUSTER_BITS,
+                           self.size, 0, l1_size, l1_offset,
+                           refcount_table_offset, table_clusters, 0, 0))
+        self.fp.close()
+
+def convert(src, dest, punch_holes=False):
+    """
+    Converts the raw image src to the qcow2 image dest, reading only the
+    allocated parts of src and leaving out all-zero clusters.
+
+    @type  punch_holes: boolean
+    @param punch_holes: Deallocate the parts of src that have been
+        converted as we go, so that src and dest together never take up
+        much more space than src did. src is useless afterwards.
+    @rtype:  tuple
+    @return: the number of bytes read from src and written to dest
+    """
+    start_time = time.time()
+    fp = open(src, 'r+b')
+    try:
+        fd = fp.fileno()
+        size = os.fstat(fd).st_size
+        writer = Qcow2Writer(dest, size)
+        bytes_read = 0
+        punched_upto = 0
+        next_index = 0
+        zeros = '\0' * CLUSTER_SIZE
+        for (start, end) in data_extents(fd, size):
+            for index in xrange(max(start / CLUSTER_SIZE, next_index), div_round_up(end, CLUSTER_SIZE)):
+                fp.seek(index * CLUSTER_SIZE)
+                data = fp.read(CLUSTER_SIZE)
+                bytes_read += len(data)
+                if data != zeros[:len(data)]:
+                    writer.write_cluster(index, data)
+                next_index = index + 1
+
+                if punch_holes and next_index * CLUSTER_SIZE - punched_upto >= PUNCH_INTERVAL:
+                    # Make sure the data is safely in dest before dropping it from src
+                    writer.sync()
+                    if not punch_hole(fd, punched_upto, next_index * CLUSTER_SIZE - punched_upto):
+                        logging.warning('%s does not support punching holes, keeping it intact' % src)
+                        punch_holes = False
+                    punched_upto = next_index * CLUSTER_SIZE
+        writer.close()
+    finally:
+        fp.close()
+
+    bytes_written = os.stat(dest).st_size
+    elapsed = max(time.time() - start_time, 0.001)
+    logging.info('Converted %s to qcow2: read %d MB, wrote %d MB in %.1f seconds (%.1f MB/s)' %
+                 (src, bytes_read / 1024 / 1024, bytes_written / 1024 / 1024, elapsed,
+                  bytes_read / 1024.0 / 1024.0 / elapsed))
+    return (bytes_read, bytes_written)
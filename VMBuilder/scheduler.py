@@ -0,0 +1,140 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2010 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Running build stages concurrently
+import logging
+import sys
+import threading
+import time
+from   VMBuilder.exception import VMBuilderException
+
+class Stage(object):
+    """
+    A step of the build.
+
+    @type  name: string
+    @param name: Name of the stage, used by other stages' after lists
+    @type  func: function
+    @param func: Does the work (called without arguments)
+    @type  after: list
+    @param after: Names of the stages that must finish before this one starts
+    @type  cleanup: function
+    @param cleanup: Undoes the work of func. Called right away if the
+                    stage fails, and if it finished, but a later or
+                    concurrent one failed.
+    """
+    def __init__(self, name, func, after=[], cleanup=None):
+        self.name = name
+        self.func = func
+        self.after = after
+        self.cleanup = cleanup
+        self.thread = None
+        self.done = False
+        self.error = None
+        self.elapsed = None
+
+def run_stages(stages):
+    """
+    Runs each stage in a thread of its own as soon as the stages it
+    comes after are done, and waits for all of them.
+
+    If a stage fails, the failure is logged and the stage's cleanup
+    function is called right away, and no more stages are started.
+    Stages that are already running can't be interrupted, so once they
+    have finished, the cleanup functions of the stages that finished
+    are called (most recent first), and the first error is raised
+    again.
+    """
+    names = [stage.name for stage in stages]
+    for stage in stages:
+        for name in stage.after:
+            if name not in names:
+                raise VMBuilderException('Stage %s comes after unknown stage %s' % (stage.name, name))
+
+    def cleanup(stage):
+        if stage.cleanup:
+            logging.info('Cleaning up after stage %s' % stage.name)
+            try:
+                stage.cleanup()
+            except Exception, e:
+                logging.error('Cleaning up after stage %s failed: %s' % (stage.name, e))
+
+    cond = threading.Condition()
+    finished = []
+    errors = []
+
+    def run(stage):
+        start = time.time()
+        try:
+            try:
+                stage.func()
+            except:
+                stage.error = sys.exc_info()
+                logging.error('Stage %s failed: %s' % (stage.name, stage.error[1]))
+                running = [other.name for other in stages if other.thread and not other.done and other is not stage]
+                if running:
+                    logging.info('Waiting for stages %s to finish' % ', '.join(running))
+                cleanup(stage)
+        finally:
+            stage.elapsed = time.time() - start
+            cond.acquire()
+            stage.done = True
+            if stage.error:
+                errors.append(stage.error)
+            else:
+                finished.append(stage)
+            cond.notify()
+            cond.release()
+
+    start = time.time()
+    cond.acquire()
+    try:
+        while True:
+            done = [stage.name for stage in stages if stage.done and not stage.error]
+            if not errors:
+                for stage in stages:
+                    if stage.thread is None and not [name for name in stage.after if name not in done]:
+                        logging.info('Starting stage %s' % stage.name)
+                        stage.thread = threading.Thread(target=run, args=(stage,), name=stage.name)
+                        stage.thread.start()
+            running = [stage for stage in stages if stage.thread and not stage.done]
+            if not running:
+                break
+            # Waiting with a timeout keeps us responsive to ^C
+            cond.wait(1)
+    finally:
+        cond.release()
+
+    for stage in stages:
+        if stage.thread:
+            stage.thread.join()
+            logging.info('Stage %s took %.1f seconds' % (stage.name, stage.elapsed))
+
+    if errors:
+        for stage in reversed(finished):
+            cleanup(stage)
+        (exc_type, exc_value, exc_traceback) = errors[0]
+        raise exc_type, exc_value, exc_traceback
+
+    not_run = [stage.name for stage in stages if not stage.thread]
+    if not_run:
+        raise VMBuilderException('Stages %s could not be run' % ', '.join(not_run))
+    elapsed = time.time() - start
+    serial = sum([stage.elapsed for stage in stages])
+    logging.info('All stages took %.1f seconds, %.1f seconds less than running them one by one' %
+                 (elapsed, max(0, serial - elapsed)))
@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import VMBuilder
+import VMBuilder.util as util
+
+from VMBuilder.contrib.batch import Batch
+from VMBuilder.exception import VMBuilderUserError
+
+def make_keygen_chroot(chroot_dir):
+    """
+    Makes chroot_dir a minimal chroot that can run ssh-keygen (the
+    host's), with an ssh host key and a dbus machine id.
+    """
+    keygen = util.run_cmd('which', 'ssh-keygen').strip()
+    paths = [keygen] + [word for word in util.run_cmd('ldd', keygen).split() if word.startswith('/')]
+    for path in paths:
+        if not os.path.isdir(os.path.dirname(chroot_dir + path)):
+            os.makedirs(os.path.dirname(chroot_dir + path))
+        shutil.copy(path, chroot_dir + path)
+    for directory in ['dev', 'etc/ssh', 'var/lib/dbus']:
+        os.makedirs('%s/%s' % (chroot_dir, directory))
+    util.run_cmd('mknod', '-m', '666', '%s/dev/null' % chroot_dir, 'c', '1', '3')
+    open('%s/etc/passwd' % chroot_dir, 'w').write('root:x:0:0:root:/root:/bin/sh\n')
+    open('%s/var/lib/dbus/machine-id' % chroot_dir, 'w').write('0' * 32 + '\n')
+    util.run_cmd('chroot', chroot_dir, keygen, '-q', '-N', '', '-t', 'rsa', '-f', '/etc/ssh/ssh_host_rsa_key')
+
+MANIFEST = '''
+[DEFAULT]
+distro = ubuntu
+hypervisor = kvm
+suite = lucid
+addpkg = vim, screen
+
+[web1]
+hostname = web1
+ip = 10.0.0.11
+
+[web2]
+hostname = web2
+ip = 10.0.0.12
+rootsize = 8192
+
+[db1]
+hostname = db1
+addpkg = postgresql
+
+[ssh1]
+hostname = ssh1
+ssh-key = /root/.ssh/id_rsa.pub
+'''
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        (fd, self.manifest) = tempfile.mkstemp()
+        os.write(fd, MANIFEST)
+        os.close(fd)
+        self.batch = Batch()
+
+    def tearDown(self):
+        os.unlink(self.manifest)
+
+    def test_read_manifest(self):
+        specs = self.batch.read_manifest(self.manifest)
+        self.assertEqual([name for (name, spec) in specs], ['web1', 'web2', 'db1', 'ssh1'])
+        self.assertEqual(specs[1][1]['rootsize'], '8192')
+        self.assertEqual(specs[1][1]['suite'], 'lucid')
+
+    def test_missing_hypervisor(self):
+        fp = open(self.manifest, 'w')
+        fp.write('[web1]\ndistro = ubuntu\n')
+        fp.close()
+        self.assertRaises(VMBuilderUserError, self.batch.read_manifest, self.manifest)
+
+    def test_chroot_sharing(self):
+        keys = dict([(name, self.batch.chroot_key(spec)) for (name, spec) in self.batch.read_manifest(self.manifest)])
+        self.assertEqual(keys['web1'], keys['web2'])
+        self.assertNotEqual(keys['web1'], keys['db1'])
+        self.assertNotEqual(keys['web1'], keys['ssh1'])
+
+    def test_clones_get_their_own_identity(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            make_keygen_chroot('%s/shared' % workdir)
+            identities = []
+            for name in ['web1', 'web2']:
+                clone = '%s/%s' % (workdir, name)
+                os.mkdir(clone)
+                self.batch.clone_chroot(VMBuilder.get_distro('ubuntu')(), '%s/shared' % workdir, clone)
+                identities.append([open('%s/%s' % (clone, path)).read() for path in
+                                   ['etc/ssh/ssh_host_rsa_key', 'etc/ssh/ssh_host_rsa_key.pub', 'var/lib/dbus/machine-id']])
+            shared = [open('%s/shared/%s' % (workdir, path)).read() for path in
+                      ['etc/ssh/ssh_host_rsa_key', 'etc/ssh/ssh_host_rsa_key.pub', 'var/lib/dbus/machine-id']]
+            for (first, second, original) in zip(identities[0], identities[1], shared):
+                self.assertNotEqual(first, second)
+                self.assertNotEqual(first, original)
+        finally:
+            shutil.rmtree(workdir)
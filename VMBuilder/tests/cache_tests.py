@@ -0,0 +1,111 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2009 Canonical Ltd.
+#    
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import shutil
+import tempfile
+import unittest
+
+from VMBuilder.cache import Cache, PackagePool, cache_key
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = Cache(self.directory, 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def add_entry(self, key, size):
+        filename = self.cache.tmp_filename()
+        fp = open(filename, 'w')
+        fp.write('x' * size)
+        fp.close()
+        self.cache.insert(key, filename)
+
+    def test_cache_key_is_stable(self):
+        self.assertEqual(cache_key('ubuntu', ('suite', 'lucid')), cache_key('ubuntu', ('suite', 'lucid')))
+        self.assertNotEqual(cache_key('ubuntu', ('suite', 'lucid')), cache_key('ubuntu', ('suite', 'hardy')))
+
+    def test_lookup(self):
+        self.assertEqual(self.cache.lookup('foo'), None)
+        self.add_entry('foo', 10)
+        self.assertEqual(open(self.cache.lookup('foo')).read(), 'x' * 10)
+
+    def test_corrupt_entry_is_ignored(self):
+        self.add_entry('foo', 10)
+        fp = open(self.cache.data_path('foo'), 'a')
+        fp.write('garbage')
+        fp.close()
+        self.assertEqual(self.cache.lookup('foo'), None)
+
+    def test_least_recently_used_is_evicted(self):
+        self.add_entry('foo', 400*1024)
+        self.add_entry('bar', 400*1024)
+        os.utime(self.cache.checksum_path('foo'), (0, 0))
+        os.utime(self.cache.checksum_path('bar'), (1, 1))
+        self.add_entry('baz', 400*1024)
+        self.assertEqual(self.cache.lookup('foo'), None)
+        self.assertNotEqual(self.cache.lookup('bar'), None)
+        self.assertNotEqual(self.cache.lookup('baz'), None)
+
+    def test_new_entry_is_kept_even_if_too_large(self):
+        self.add_entry('foo', 2*1024*1024)
+        self.assertNotEqual(self.cache.lookup('foo'), None)
+
+class TestPackagePool(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pool = PackagePool(self.directory, 1, '.deb')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def download(self, builddir, name, size):
+        fp = open(os.path.join(builddir, name), 'w')
+        fp.write('x' * size)
+        fp.close()
+
+    def test_checkin_and_checkout(self):
+        builddir = self.pool.checkout()
+        self.assertEqual(os.listdir(builddir), [])
+        os.mkdir(os.path.join(builddir, 'partial'))
+        self.download(builddir, 'foo_1.0_all.deb', 10)
+        self.download(builddir, 'partial/bar_1.0_all.deb', 10)
+        self.download(builddir, 'lock', 0)
+        self.pool.checkin(builddir)
+        self.assertFalse(os.path.exists(builddir))
+
+        builddir = self.pool.checkout()
+        self.assertEqual(os.listdir(builddir), ['foo_1.0_all.deb'])
+        self.assertEqual(open(os.path.join(builddir, 'foo_1.0_all.deb')).read(), 'x' * 10)
+        shutil.rmtree(builddir)
+
+    def test_eviction_leaves_builds_alone(self):
+        builddir = self.pool.checkout()
+        self.download(builddir, 'old_1.0_all.deb', 600*1024)
+        self.pool.checkin(builddir)
+
+        user = self.pool.checkout()
+        builddir = self.pool.checkout()
+        os.utime(os.path.join(self.pool.pool, 'old_1.0_all.deb'), (0, 0))
+        self.download(builddir, 'new_1.0_all.deb', 600*1024)
+        self.pool.checkin(builddir)
+
+        self.assertEqual([name for (last_use, size, name) in self.pool.entries()], ['new_1.0_all.deb'])
+        self.assertTrue(os.path.exists(os.path.join(user, 'old_1.0_all.deb')))
+        shutil.rmtree(user)
@@ -0,0 +1,111 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2009 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import shutil
+import tempfile
+import unittest
+
+import VMBuilder
+from VMBuilder.checkpoint import Checkpoints, settings_hash
+
+def write_file(filename, contents):
+    fp = open(filename, 'w')
+    try:
+        fp.write(contents)
+    finally:
+        fp.close()
+
+def read_file(filename):
+    fp = open(filename)
+    try:
+        return fp.read()
+    finally:
+        fp.close()
+
+class TestSettingsHash(unittest.TestCase):
+    def test_changes_with_settings(self):
+        distro = VMBuilder.get_distro('ubuntu')()
+        before = settings_hash([distro], 4096)
+        self.assertEqual(before, settings_hash([distro], 4096))
+        self.assertNotEqual(before, settings_hash([distro], 8192))
+        distro.set_setting('suite', 'hardy')
+        self.assertNotEqual(before, settings_hash([distro], 4096))
+
+class TestCheckpoints(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.directory = '%s/checkpoints' % self.workdir
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def make_chroot(self, name):
+        chroot_dir = '%s/%s' % (self.workdir, name)
+        os.makedirs('%s/etc' % chroot_dir)
+        return chroot_dir
+
+    def test_chroot_round_trip(self):
+        chroot_dir = self.make_chroot('chroot')
+        write_file('%s/etc/hostname' % chroot_dir, 'test\n')
+        write_file('%s/etc/unsafe' % chroot_dir, '')
+        checkpoints = Checkpoints(self.directory, 'key')
+        self.assertEqual(checkpoints.last_stage(), None)
+        checkpoints.save_chroot('bootstrap', chroot_dir, excludes=['/etc/unsafe'])
+        self.assertEqual(checkpoints.last_stage(), 'bootstrap')
+
+        checkpoints = Checkpoints(self.directory, 'key')
+        resumed = self.make_chroot('resumed')
+        self.assertEqual(checkpoints.restore_chroot(resumed), 'bootstrap')
+        self.assertEqual(read_file('%s/etc/hostname' % resumed), 'test\n')
+        self.assertFalse(os.path.exists('%s/etc/unsafe' % resumed))
+
+    def test_other_settings_are_not_resumed(self):
+        chroot_dir = self.make_chroot('chroot')
+        Checkpoints(self.directory, 'key').save_chroot('chroot', chroot_dir)
+        checkpoints = Checkpoints(self.directory, 'other key')
+        self.assertEqual(checkpoints.last_stage(), None)
+        self.assertEqual(checkpoints.restore_chroot(self.make_chroot('resumed')), None)
+        self.assertFalse(os.path.exists(checkpoints.chroot_path()))
+
+    def test_reset(self):
+        checkpoints = Checkpoints(self.directory, 'key')
+        checkpoints.save_chroot('chroot', self.make_chroot('chroot'))
+        checkpoints.reset()
+        self.assertEqual(Checkpoints(self.directory, 'key').last_stage(), None)
+
+    def test_images_round_trip(self):
+        image = '%s/disk0.img' % self.workdir
+        write_file(image, 'installed')
+        checkpoints = Checkpoints(self.directory, 'key')
+        checkpoints.save_images('install', [image])
+        self.assertEqual(checkpoints.last_stage(), 'install')
+
+        # The next run's images have other (temporary) names
+        renamed = '%s/disk0-again.img' % self.workdir
+        Checkpoints(self.directory, 'key').restore_images('install', [renamed])
+        self.assertEqual(read_file(renamed), 'installed')
+
+    def test_remove_keeps_other_files(self):
+        checkpoints = Checkpoints(self.directory, 'key')
+        checkpoints.save_chroot('chroot', self.make_chroot('chroot'))
+        write_file('%s/notes' % self.directory, '')
+        checkpoints.remove()
+        self.assertEqual(os.listdir(self.directory), ['notes'])
+        os.unlink('%s/notes' % self.directory)
+        Checkpoints(self.directory, 'key').remove()
+        self.assertFalse(os.path.exists(self.directory))
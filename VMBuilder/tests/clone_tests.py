@@ -0,0 +1,118 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import VMBuilder
+from VMBuilder.clone import attach_root_filesystem, check_hypervisor, create_overlay, image_format
+from VMBuilder.disk import mbr_entry, mbr_sector, qemu_img_path, SECTOR_SIZE
+from VMBuilder.exception import VMBuilderUserError
+from VMBuilder.qcow2 import convert
+from VMBuilder.util import run_cmd
+
+class Context(object):
+    def __init__(self):
+        self.cleanup_cbs = []
+
+    def add_clean_cb(self, cb):
+        self.cleanup_cbs.insert(0, cb)
+
+    def cleanup(self):
+        for cb in self.cleanup_cbs:
+            cb()
+
+class TestClone(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.context = Context()
+
+    def tearDown(self):
+        self.context.cleanup()
+        shutil.rmtree(self.tmpdir)
+
+    def make_fs(self, name, size, root=False):
+        filename = os.path.join(self.tmpdir, name)
+        fp = open(filename, 'w')
+        fp.truncate(size)
+        fp.close()
+        if root:
+            srcdir = os.path.join(self.tmpdir, 'root')
+            os.makedirs(os.path.join(srcdir, 'etc'))
+            open(os.path.join(srcdir, 'etc', 'fstab'), 'w').write('# root\n')
+            run_cmd('mkfs.ext4', '-q', '-F', '-d', srcdir, filename)
+        else:
+            run_cmd('mkfs.ext4', '-q', '-F', filename)
+        return filename
+
+    def make_disk(self):
+        """A disk with a data partition and a root partition, in that order"""
+        disk = os.path.join(self.tmpdir, 'disk.img')
+        fp = open(disk, 'w')
+        fp.write(mbr_sector([mbr_entry(0x83, 2048, 10239), mbr_entry(0x83, 10240, 43007)]))
+        for (start, filename) in [(2048, self.make_fs('data', 4 << 20)),
+                                  (10240, self.make_fs('rootfs', 16 << 20, root=True))]:
+            fp.seek(start * SECTOR_SIZE)
+            fp.write(open(filename).read())
+        fp.truncate(43008 * SECTOR_SIZE)
+        fp.close()
+        return disk
+
+    def check_root(self, loopdev):
+        mntdir = os.path.join(self.tmpdir, 'mnt')
+        os.mkdir(mntdir)
+        run_cmd('mount', '-o', 'ro', loopdev, mntdir)
+        try:
+            self.assertTrue(os.path.exists(os.path.join(mntdir, 'etc', 'fstab')))
+        finally:
+            run_cmd('umount', mntdir)
+
+    def test_image_format(self):
+        raw = self.make_fs('raw', 1 << 20)
+        qcow2 = os.path.join(self.tmpdir, 'qcow2')
+        open(qcow2, 'w').write('QFI\xfb\0\0\0\2')
+        self.assertEqual(image_format(raw), 'raw')
+        self.assertEqual(image_format(qcow2), 'qcow2')
+
+    def test_raw_overlay_is_a_copy(self):
+        base = self.make_fs('base', 4 << 20)
+        dest = os.path.join(self.tmpdir, 'dest')
+        self.assertEqual(create_overlay(base, dest), 'raw')
+        self.assertEqual(open(base).read(), open(dest).read())
+
+    def test_finds_root_partition(self):
+        if os.geteuid() != 0:
+            self.skipTest('losetup requires root')
+        self.check_root(attach_root_filesystem(self.context, self.make_disk()))
+
+    def test_finds_root_in_filesystem_image(self):
+        if os.geteuid() != 0:
+            self.skipTest('losetup requires root')
+        self.check_root(attach_root_filesystem(self.context, self.make_fs('rootfs', 16 << 20, root=True)))
+
+    def test_no_root(self):
+        if os.geteuid() != 0:
+            self.skipTest('losetup requires root')
+        self.assertRaises(VMBuilderUserError, attach_root_filesystem, self.context, self.make_fs('data', 4 << 20))
+
+    def test_qcow2_overlay(self):
+        if not qemu_img_path():
+            self.skipTest('qemu-img is not installed')
+        raw = self.make_fs('raw', 4 << 20, root=True)
+        base = os.path.join(self.tmpdir, 'base.qcow2')
+        convert(raw, base)
+        dest = os.path.join(self.tmpdir, 'dest.qcow2')
+        self.assertEqual(create_overlay(base, dest), 'qcow2')
+        info = json.loads(run_cmd(qemu_img_path(), 'info', '--output=json', dest))
+        self.assertEqual(info['backing-filename'], base)
+        self.assertEqual(info['backing-filename-format'], 'qcow2')
+        # The overlay reads as the base image
+        copy = os.path.join(self.tmpdir, 'copy')
+        run_cmd(qemu_img_path(), 'convert', '-O', 'raw', dest, copy)
+        self.assertEqual(open(copy).read(), open(raw).read())
+
+    def test_check_hypervisor(self):
+        distro = VMBuilder.get_distro('ubuntu')()
+        check_hypervisor(VMBuilder.get_hypervisor('kvm')(distro))
+        self.assertRaises(VMBuilderUserError, check_hypervisor, VMBuilder.get_hypervisor('xen')(distro))
+        self.assertRaises(VMBuilderUserError, check_hypervisor, VMBuilder.get_hypervisor('vmw6')(distro))
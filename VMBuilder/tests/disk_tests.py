@@ -17,12 +17,13 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import stat
+import struct
 import tempfile
 import unittest
 import testtools
 
 import VMBuilder
-from VMBuilder.disk import detect_size, parse_size, index_to_devname, devname_to_index, Disk
+from VMBuilder.disk import detect_size, parse_size, index_to_devname, devname_to_index, Disk, Filesystem, convert_disks, copy_into, mkfs_all, read_mbr_partitions, read_partitions, read_superblock_uuid, wait_for
 from VMBuilder.exception import VMBuilderException, VMBuilderUserError
 from VMBuilder.util import run_cmd
 
@@ -42,6 +43,10 @@ class MockHypervisor(object):
     def __init__(self):
         self.disks = []
         self.distro = MockDistro()
+        self.settings = { 'convert-engine': 'native', 'punch-holes': False }
+
+    def get_setting(self, name):
+        return self.settings[name]
 
     def add_clean_cb(self, *args, **kwargs):
         pass
@@ -220,30 +225,24 @@ class TestDiskPartitioningPlugin(TestCase):
         file_output = run_cmd('file', self.tmpfile)
         self.assertEqual('%s: data' % self.tmpfile, file_output.strip())
         self.disk.partition()
-        file_output = run_cmd('file', self.tmpfile)
-        self.assertEqual('%s: x86 boot sector, code offset 0xb8' % self.tmpfile, file_output.strip())
-
-        file_output = run_cmd('parted', '--script', self.tmpfile, 'print')
-        self.assertEqual('''Model:  (file)
-Disk %s: 1074MB
-Sector size (logical/physical): 512B/512B
-Partition Table: msdos
-
-Number  Start  End  Size  Type  File system  Flags''' % self.tmpfile, file_output.strip())
+        self.assertEqual(read_mbr_partitions(self.tmpfile), [])
 
     def test_partition_table_nonempty(self):
-        from VMBuilder.util import run_cmd
-
         self.disk.add_part(1, 1023, 'ext3', '/')
         self.disk.partition()
-        file_output = run_cmd('parted', '--script', self.tmpfile, 'print')
-        self.assertEqual('''Model:  (file)
-Disk %s: 1074MB
-Sector size (logical/physical): 512B/512B
-Partition Table: msdos
+        self.assertEqual(read_mbr_partitions(self.tmpfile), [(2048, 1023*2048)])
+        self.assertEqual(self.disk.partitions[0].offset, 1024*1024)
+        self.assertEqual(self.disk.partitions[0].nbytes, 1023*1024*1024)
 
-Number  Start   End     Size    Type     File system  Flags
- 1      1049kB  1023MB  1022MB  primary''' % self.tmpfile, file_output.strip())
+    def test_partition_at_start_skips_first_track(self):
+        self.disk.add_part(0, 100, 'ext3', '/boot')
+        self.disk.add_part(100, 924, 'swap', 'swap')
+        self.disk.partition()
+        self.assertEqual(read_mbr_partitions(self.tmpfile), [(63, 100*2048-63), (100*2048, 924*2048)])
+        fp = open(self.tmpfile)
+        mbr = fp.read(512)
+        fp.close()
+        self.assertEqual([ord(mbr[446 + 16*i + 4]) for i in range(4)], [0x83, 0x82, 0, 0])
 
     @testtools.skipIf(os.geteuid() != 0, 'Needs root to run')
     def test_map_partitions(self):
@@ -252,7 +251,7 @@ Number  Start   End     Size    Type     File system  Flags
         self.disk.map_partitions()
         try:
             from VMBuilder.disk import detect_size
-            self.assertEqual(detect_size(self.disk.partitions[0].filename), 1023000576)
+            self.assertEqual(detect_size(self.disk.partitions[0].filename), 1023*1024*1024)
         except:
             raise
         finally:
@@ -287,3 +286,190 @@ Number  Start   End     Size    Type     File system  Flags
         disk2 = self.vm.add_disk(tmpfile2, '1G')
         self.assertEqual(self.disk.get_index(), 0)
         self.assertEqual(disk2.get_index(), 1)
+
+class TestGPTPartitioning(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        self.tmpfile = get_temp_filename()
+        fp = open(self.tmpfile, 'w')
+        fp.truncate(3 * 1024**4)
+        fp.close()
+
+        self.vm = MockHypervisor()
+        self.disk = self.vm.add_disk(self.tmpfile)
+        self.disk.size = 3 * 1024**2
+
+    def tearDown(self):
+        TestCase.tearDown(self)
+        os.unlink(self.tmpfile)
+
+    def test_large_disk_gets_gpt(self):
+        self.disk.add_part(1, 3 * 1024**2 - 1, 'ext4', '/')
+        self.disk.partition()
+        sectors = 3 * 1024**4 / 512
+        fp = open(self.tmpfile)
+        primary = fp.read(34 * 512)
+        fp.seek((sectors - 33) * 512)
+        backup = fp.read(33 * 512)
+        fp.close()
+
+        # Protective MBR covering the whole addressable range
+        self.assertEqual(read_mbr_partitions(self.tmpfile), [(1, 2**32 - 1)])
+        self.assertEqual(ord(primary[446 + 4]), 0xee)
+
+        self.assertEqual(primary[512:520], 'EFI PART')
+        self.assertEqual(backup[-512:-504], 'EFI PART')
+        (current, alternate) = struct.unpack('<QQ', primary[512+24:512+40])
+        self.assertEqual((current, alternate), (1, sectors - 1))
+        (current, alternate) = struct.unpack('<QQ', backup[-512+24:-512+40])
+        self.assertEqual((current, alternate), (sectors - 1, 1))
+
+        # The partition ends before the backup GPT
+        (first, last) = struct.unpack('<QQ', primary[1024+32:1024+48])
+        self.assertEqual(first, 2048)
+        self.assertEqual(last, sectors - 34)
+        self.assertEqual(primary[1024:1024+128], backup[:128])
+        self.assertEqual(self.disk.partitions[0].nbytes, (last - first + 1) * 512)
+
+    def test_read_gpt_partitions(self):
+        self.disk.add_part(1, 1024, 'ext4', '/')
+        self.disk.add_part(1025, 2048, 'swap', 'swap')
+        self.disk.partition()
+        self.assertEqual(read_partitions(self.tmpfile), [(2048, 1024 * 2048), (1025 * 2048, 2048 * 2048)])
+
+class TestDirectPopulation(TestCase):
+    def setUp(self):
+        super(TestDirectPopulation, self).setUp()
+        self.tmpfile = get_temp_filename()
+        self.addCleanup(os.unlink, self.tmpfile)
+
+    def test_read_mbr_partitions(self):
+        mbr = '\0' * 446
+        mbr += '\0' * 4 + '\x82' + '\0' * 3 + struct.pack('<II', 10240, 2048)
+        mbr += '\0' * 4 + '\x83' + '\0' * 3 + struct.pack('<II', 2048, 8192)
+        mbr += '\0' * 32 + '\x55\xaa'
+        fp = open(self.tmpfile, 'w')
+        fp.write(mbr)
+        fp.close()
+        self.assertEqual(read_mbr_partitions(self.tmpfile), [(2048, 8192), (10240, 2048)])
+        self.assertEqual(read_partitions(self.tmpfile), [(2048, 8192), (10240, 2048)])
+
+    def test_read_mbr_partitions_no_signature(self):
+        fp = open(self.tmpfile, 'w')
+        fp.write('\0' * 512)
+        fp.close()
+        self.assertRaises(VMBuilderException, read_mbr_partitions, self.tmpfile)
+
+    def test_copy_into(self):
+        src = get_temp_filename()
+        self.addCleanup(os.unlink, src)
+        fp = open(src, 'w')
+        fp.write('\0' * 1024 * 1024 + 'data')
+        fp.close()
+        fp = open(self.tmpfile, 'w')
+        fp.write('x' * 4 * 1024 * 1024)
+        fp.close()
+
+        copy_into(src, self.tmpfile, 512, sparse=True)
+        contents = open(self.tmpfile).read()
+        self.assertEqual(contents[512:1024*1024+512], 'x' * 1024 * 1024)
+        self.assertEqual(contents[1024*1024+512:1024*1024+516], 'data')
+
+        copy_into(src, self.tmpfile, 512, sparse=False)
+        contents = open(self.tmpfile).read()
+        self.assertEqual(contents[512:1024*1024+512], '\0' * 1024 * 1024)
+
+class TestWaitFor(TestCase):
+    def test_wait_for_polls_until_true(self):
+        calls = []
+        def condition():
+            calls.append(1)
+            return len(calls) == 3
+        self.assertTrue(wait_for(condition, timeout=5, first_delay=0.001))
+        self.assertEqual(len(calls), 3)
+
+    def test_wait_for_gives_up(self):
+        self.assertFalse(wait_for(lambda: False, timeout=0.05, first_delay=0.001))
+
+class TestMkfsAll(TestCase):
+    def test_mkfs_all(self):
+        vm = MockHypervisor()
+        fss = []
+        for (type, mntpnt) in [('ext3', '/'), ('ext4', '/var'), ('swap', None)]:
+            filename = get_temp_filename()
+            self.addCleanup(os.unlink, filename)
+            fp = open(filename, 'w')
+            fp.truncate(16*1024*1024)
+            fp.close()
+            fss.append(Filesystem(vm=vm, type=type, mntpnt=mntpnt, filename=filename))
+        mkfs_all(fss, 2)
+        for fs in fss:
+            self.assertTrue(fs.uuid)
+        self.assertEqual(len(set([fs.uuid for fs in fss])), 3)
+
+class TestSuperblockUUID(TestCase):
+    def setUp(self):
+        super(TestSuperblockUUID, self).setUp()
+        self.tmpfile = get_temp_filename()
+        self.addCleanup(os.unlink, self.tmpfile)
+        fp = open(self.tmpfile, 'w')
+        fp.truncate(16*1024*1024)
+        fp.close()
+
+    def test_ext(self):
+        uuid = '7e3c1f5a-2b1d-4e0b-9c1a-3f4b5c6d7e8f'
+        for mkfs in ['mkfs.ext2', 'mkfs.ext3', 'mkfs.ext4']:
+            run_cmd(mkfs, '-F', '-U', uuid, self.tmpfile)
+            self.assertEqual(read_superblock_uuid(self.tmpfile), uuid)
+
+    def test_swap(self):
+        uuid = '0d1e2f3a-4b5c-4d6e-8f7a-9b0c1d2e3f4a'
+        run_cmd('mkswap', '-U', uuid, self.tmpfile)
+        self.assertEqual(read_superblock_uuid(self.tmpfile), uuid)
+
+    def test_xfs(self):
+        fp = open(self.tmpfile, 'r+')
+        fp.write('XFSB' + '\0' * 28 + '\x12\x34\x56\x78' * 4)
+        fp.close()
+        self.assertEqual(read_superblock_uuid(self.tmpfile), '12345678-1234-5678-1234-567812345678')
+
+    def test_unknown(self):
+        self.assertRaises(VMBuilderException, read_superblock_uuid, self.tmpfile)
+
+class TestConvertDisks(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        self.destdir = tempfile.mkdtemp()
+        self.vm = MockHypervisor()
+        for x in range(3):
+            tmpfile = get_temp_filename()
+            os.unlink(tmpfile)
+            fp = open(tmpfile, 'w')
+            fp.truncate(64*1024*1024)
+            fp.write('disk %d' % x)
+            fp.close()
+            self.vm.disks.append(Disk(self.vm, tmpfile))
+            # Pretend we created it, so it gets converted
+            self.vm.disks[-1].preallocated = False
+
+    def tearDown(self):
+        TestCase.tearDown(self)
+        for disk in self.vm.disks:
+            if os.path.exists(disk.filename):
+                os.unlink(disk.filename)
+        os.rmdir(self.destdir)
+
+    def test_convert_disks_keeps_order(self):
+        expected = [disk.converted_filename(self.destdir, 'qcow2') for disk in self.vm.disks]
+        imgs = convert_disks(self.vm.disks, self.destdir, 'qcow2', 3)
+        self.assertEqual(imgs, expected)
+        for (disk, img) in zip(self.vm.disks, imgs):
+            self.assertEqual(disk.filename, os.path.abspath(img))
+            self.assertEqual(disk.format_type, 'qcow2')
+            self.assertEqual(open(img).read(4), 'QFI\xfb')
+
+    def test_convert_disks_fails(self):
+        os.unlink(self.vm.disks[1].filename)
+        self.assertRaises(IOError, convert_disks, self.vm.disks, self.destdir, 'qcow2', 3)
+        for filename in os.listdir(self.destdir):
+            os.unlink(os.path.join(self.destdir, filename))
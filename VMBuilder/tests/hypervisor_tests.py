@@ -0,0 +1,55 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2009 Canonical Ltd.
+#
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import shutil
+import tempfile
+import unittest
+
+import VMBuilder
+from VMBuilder.qcow2 import CLUSTER_SIZE
+from VMBuilder.tests.qcow2_tests import read_qcow2
+
+class TestFinalise(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.destdir = os.path.join(self.tmpdir, 'dest')
+        os.mkdir(self.destdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_kvm_converts_and_deploys(self):
+        hypervisor = VMBuilder.get_hypervisor('kvm')(VMBuilder.get_distro('ubuntu')())
+        # The native engine doesn't need qemu-img
+        hypervisor.set_setting('convert-engine', 'native')
+        filename = os.path.join(self.tmpdir, 'disk0.img')
+        hypervisor.add_disk(filename, size='4M')
+        fp = open(filename, 'w')
+        fp.seek(CLUSTER_SIZE)
+        fp.write('x' * CLUSTER_SIZE)
+        fp.truncate(4 << 20)
+        fp.close()
+
+        hypervisor.finalise(self.destdir)
+
+        converted = os.path.join(self.destdir, 'disk0.qcow2')
+        contents = read_qcow2(converted)[0]
+        self.assertEqual(contents[CLUSTER_SIZE:2 * CLUSTER_SIZE], 'x' * CLUSTER_SIZE)
+        self.assertEqual(hypervisor.disks[0].filename, converted)
+        script = open(os.path.join(self.destdir, 'run.sh')).read()
+        self.assertTrue('-drive file=disk0.qcow2' in script)
@@ -0,0 +1,100 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2009 Canonical Ltd.
+#    
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import BaseHTTPServer
+import SocketServer
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from VMBuilder.exception import VMBuilderUserError
+from VMBuilder.mirror    import RankingCache, probe, rank_mirrors, select_mirror
+
+INDEX_PATH = 'dists/lucid/Release'
+
+class StubMirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves INDEX_PATH below /fast/ and (after a delay) below /slow/
+    """
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path.startswith('/slow/'):
+            time.sleep(0.3)
+        if self.path not in ['/fast/%s' % INDEX_PATH, '/slow/%s' % INDEX_PATH]:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '4096')
+        self.end_headers()
+        self.wfile.write('x' * 4096)
+
+    def log_message(self, *args):
+        pass
+
+class StubMirror(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class TestMirror(unittest.TestCase):
+    def setUp(self):
+        self.server = StubMirror(('127.0.0.1', 0), StubMirrorHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base = 'http://127.0.0.1:%d' % self.server.server_port
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_probe(self):
+        (ttfb, throughput) = probe('%s/fast/%s' % (self.base, INDEX_PATH))
+        self.assertTrue(ttfb >= 0)
+        self.assertTrue(throughput > 0)
+        self.assertEqual(probe('%s/missing/%s' % (self.base, INDEX_PATH)), None)
+
+    def test_rank_mirrors(self):
+        candidates = ['%s/slow' % self.base, '%s/missing' % self.base, '%s/fast/' % self.base]
+        ranking = rank_mirrors(candidates, INDEX_PATH)
+        self.assertEqual([mirror for (score, mirror) in ranking], ['%s/fast/' % self.base, '%s/slow' % self.base])
+
+    def test_probes_run_concurrently(self):
+        start = time.time()
+        rank_mirrors(['%s/slow' % self.base] * 3, INDEX_PATH)
+        self.assertTrue(time.time() - start < 0.8, 'Mirrors were not probed concurrently')
+
+    def test_select_mirror_uses_cache(self):
+        candidates = ['%s/slow' % self.base, '%s/fast' % self.base]
+        cache = RankingCache(self.directory)
+        self.assertEqual(select_mirror(candidates, INDEX_PATH, cache), '%s/fast' % self.base)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(select_mirror(candidates, INDEX_PATH, cache), '%s/fast' % self.base)
+        self.assertEqual(len(self.server.requests), 2, 'Cached ranking was not used')
+
+    def test_expired_ranking_is_ignored(self):
+        candidates = ['%s/fast' % self.base]
+        cache = RankingCache(self.directory, ttl=0)
+        select_mirror(candidates, INDEX_PATH, cache)
+        select_mirror(candidates, INDEX_PATH, cache)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_no_reachable_mirror(self):
+        self.assertRaises(VMBuilderUserError, select_mirror, ['%s/missing' % self.base], INDEX_PATH)
@@ -1,7 +1,9 @@
+import os
 import unittest
 
 import VMBuilder.plugins
 from   VMBuilder.exception import VMBuilderException
+from   VMBuilder.util      import LazyDefault
 
 class TestPluginsSettings(unittest.TestCase):
     class VM(VMBuilder.plugins.Plugin):
@@ -34,6 +36,31 @@ class TestPluginsSettings(unittest.TestCase):
         self.vm.set_setting_default('testsetting', 'newerdefault')
         self.assertEqual(self.vm.get_setting('testsetting'), 'foo', "Setting does not return set value after setting new default value.")
 
+    def test_lazy_default(self):
+        calls = []
+        def compute():
+            calls.append(None)
+            return 'computed'
+
+        setting_group = self.plugin.setting_group('Test Setting Group')
+        setting_group.add_setting('lazysetting', default=LazyDefault(compute, 'a computed value'))
+        self.assertTrue(self.vm._config['lazysetting'].has_lazy_default())
+        self.assertEqual(calls, [], 'Lazy default computed when the setting was added.')
+
+        self.assertEqual(self.vm.get_setting('lazysetting'), 'computed')
+        self.assertEqual(self.vm.get_setting_default('lazysetting'), 'computed')
+        self.assertFalse(self.vm._config['lazysetting'].has_lazy_default())
+        self.assertEqual(len(calls), 1, 'Lazy default computed more than once.')
+
+    def test_lazy_default_not_computed_if_set(self):
+        def compute():
+            self.fail('Lazy default computed although a value was set.')
+
+        setting_group = self.plugin.setting_group('Test Setting Group')
+        setting_group.add_setting('lazysetting', default=LazyDefault(compute, 'a computed value'))
+        self.vm.set_setting('lazysetting', 'foo')
+        self.assertEqual(self.vm.get_setting('lazysetting'), 'foo')
+
     def test_invalid_type_raises_exception(self):
         setting_group = self.plugin.setting_group('Test Setting Group')
         self.assertRaises(VMBuilderException, setting_group.add_setting, 'oddsetting', type='odd')
@@ -46,6 +73,7 @@ class TestPluginsSettings(unittest.TestCase):
         self.vm.set_setting_valid_options('strsetting', ['foo', 'bar'])
         self.assertEqual(self.vm.get_setting_valid_options('strsetting'), ['foo', 'bar'])
         self.vm.set_setting('strsetting', 'foo')
+        self.assertEqual(self.vm.get_setting('strsetting'), 'foo')
         self.assertRaises(VMBuilderException, self.vm.set_setting, 'strsetting', 'baz')
         self.vm.set_setting_valid_options('strsetting', None)
         self.vm.set_setting('strsetting', 'baz')
@@ -117,3 +145,35 @@ class TestPluginsSettings(unittest.TestCase):
 
     def test_add_setting(self):
         setting_group = self.plugin.setting_group('Test Setting Group')
+
+class TestRunInTarget(unittest.TestCase):
+    class VM(VMBuilder.plugins.Plugin):
+        def __init__(self, *args, **kwargs):
+            self._config = {}
+            self.context = self
+            self.chroot_dir = '/'
+            self.cmd_env = { 'VMBUILDER_TEST' : 'context' }
+
+    def setUp(self):
+        self.vm = self.VM()
+
+    @unittest.skipIf(os.geteuid() != 0, 'chroot requires root')
+    def test_cmd_env_is_passed(self):
+        self.assertEqual(self.vm.run_in_target('sh', '-c', 'echo $VMBUILDER_TEST'), 'context\n')
+
+    @unittest.skipIf(os.geteuid() != 0, 'chroot requires root')
+    def test_explicit_env_wins(self):
+        self.assertEqual(self.vm.run_in_target('sh', '-c', 'echo $VMBUILDER_TEST', env={ 'VMBUILDER_TEST' : 'explicit' }), 'explicit\n')
+        self.assertEqual(self.vm.cmd_env, { 'VMBUILDER_TEST' : 'context' })
+
+class TestPluginIndex(unittest.TestCase):
+    def test_index_is_up_to_date(self):
+        from VMBuilder.plugins.index import PLUGIN_INDEX
+        self.assertEqual(VMBuilder.plugins.generate_plugin_index(), PLUGIN_INDEX,
+                         'The plugin index is out of date. Run VMBuilder.plugins.write_plugin_index().')
+
+    def test_get_distro_loads_plugin(self):
+        import VMBuilder
+        self.assertEqual(VMBuilder.get_distro('ubuntu').arg, 'ubuntu')
+        self.assertTrue('ubuntu' in VMBuilder.available_distros())
+        self.assertTrue('kvm' in VMBuilder.available_hypervisors())
@@ -0,0 +1,61 @@
+import json
+import os
+import tempfile
+import unittest
+
+import VMBuilder.profiler
+from VMBuilder.util import call_hooks, run_cmd
+
+class TestProfiler(unittest.TestCase):
+    class Plugin(object):
+        def build(self):
+            run_cmd('sleep', '0.1')
+            run_cmd('true')
+
+    class Context(object):
+        def __init__(self, plugins):
+            self.plugins = plugins
+            self.hooks = {}
+
+    def setUp(self):
+        (fd, self.report) = tempfile.mkstemp()
+        os.close(fd)
+        self.imagedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        VMBuilder.profiler.profiler = None
+        os.unlink(self.report)
+        for filename in os.listdir(self.imagedir):
+            os.unlink(os.path.join(self.imagedir, filename))
+        os.rmdir(self.imagedir)
+
+    def test_report(self):
+        profiler = VMBuilder.profiler.start()
+        call_hooks(self.Context([self.Plugin()]), 'build')
+        fp = open(os.path.join(self.imagedir, 'disk0.img'), 'w')
+        fp.write('x' * 8192)
+        fp.close()
+        profiler.measure_images(self.imagedir)
+        VMBuilder.profiler.stop(self.report)
+        self.assertEqual(VMBuilder.profiler.profiler, None)
+
+        report = json.load(open(self.report))
+        categories = [event['cat'] for event in report['traceEvents']]
+        self.assertEqual(sorted(categories), ['command', 'command', 'hook', 'plugin'])
+        for event in report['traceEvents']:
+            self.assertEqual(event['ph'], 'X')
+            self.assertEqual(event['args']['hook'], 'build')
+
+        summary = report['summary']
+        self.assertEqual(summary['commands'], 2)
+        self.assertEqual(summary['slowest_commands'][0]['argv'], ['sleep', '0.1'])
+        self.assertEqual(summary['slowest_commands'][0]['plugin'], self.Plugin.__module__)
+        self.assertTrue(summary['slowest_commands'][0]['time'] >= 0.1)
+        self.assertTrue(summary['hooks']['build'] >= 0.1)
+        self.assertEqual(summary['image_bytes_written'], 8192)
+
+    def test_inactive(self):
+        self.assertEqual(VMBuilder.profiler.profiler, None)
+        call_hooks(self.Context([self.Plugin()]), 'build')
+        VMBuilder.profiler.stop(self.report)
+        self.assertEqual(os.stat(self.report).st_size, 0)
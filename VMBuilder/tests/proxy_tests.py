@@ -0,0 +1,139 @@
+#
+#    Uncomplicated VM Builder
+#    Copyright (C) 2007-2009 Canonical Ltd.
+#    
+#    See AUTHORS for list of contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import BaseHTTPServer
+import shutil
+import SocketServer
+import tempfile
+import threading
+import unittest
+import urllib2
+
+from VMBuilder.disk  import wait_for
+from VMBuilder.proxy import CachingProxy, ContentStore, classify
+
+class StubOriginHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the files in server.files, honouring If-None-Match
+    """
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('If-None-Match')))
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        body = self.server.files[self.path]
+        etag = '"%d"' % hash(body)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class StubOrigin(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class TestCachingProxy(unittest.TestCase):
+    def setUp(self):
+        self.origin = StubOrigin(('127.0.0.1', 0), StubOriginHandler)
+        self.origin.requests = []
+        self.origin.files = { '/pool/foo.deb' : 'foo' * 1000,
+                              '/pool/bar.deb' : 'bar' * 1000,
+                              '/dists/lucid/Release' : 'release 1',
+                              '/other' : 'other' }
+        thread = threading.Thread(target=self.origin.serve_forever, kwargs={ 'poll_interval' : 0.05 })
+        thread.daemon = True
+        thread.start()
+        self.base = 'http://127.0.0.1:%d' % self.origin.server_port
+
+        self.directory = tempfile.mkdtemp()
+        self.proxy = CachingProxy(ContentStore(self.directory, 1))
+        self.proxy.start()
+        self.opener = urllib2.build_opener(urllib2.ProxyHandler({ 'http' : self.proxy.url }))
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.origin.shutdown()
+        self.origin.server_close()
+        shutil.rmtree(self.directory)
+
+    def get(self, path, stored=True):
+        """
+        Fetches path through the proxy and, if it should be stored, waits
+        until it is (which happens after the client has got it all).
+        """
+        data = self.opener.open(self.base + path).read()
+        if stored:
+            wait_for(lambda: self.proxy.store.get_meta(self.base + path), timeout=5)
+        return data
+
+    def test_classify(self):
+        self.assertEqual(classify('http://archive/pool/main/f/foo_1.0_amd64.deb'), 'package')
+        self.assertEqual(classify('http://mirror/5/os/x86_64/CentOS/foo-1.0.x86_64.rpm'), 'package')
+        self.assertEqual(classify('http://archive/dists/lucid/main/binary-amd64/Packages.bz2'), 'metadata')
+        self.assertEqual(classify('http://mirror/5/os/x86_64/repodata/primary.xml.gz'), 'metadata')
+        self.assertEqual(classify('http://archive/index.html'), None)
+
+    def test_packages_are_served_from_the_store(self):
+        self.assertEqual(self.get('/pool/foo.deb'), 'foo' * 1000)
+        self.assertEqual(self.get('/pool/foo.deb'), 'foo' * 1000)
+        self.assertEqual(self.origin.requests, [('/pool/foo.deb', None)])
+        self.assertEqual(self.proxy.stats['hits'], 1)
+
+    def test_metadata_is_revalidated(self):
+        self.assertEqual(self.get('/dists/lucid/Release'), 'release 1')
+        self.assertEqual(self.get('/dists/lucid/Release'), 'release 1')
+        self.assertEqual(len(self.origin.requests), 2)
+        self.assertNotEqual(self.origin.requests[1][1], None, 'Second request was not conditional')
+        self.assertEqual(self.proxy.stats['revalidated'], 1)
+
+        self.origin.files['/dists/lucid/Release'] = 'release 2'
+        self.assertEqual(self.get('/dists/lucid/Release'), 'release 2')
+
+    def test_other_files_are_passed_through(self):
+        self.assertEqual(self.get('/other', stored=False), 'other')
+        self.assertEqual(self.get('/other', stored=False), 'other')
+        self.assertEqual(len(self.origin.requests), 2)
+        self.assertEqual(len(self.proxy.store.entries()), 0)
+
+    def test_errors_are_relayed(self):
+        try:
+            self.get('/pool/missing.deb', stored=False)
+            self.fail('No error for a missing file')
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 404)
+        self.assertEqual(len(self.proxy.store.entries()), 0)
+
+    def test_same_contents_are_stored_once(self):
+        self.origin.files['/mirror2/pool/foo.deb'] = self.origin.files['/pool/foo.deb']
+        self.get('/pool/foo.deb')
+        self.get('/mirror2/pool/foo.deb')
+        self.assertEqual(len(self.proxy.store.entries()), 1)
+
+    def test_least_recently_used_files_are_evicted(self):
+        self.proxy.store.max_size = 0
+        self.get('/pool/foo.deb')
+        self.get('/pool/bar.deb')
+        self.assertEqual(len(self.proxy.store.entries()), 1)
+        self.get('/pool/foo.deb')
+        self.assertEqual([path for (path, etag) in self.origin.requests], ['/pool/foo.deb', '/pool/bar.deb', '/pool/foo.deb'])
@@ -0,0 +1,100 @@
+import os
+import struct
+import tempfile
+import unittest
+
+from VMBuilder.qcow2 import convert, CLUSTER_SIZE, QCOW_MAGIC, QCOW_OFLAG_COPIED
+
+def get_temp_filename():
+    (fd, tmpfile) = tempfile.mkstemp()
+    os.close(fd)
+    return tmpfile
+
+def read_qcow2(filename):
+    """Returns the virtual contents of a qcow2 image and the refcount of each of its clusters"""
+    fp = open(filename, 'rb')
+    (magic, version, backing_file_offset, backing_file_size, cluster_bits,
+     size, crypt_method, l1_size, l1_offset, refcount_table_offset,
+     refcount_table_clusters, nb_snapshots, snapshots_offset) = struct.unpack('>IIQIIQIIQQIIQ', fp.read(72))
+    assert magic == QCOW_MAGIC and version == 2 and cluster_bits == 16
+
+    def read_at(offset, length):
+        fp.seek(offset)
+        return fp.read(length)
+
+    contents = ['\0' * CLUSTER_SIZE] * ((size + CLUSTER_SIZE - 1) / CLUSTER_SIZE)
+    l1 = struct.unpack('>%dQ' % l1_size, read_at(l1_offset, l1_size * 8))
+    for (l1_index, l2_offset) in enumerate(l1):
+        if not l2_offset:
+            continue
+        l2 = struct.unpack('>%dQ' % (CLUSTER_SIZE / 8), read_at(l2_offset & ~QCOW_OFLAG_COPIED, CLUSTER_SIZE))
+        for (l2_index, data_offset) in enumerate(l2):
+            if data_offset:
+                contents[l1_index * CLUSTER_SIZE / 8 + l2_index] = read_at(data_offset & ~QCOW_OFLAG_COPIED, CLUSTER_SIZE)
+
+    refcounts = []
+    table = struct.unpack('>%dQ' % (refcount_table_clusters * CLUSTER_SIZE / 8),
+                          read_at(refcount_table_offset, refcount_table_clusters * CLUSTER_SIZE))
+    for block_offset in table:
+        if block_offset:
+            refcounts += struct.unpack('>%dH' % (CLUSTER_SIZE / 2), read_at(block_offset, CLUSTER_SIZE))
+    fp.seek(0, 2)
+    nclusters = fp.tell() / CLUSTER_SIZE
+    fp.close()
+    return (''.join(contents)[:size], refcounts[:nclusters], refcounts[nclusters:])
+
+class TestQcow2(unittest.TestCase):
+    def setUp(self):
+        self.src = get_temp_filename()
+        self.dest = get_temp_filename()
+
+    def tearDown(self):
+        for filename in [self.src, self.dest]:
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+    def write_source(self, chunks, size):
+        fp = open(self.src, 'w')
+        fp.truncate(size)
+        for (offset, data) in chunks:
+            fp.seek(offset)
+            fp.write(data)
+        fp.close()
+
+    def check_conversion(self, size):
+        expected = open(self.src).read()
+        convert(self.src, self.dest)
+        (contents, refcounts, unused) = read_qcow2(self.dest)
+        self.assertEqual(contents, expected)
+        self.assertEqual(refcounts, [1] * len(refcounts))
+        self.assertFalse([r for r in unused if r])
+
+    def test_sparse_image(self):
+        size = 1024 * 1024 * 1024
+        self.write_source([(0, 'bootsector'), (5 * CLUSTER_SIZE + 17, 'x' * 100000), (size - 3, 'end')], size)
+        self.check_conversion(size)
+        # Only the header, 4 data clusters and the metadata are stored
+        self.assertTrue(os.stat(self.dest).st_size < 16 * CLUSTER_SIZE)
+
+    def test_zero_clusters_are_skipped(self):
+        size = 4 * CLUSTER_SIZE
+        self.write_source([(0, '\0' * size), (CLUSTER_SIZE, 'data')], size)
+        self.check_conversion(size)
+        (bytes_read, bytes_written) = convert(self.src, self.dest)
+        self.assertEqual(bytes_read, size)
+        # header, one data cluster, L2, L1, refcount block and table
+        self.assertEqual(bytes_written, 6 * CLUSTER_SIZE)
+
+    def test_size_not_cluster_aligned(self):
+        size = 3 * CLUSTER_SIZE + 512
+        self.write_source([(size - 512, 'y' * 512)], size)
+        self.check_conversion(size)
+
+    def test_punch_holes(self):
+        size = 128 * 1024 * 1024
+        self.write_source([(0, 'z' * size)], size)
+        expected = open(self.src).read()
+        convert(self.src, self.dest, punch_holes=True)
+        (contents, refcounts, unused) = read_qcow2(self.dest)
+        self.assertEqual(contents, expected)
+        self.assertTrue(os.stat(self.src).st_blocks * 512 < size)
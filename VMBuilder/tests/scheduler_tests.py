@@ -0,0 +1,55 @@
+import threading
+import time
+import unittest
+
+from VMBuilder.exception import VMBuilderException
+from VMBuilder.scheduler import Stage, run_stages
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.log = []
+        self.lock = threading.Lock()
+
+    def step(self, name, delay=0, fail=False):
+        def func():
+            self.record('start %s' % name)
+            time.sleep(delay)
+            if fail:
+                raise VMBuilderException('%s failed' % name)
+            self.record('end %s' % name)
+        return func
+
+    def record(self, entry):
+        self.lock.acquire()
+        self.log.append(entry)
+        self.lock.release()
+
+    def test_dependencies_and_overlap(self):
+        run_stages([Stage('chroot', self.step('chroot', 0.2)),
+                    Stage('disks', self.step('disks', 0.1)),
+                    Stage('install', self.step('install'), after=['chroot', 'disks'])])
+        self.assertEqual(sorted(self.log[:2]), ['start chroot', 'start disks'])
+        self.assertEqual(self.log[2:], ['end disks', 'end chroot', 'start install', 'end install'])
+
+    def test_failure_cleans_up_finished_stages(self):
+        stages = [Stage('chroot', self.step('chroot', 0.2, fail=True)),
+                  Stage('disks', self.step('disks'), cleanup=lambda: self.record('cleanup disks')),
+                  Stage('install', self.step('install'), after=['chroot', 'disks'],
+                        cleanup=lambda: self.record('cleanup install'))]
+        self.assertRaises(VMBuilderException, run_stages, stages)
+        self.assertTrue('start install' not in self.log)
+        self.assertEqual(self.log[-1], 'cleanup disks')
+
+    def test_failed_stage_cleans_up_right_away(self):
+        stages = [Stage('chroot', self.step('chroot', 0.3)),
+                  Stage('disks', self.step('disks', fail=True), cleanup=lambda: self.record('cleanup disks'))]
+        self.assertRaises(VMBuilderException, run_stages, stages)
+        self.assertTrue(self.log.index('cleanup disks') < self.log.index('end chroot'))
+
+    def test_unknown_dependency(self):
+        self.assertRaises(VMBuilderException, run_stages, [Stage('install', self.step('install'), after=['chroot'])])
+        self.assertEqual(self.log, [])
+
+    def test_cycle(self):
+        self.assertRaises(VMBuilderException, run_stages, [Stage('a', self.step('a'), after=['b']),
+                                                           Stage('b', self.step('b'), after=['a'])])
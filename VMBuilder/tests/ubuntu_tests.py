@@ -19,10 +19,14 @@
 #    Tests, tests, tests, and more tests
 
 import logging
+import os
+import shutil
+import tempfile
 import unittest
 
 import VMBuilder
 
+from VMBuilder.plugins.ubuntu.dapper import Dapper
 from VMBuilder.plugins.ubuntu.distro import Ubuntu
 from VMBuilder.exception import VMBuilderUserError
 from VMBuilder import set_console_loglevel
@@ -37,3 +41,32 @@ class TestUbuntuPlugin(unittest.TestCase):
         ubuntu = Ubuntu()
         ubuntu.set_setting('suite', 'foo')
         self.assertRaises(VMBuilderUserError, ubuntu.preflight_check)
+
+class TestAptProxy(unittest.TestCase):
+    def setUp(self):
+        self.chroot_dir = tempfile.mkdtemp()
+        os.makedirs('%s/etc/apt' % self.chroot_dir)
+        self.ubuntu = Ubuntu()
+        self.ubuntu.set_chroot_dir(self.chroot_dir)
+        self.suite = Dapper(self.ubuntu)
+        self.apt_conf = '%s/etc/apt/apt.conf' % self.chroot_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.chroot_dir)
+
+    def test_build_proxy_is_removed_from_final_config(self):
+        self.ubuntu.build_proxy = 'http://127.0.0.1:3142/'
+        self.suite.install_apt_proxy()
+        self.assertTrue('127.0.0.1:3142' in open(self.apt_conf).read())
+
+        self.ubuntu.build_proxy = None
+        self.suite.install_apt_proxy(final=True)
+        self.assertFalse(os.path.exists(self.apt_conf))
+
+    def test_proxy_setting_is_kept_in_final_config(self):
+        self.ubuntu.set_setting('proxy', 'http://proxy.example.com:3128/')
+        self.ubuntu.build_proxy = 'http://127.0.0.1:3142/'
+        self.suite.install_apt_proxy()
+        self.ubuntu.build_proxy = None
+        self.suite.install_apt_proxy(final=True)
+        self.assertTrue('proxy.example.com' in open(self.apt_conf).read())
@@ -1,10 +1,175 @@
+import os
+import shutil
+import tempfile
 import unittest
 
 import VMBuilder
-from VMBuilder.util import run_cmd
+from VMBuilder.exception import VMBuilderException
+from VMBuilder.util import run_cmd, run_parallel, copy_file_range_sparse, place_image, ChrootSession
+from VMBuilder.util import NonBlockingFile, LOG_LINES_PER_SECOND, template_path, memoize
 
 class TestUtils(unittest.TestCase):
     def test_run_cmd(self):
         self.assertTrue("foobarbaztest" in run_cmd("env", env={'foobarbaztest' : 'bar' }))
 
+    def test_run_cmd_large_output(self):
+        output = run_cmd('sh', '-c', 'yes line | head -n 1000000', log_output=False)
+        self.assertEqual(output, 'line\n' * 1000000)
 
+    def test_run_cmd_max_output(self):
+        output = run_cmd('sh', '-c', 'seq 100000', max_output=1000, log_output=False)
+        self.assertTrue(1000 <= len(output) < 1000 + 64 * 1024)
+        self.assertTrue(output.endswith('\n99999\n100000\n'))
+
+    def test_run_cmd_no_capture(self):
+        self.assertEqual(run_cmd('echo', 'foo', capture=False), None)
+
+    def test_run_cmd_error_has_stderr_tail(self):
+        try:
+            run_cmd('sh', '-c', 'seq 200000 >&2; echo lastline >&2; exit 1', log_output=False)
+        except VMBuilderException, e:
+            self.assertTrue(str(e).endswith('lastline\n'))
+            self.assertTrue(len(str(e)) < 128 * 1024)
+        else:
+            self.fail('run_cmd did not raise')
+
+    def test_run_cmd_log_rate_limit(self):
+        lines = []
+        fp = NonBlockingFile(open('/dev/null'), logfunc=lines.append)
+        for i in range(LOG_LINES_PER_SECOND * 2):
+            fp.log_line(str(i))
+        fp.log_suppressed()
+        self.assertEqual(len(lines), LOG_LINES_PER_SECOND + 1)
+        self.assertEqual(lines[-1], '(%d lines of output not logged)' % LOG_LINES_PER_SECOND)
+
+    def test_run_parallel_keeps_order(self):
+        funcs = [lambda x=x: x * 2 for x in range(10)]
+        self.assertEqual(run_parallel(funcs, 3), [x * 2 for x in range(10)])
+
+    def test_run_parallel_raises_first_error(self):
+        def fail():
+            raise VMBuilderException('failed')
+        self.assertRaises(VMBuilderException, run_parallel, [lambda: 1, fail, lambda: 2], 2)
+
+    def test_place_image_renames_on_same_filesystem(self):
+        tmpdir = tempfile.mkdtemp()
+        src = '%s/src.img' % tmpdir
+        dest = '%s/dest.img' % tmpdir
+        open(src, 'w').write('image')
+        try:
+            self.assertEqual(place_image(src, dest), 'rename')
+            self.assertFalse(os.path.exists(src))
+            self.assertEqual(open(dest).read(), 'image')
+        finally:
+            os.unlink(dest)
+            os.rmdir(tmpdir)
+
+    def test_copy_file_range_sparse_keeps_holes(self):
+        size = 64 * 1024 * 1024
+        (src_fd, src) = tempfile.mkstemp()
+        (dest_fd, dest) = tempfile.mkstemp()
+        try:
+            os.ftruncate(src_fd, size)
+            os.lseek(src_fd, 32 * 1024 * 1024, 0)
+            os.write(src_fd, 'data in the middle')
+            if not copy_file_range_sparse(src_fd, dest_fd, size):
+                return
+            self.assertEqual(open(dest).read(), open(src).read())
+            self.assertTrue(os.fstat(dest_fd).st_blocks * 512 < size / 2)
+        finally:
+            os.close(src_fd)
+            os.close(dest_fd)
+            os.unlink(src)
+            os.unlink(dest)
+
+class TestMemoize(unittest.TestCase):
+    def test_computes_once_per_argument(self):
+        calls = []
+        def double(x):
+            calls.append(x)
+            return 2 * x
+        double = memoize(double)
+
+        self.assertEqual(double(2), 4)
+        self.assertEqual(double(2), 4)
+        self.assertEqual(double(3), 6)
+        self.assertEqual(calls, [2, 3])
+
+    def test_exceptions_are_not_remembered(self):
+        calls = []
+        def fail():
+            calls.append(None)
+            raise VMBuilderException('failed')
+        fail = memoize(fail)
+
+        self.assertRaises(VMBuilderException, fail)
+        self.assertRaises(VMBuilderException, fail)
+        self.assertEqual(len(calls), 2)
+
+class TestTemplatePath(unittest.TestCase):
+    class Context(object):
+        pass
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.context = self.Context()
+        self.context.template_dirs = ['%s/user/%%s' % self.tmpdir, '%s/system/%%s' % self.tmpdir]
+        for dir in ['user', 'system']:
+            os.makedirs('%s/%s/kvm' % (self.tmpdir, dir))
+        self.add_template('system', 'libvirtxml')
+        self.add_template('system', 'sources')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def add_template(self, dir, name):
+        path = '%s/%s/kvm/%s.tmpl' % (self.tmpdir, dir, name)
+        open(path, 'w').write('$name\n')
+        return path
+
+    def test_earlier_dirs_win(self):
+        self.add_template('user', 'sources')
+        self.assertEqual(template_path('kvm', self.context, 'sources')[0], '%s/user/kvm/sources.tmpl' % self.tmpdir)
+        self.assertEqual(template_path('kvm', self.context, 'libvirtxml')[0], '%s/system/kvm/libvirtxml.tmpl' % self.tmpdir)
+
+    def test_index_notices_changes(self):
+        self.assertRaises(VMBuilderException, template_path, 'kvm', self.context, 'new')
+        path = self.add_template('system', 'new')
+        self.assertEqual(template_path('kvm', self.context, 'new')[0], path)
+        os.unlink(path)
+        self.assertRaises(VMBuilderException, template_path, 'kvm', self.context, 'new')
+
+    def test_template_dirs_change(self):
+        self.assertEqual(template_path('kvm', self.context, 'sources')[0], '%s/system/kvm/sources.tmpl' % self.tmpdir)
+        os.makedirs('%s/extra/kvm' % self.tmpdir)
+        path = self.add_template('extra', 'sources')
+        self.context.template_dirs.insert(0, '%s/extra/%%s' % self.tmpdir)
+        self.assertEqual(template_path('kvm', self.context, 'sources')[0], path)
+
+class TestChrootSession(unittest.TestCase):
+    def setUp(self):
+        if os.geteuid() != 0:
+            self.skipTest('chroot requires root')
+        self.session = ChrootSession('/', env={ 'SESSIONTEST' : 'session' })
+
+    def tearDown(self):
+        self.session.close()
+        self.assertFalse(os.path.exists(self.session.workdir))
+
+    def test_batch_returns_each_stdout(self):
+        self.assertEqual(self.session.run_batch([['echo', 'one'],
+                                                 (['cat'], { 'stdin' : 'two\n' }),
+                                                 (['sh', '-c', 'echo $SESSIONTEST $EXTRA'], { 'env' : { 'EXTRA' : "it's" } })]),
+                         ['one\n', 'two\n', "session it's\n"])
+
+    def test_failure_stops_batch(self):
+        marker = tempfile.mktemp()
+        self.assertRaises(VMBuilderException, self.session.run_batch, [['false'], ['touch', marker]])
+        self.assertFalse(os.path.exists(marker))
+        # The session is still usable afterwards
+        self.assertEqual(self.session.run('echo', 'again'), 'again\n')
+
+    def test_ignore_fail(self):
+        self.assertEqual(self.session.run_batch([(['sh', '-c', 'echo out; exit 3'], { 'ignore_fail' : True }),
+                                                 ['echo', 'next']]),
+                         ['out\n', 'next\n'])
@@ -17,23 +17,65 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 #    Various utility functions
+import collections
 import ConfigParser
+import ctypes
+import ctypes.util
 import errno
 import fcntl
 import logging
 import os.path
+import pipes
 import select
+import shutil
 import subprocess
+import sys
 import tempfile
+import threading
+import time
+import uuid
+import VMBuilder.profiler
 from   exception        import VMBuilderException, VMBuilderUserError
 
+# How much to read from a pipe at a time
+READ_SIZE = 64 * 1024
+
+# How much of a failed command's output to put in the error message
+ERROR_TAIL_BYTES = 64 * 1024
+
+# Output lines beyond this rate are counted instead of logged
+LOG_LINES_PER_SECOND = 200
+
 class NonBlockingFile(object):
-    def __init__(self, fp, logfunc):
+    """
+    Collects what a process writes to one of its pipes.
+
+    The output is kept as a list of chunks, so that collecting it takes
+    time linear in its size, and only as much of it as is needed.
+
+    @type  logfunc: function
+    @param logfunc: Called with each line of output, at most
+                    L{LOG_LINES_PER_SECOND} times a second. None to not
+                    log the output.
+    @type  capture: boolean
+    @param capture: Whether to keep the output at all
+    @type  max_bytes: number
+    @param max_bytes: Keep only (roughly) the last max_bytes of the
+                      output. None to keep all of it.
+    """
+    def __init__(self, fp, logfunc, capture=True, max_bytes=None):
         self.file = fp
         self.set_non_blocking()
-        self.buf = ''
-        self.logbuf = ''
         self.logfunc = logfunc
+        self.capture = capture
+        self.max_bytes = max_bytes
+        self.chunks = collections.deque()
+        self.size = 0
+        self.truncated = False
+        self.partial_line = []
+        self.window_start = 0
+        self.window_lines = 0
+        self.suppressed_lines = 0
 
     def set_non_blocking(self):
         flags = fcntl.fcntl(self.file, fcntl.F_GETFL)
@@ -47,17 +89,79 @@ class NonBlockingFile(object):
             raise AttributeError()
 
     def process_input(self):
-        data = self.file.read()
+        try:
+            data = os.read(self.file.fileno(), READ_SIZE)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
         if data == '':
             self.file.close()
-            if self.logbuf:
-                self.logfunc(self.logbuf)
+            if self.logfunc:
+                line = ''.join(self.partial_line)
+                if line:
+                    self.log_line(line)
+                self.log_suppressed()
+            return
+
+        if self.capture:
+            self.chunks.append(data)
+            self.size += len(data)
+            if self.max_bytes is not None:
+                while self.size - len(self.chunks[0]) >= self.max_bytes:
+                    self.size -= len(self.chunks.popleft())
+                    self.truncated = True
+
+        if self.logfunc:
+            if '\n' not in data:
+                self.partial_line.append(data)
+            else:
+                lines = data.split('\n')
+                lines[0] = ''.join(self.partial_line) + lines[0]
+                self.partial_line = [lines.pop()]
+                for line in lines:
+                    self.log_line(line)
+
+    def log_line(self, line):
+        now = time.time()
+        if now - self.window_start >= 1:
+            self.log_suppressed()
+            self.window_start = now
+            self.window_lines = 0
+        if self.window_lines < LOG_LINES_PER_SECOND:
+            self.window_lines += 1
+            self.logfunc(line)
         else:
-            self.buf += data
-            self.logbuf += data
-            while '\n' in self.logbuf:
-                line, self.logbuf = self.logbuf.split('\n', 1)
-                self.logfunc(line)
+            self.suppressed_lines += 1
+
+    def log_suppressed(self):
+        if self.suppressed_lines:
+            self.logfunc('(%d lines of output not logged)' % self.suppressed_lines)
+            self.suppressed_lines = 0
+
+    def output(self):
+        """
+        @rtype:  string
+        @return: the captured output
+        """
+        return ''.join(self.chunks)
+
+    def tail(self, nbytes):
+        """
+        @rtype:  string
+        @return: the last nbytes of the captured output
+        """
+        chunks = []
+        size = 0
+        for chunk in reversed(self.chunks):
+            if size >= nbytes:
+                break
+            chunks.insert(0, chunk)
+            size += len(chunk)
+        data = ''.join(chunks)
+        if len(data) > nbytes or self.truncated:
+            return '...' + data[-nbytes:]
+        return data
 
 def run_cmd(*argv, **kwargs):
     """
@@ -73,16 +177,22 @@ def run_cmd(*argv, **kwargs):
                         cause an exception to be raised.
     @type  env: dict
     @param env: Dictionary of extra environment variables to set in the new process
+    @type  capture: boolean
+    @param capture: If False, stdout is not kept (and None is returned)
+    @type  max_output: number
+    @param max_output: Keep only the last max_output bytes of stdout
+    @type  log_output: boolean
+    @param log_output: If False, the output is not logged line by line
 
     @rtype:  string
     @return: string containing the stdout of the process
     """
 
     env = kwargs.get('env', {})
-    print argv
-    print kwargs
     stdin = kwargs.get('stdin', None)
     ignore_fail = kwargs.get('ignore_fail', False)
+    capture = kwargs.get('capture', True)
+    log_output = kwargs.get('log_output', True)
     args = [str(arg) for arg in argv]
     logging.debug(args.__repr__())
     if stdin:
@@ -95,6 +205,11 @@ def run_cmd(*argv, **kwargs):
     proc_env['LC_ALL'] = 'C'
     proc_env.update(env)
 
+    profiler = VMBuilder.profiler.profiler
+    if profiler:
+        start = time.time()
+        start_cpu = VMBuilder.profiler.children_cpu_time()
+
     try:
         proc = subprocess.Popen(args, stdin=stdin_arg, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=proc_env)
     except OSError, error:
@@ -107,8 +222,11 @@ def run_cmd(*argv, **kwargs):
         proc.stdin.write(stdin)
         proc.stdin.close()
 
-    mystdout = NonBlockingFile(proc.stdout, logfunc=logging.debug)
-    mystderr = NonBlockingFile(proc.stderr, logfunc=(ignore_fail and logging.debug or logging.info))
+    mystdout = NonBlockingFile(proc.stdout, logfunc=(log_output and logging.debug or None),
+                               capture=capture, max_bytes=kwargs.get('max_output', None))
+    # stderr is only needed for error messages
+    mystderr = NonBlockingFile(proc.stderr, logfunc=(log_output and (ignore_fail and logging.debug or logging.info) or None),
+                               max_bytes=ERROR_TAIL_BYTES)
 
     while not (mystdout.closed and mystderr.closed):
         # Block until either of them has something to offer
@@ -118,9 +236,131 @@ def run_cmd(*argv, **kwargs):
                 fp.process_input()
 
     status = proc.wait()
+    if profiler:
+        profiler.record_command(args, start, start_cpu, status)
     if not ignore_fail and status != 0:
-        raise VMBuilderException, "Process (%s) returned %d. stdout: %s, stderr: %s" % (args.__repr__(), status, mystdout.buf, mystderr.buf)
-    return mystdout.buf
+        raise VMBuilderException, "Process (%s) returned %d. stdout: %s, stderr: %s" % (args.__repr__(), status, mystdout.tail(ERROR_TAIL_BYTES), mystderr.tail(ERROR_TAIL_BYTES))
+    if not capture:
+        return None
+    return mystdout.output()
+
+class ChrootSession(object):
+    """
+    A shell running inside a chroot that runs batches of commands, so
+    that a series of small steps (mknod, adduser, ...) costs a single
+    launch of chroot instead of one per step.
+
+    Each command's stdin, stdout and stderr go through files in a
+    private directory inside the chroot. After each command, the shell
+    prints a marker line with its exit status on the pipe we read.
+
+    @type  chroot_dir: string
+    @param chroot_dir: The chroot to run commands in
+    @type  env: dict
+    @param env: Extra environment variables for all commands
+    """
+    def __init__(self, chroot_dir, env={}):
+        self.chroot_dir = chroot_dir
+        self.workdir = tempfile.mkdtemp(prefix='.vmbuilder-session', dir=chroot_dir)
+        self.target_workdir = '/%s' % os.path.basename(self.workdir)
+        self.marker = 'VMBUILDER-SESSION-%s' % uuid.uuid4().hex
+        proc_env = dict(os.environ)
+        proc_env['LANG'] = 'C'
+        proc_env['LC_ALL'] = 'C'
+        proc_env.update(env)
+        try:
+            self.proc = subprocess.Popen(['chroot', chroot_dir, '/bin/sh'], stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=proc_env)
+        except OSError, error:
+            shutil.rmtree(self.workdir)
+            raise VMBuilderUserError, "Couldn't launch chroot: %s" % (error,)
+
+    def command_line(self, index, argv, kwargs):
+        """
+        @rtype:  string
+        @return: the shell command running argv as command number index
+        """
+        prefix = '%s/%d' % (self.target_workdir, index)
+        stdin = kwargs.get('stdin', None)
+        if stdin:
+            fp = open('%s/%d.in' % (self.workdir, index), 'w')
+            fp.write(stdin)
+            fp.close()
+            stdin_file = '%s.in' % prefix
+        else:
+            stdin_file = '/dev/null'
+        assignments = ['%s=%s' % (key, pipes.quote(str(value))) for (key, value) in kwargs.get('env', {}).items()]
+        return '%s <%s >%s.out 2>%s.err' % (' '.join(assignments + [pipes.quote(str(arg)) for arg in argv]),
+                                            stdin_file, prefix, prefix)
+
+    def read_output(self, index, name, logfunc):
+        fp = open('%s/%d.%s' % (self.workdir, index, name))
+        data = fp.read()
+        fp.close()
+        for line in data.splitlines():
+            logfunc(line)
+        return data
+
+    def run_batch(self, commands):
+        """
+        Runs commands one after the other, stopping at the first one that
+        fails (unless it was run with ignore_fail).
+
+        @type  commands: list
+        @param commands: argv lists, or (argv, kwargs) tuples where kwargs
+                         holds the L{run_cmd} keyword arguments stdin,
+                         ignore_fail and env for that command
+        @rtype:  list
+        @return: the stdout of each command
+        """
+        commands = [isinstance(cmd, tuple) and cmd or (cmd, {}) for cmd in commands]
+        # The loop is only there so that break can end the batch
+        script = ['while :; do']
+        for (index, (argv, kwargs)) in enumerate(commands):
+            logging.debug(repr(['chroot', self.chroot_dir] + [str(arg) for arg in argv]))
+            script.append('%s; s=$?; echo "%s %d $s"' % (self.command_line(index, argv, kwargs), self.marker, index))
+            if not kwargs.get('ignore_fail', False):
+                script.append('[ $s -eq 0 ] || break')
+        script += ['break', 'done', 'echo "%s end"' % self.marker, '']
+        self.proc.stdin.write('\n'.join(script))
+        self.proc.stdin.flush()
+
+        statuses = {}
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                raise VMBuilderException('The shell in %s exited unexpectedly' % (self.chroot_dir,))
+            if not line.startswith(self.marker):
+                logging.info(line.rstrip('\n'))
+                continue
+            fields = line.split()
+            if fields[1] == 'end':
+                break
+            statuses[int(fields[1])] = int(fields[2])
+
+        retval = []
+        for (index, (argv, kwargs)) in enumerate(commands):
+            if index not in statuses:
+                break
+            ignore_fail = kwargs.get('ignore_fail', False)
+            stdout = self.read_output(index, 'out', logging.debug)
+            stderr = self.read_output(index, 'err', ignore_fail and logging.debug or logging.info)
+            if not ignore_fail and statuses[index] != 0:
+                raise VMBuilderException, "Process (%s) returned %d. stdout: %s, stderr: %s" % (repr(['chroot', self.chroot_dir] + [str(arg) for arg in argv]), statuses[index], stdout, stderr)
+            retval.append(stdout)
+        return retval
+
+    def run(self, *argv, **kwargs):
+        """
+        Runs a single command, like L{run_cmd}.
+        """
+        return self.run_batch([(argv, kwargs)])[0]
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
+        shutil.rmtree(self.workdir)
 
 def checkroot():
     """
@@ -130,7 +370,93 @@ def checkroot():
     if os.geteuid() != 0:
         raise VMBuilderUserError("This script must be run as root (e.g. via sudo)")
 
+def memoize(func):
+    """
+    Makes func remember its return value for each tuple of arguments
+    for the rest of the process's life. Exceptions aren't remembered.
+    """
+    results = {}
+    def wrapper(*args):
+        if args not in results:
+            results[args] = func(*args)
+        return results[args]
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+class LazyDefault(object):
+    """
+    A setting default that is only computed when it is first needed
+    (see L{VMBuilder.plugins.Plugin.Setting.get_default}), for defaults
+    that cost a subprocess or a host lookup.
+
+    @type  func: function
+    @param func: Computes the default (called without arguments)
+    @type  description: string
+    @param description: Describes the default (e.g. in --help output)
+    """
+    def __init__(self, func, description):
+        self.func = func
+        self.description = description
+
+    def __str__(self):
+        return self.description
+
+@memoize
+def host_arch():
+    """
+    @rtype:  string
+    @return: The host's Debian architecture name (e.g. amd64)
+    """
+    return run_cmd('dpkg', '--print-architecture').rstrip()
+
+# (template dirs, plugin) -> { template name : path }, see template_path
+_template_index = {}
+# (path, mtime) -> compiled Cheetah template class, see render_template
+_template_classes = {}
+
+def template_index(plugin, template_dirs):
+    """
+    @rtype:  dict
+    @return: the path of each template available to plugin, by name.
+             Templates in earlier template_dirs win.
+    """
+    key = (tuple(template_dirs), plugin)
+    if key not in _template_index:
+        index = {}
+        for dir in reversed([dir % plugin for dir in template_dirs]):
+            try:
+                names = os.listdir(dir)
+            except OSError:
+                continue
+            for name in names:
+                if name.endswith('.tmpl'):
+                    index[name[:-len('.tmpl')]] = '%s/%s' % (dir, name)
+        _template_index[key] = index
+    return _template_index[key]
+
+def template_path(plugin, context, tmplname):
+    """
+    @rtype:  tuple
+    @return: the path and mtime of the template tmplname for plugin
+    """
+    for attempt in range(2):
+        path = template_index(plugin, context.template_dirs).get(tmplname)
+        if path:
+            try:
+                return (path, os.stat(path).st_mtime)
+            except OSError:
+                pass
+        # Templates may have been added or removed since the index was built
+        _template_index.pop((tuple(context.template_dirs), plugin), None)
+    raise VMBuilderException('Template %s.tmpl not found in any of %s' % (tmplname, ', '.join([dir % plugin for dir in context.template_dirs])))
+
 def render_template(plugin, context, tmplname, extra_context=None):
+    """
+    Renders the template tmplname of plugin. Each template is compiled
+    once per process (and again if it changes); after that, rendering
+    it is just a matter of filling it in.
+    """
     # Import here to avoid having to build-dep on python-cheetah
     from   Cheetah.Template import Template
     searchList = []
@@ -138,33 +464,202 @@ def render_template(plugin, context, tmplname, extra_context=None):
         searchList.append(extra_context)
     searchList.append(context)
 
-#        tmpldirs.insert(0,'%s/%%s' % vm.templates)
-    
-    tmpldirs = [dir % plugin for dir in context.template_dirs]
-
-    for dir in tmpldirs:
-        tmplfile = '%s/%s.tmpl' % (dir, tmplname)
-        if os.path.exists(tmplfile):
-            t = Template(file=tmplfile, searchList=searchList)
-            output = t.respond()
-            logging.debug('Output from template \'%s\': %s' % (tmplfile, output))
-            return output
-
-    raise VMBuilderException('Template %s.tmpl not found in any of %s' % (tmplname, ', '.join(tmpldirs)))
+    (tmplfile, mtime) = template_path(plugin, context, tmplname)
+    cls = _template_classes.get((tmplfile, mtime))
+    if cls is None:
+        cls = Template.compile(file=tmplfile)
+        _template_classes[(tmplfile, mtime)] = cls
+    output = cls(searchList=searchList).respond()
+    logging.debug('Output from template \'%s\': %s' % (tmplfile, output))
+    return output
 
 def call_hooks(context, func, *args, **kwargs):
     logging.info('Calling hook: %s' % func)
     logging.debug('(args=%r, kwargs=%r)' % (args, kwargs))
+    profiler = VMBuilder.profiler.profiler
+    if profiler:
+        return profiler.call('hook', func, context.__module__, _call_hooks, profiler, context, func, *args, **kwargs)
+    return _call_hooks(None, context, func, *args, **kwargs)
+
+def _call_hooks(profiler, context, func, *args, **kwargs):
+    def call(owner, method):
+        if profiler and method is not log_no_such_method:
+            profiler.call('plugin', func, owner, method, *args, **kwargs)
+        else:
+            method(*args, **kwargs)
+
     for plugin in context.plugins:
         logging.debug('Calling %s method in %s plugin.' % (func, plugin.__module__))
-        getattr(plugin, func, log_no_such_method)(*args, **kwargs)
+        call(plugin.__module__, getattr(plugin, func, log_no_such_method))
 
     for f in context.hooks.get(func, []):
         logging.debug('Calling %r.' % (f,))
-        f(*args, **kwargs)
+        call(getattr(f, '__module__', None), f)
 
     logging.debug('Calling %s method in context plugin %s.' % (func, context.__module__))
-    getattr(context, func, log_no_such_method)(*args, **kwargs)
+    call(context.__module__, getattr(context, func, log_no_such_method))
+
+def run_parallel(funcs, jobs):
+    """
+    Calls each of funcs (without arguments), running up to jobs of them
+    at a time in separate threads.
+
+    If one of them raises an exception, no further calls are started,
+    and once the running ones have returned, the first exception is
+    raised again.
+
+    @type  funcs: list
+    @param funcs: callables to run
+    @type  jobs: number
+    @param jobs: maximum number of callables running at the same time
+    @rtype:  list
+    @return: the return values of funcs, in the same order as funcs
+    """
+    results = [None] * len(funcs)
+    errors = []
+    pending = range(len(funcs))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if errors or not pending:
+                    return
+                index = pending.pop(0)
+            finally:
+                lock.release()
+            try:
+                results[index] = funcs[index]()
+            except:
+                lock.acquire()
+                errors.append(sys.exc_info())
+                lock.release()
+
+    threads = [threading.Thread(target=worker) for x in range(max(1, min(jobs, len(funcs))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+# Not exposed by the os and fcntl modules
+SEEK_DATA = 3
+SEEK_HOLE = 4
+FICLONE = 0x40049409
+
+_libc = None
+
+def libc():
+    """
+    @rtype:  ctypes.CDLL
+    @return: the C library, for the system calls Python doesn't wrap
+    """
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return _libc
+
+def data_extents(fd, size):
+    """
+    @rtype:  list
+    @return: (start, end) byte ranges of fd that hold data. If the
+             filesystem can't tell data from holes, that is all of it.
+    """
+    extents = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError, e:
+            if e.errno == errno.ENXIO:
+                # No data beyond offset
+                break
+            if e.errno in [errno.EINVAL, errno.EOPNOTSUPP] and not extents:
+                return [(0, size)]
+            raise
+        end = os.lseek(fd, start, SEEK_HOLE)
+        extents.append((start, min(end, size)))
+        offset = end
+    return extents
+
+def copy_file_range_sparse(src_fd, dest_fd, size):
+    """
+    Copies the data extents of src_fd to the same offsets in dest_fd
+    (which should be empty) with copy_file_range(2), leaving holes as
+    holes. The copy happens in the kernel, and some filesystems share
+    the blocks instead of copying them.
+
+    @rtype:  boolean
+    @return: False if copy_file_range isn't available for these files
+             (nothing has been copied then)
+    """
+    c = libc()
+    if not hasattr(c, 'copy_file_range'):
+        return False
+    c.copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_int, ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t, ctypes.c_uint]
+    c.copy_file_range.restype = ctypes.c_ssize_t
+
+    os.ftruncate(dest_fd, size)
+    first = True
+    for (start, end) in data_extents(src_fd, size):
+        off_in = ctypes.c_longlong(start)
+        off_out = ctypes.c_longlong(start)
+        while off_in.value < end:
+            copied = c.copy_file_range(src_fd, ctypes.byref(off_in), dest_fd, ctypes.byref(off_out), min(end - off_in.value, 1 << 30), 0)
+            if copied < 0:
+                err = ctypes.get_errno()
+                if first and err in [errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL]:
+                    return False
+                raise OSError(err, os.strerror(err))
+            if copied == 0:
+                raise VMBuilderException('Unexpected end of file while copying')
+            first = False
+    return True
+
+def place_image(src, dest):
+    """
+    Moves the image src to dest as cheaply as possible. In order of
+    preference: rename it, reflink it (sharing the blocks), copy it in the
+    kernel with copy_file_range (preserving holes), or copy it with
+    cp --sparse=always. Except after a rename, src is removed afterwards.
+
+    @rtype:  string
+    @return: the method used: 'rename', 'reflink', 'copy_file_range' or 'cp'
+    """
+    try:
+        os.rename(src, dest)
+        method = 'rename'
+    except OSError, e:
+        if e.errno != errno.EXDEV:
+            raise
+        method = None
+
+    if not method:
+        srcfp = open(src, 'rb')
+        destfp = open(dest, 'wb')
+        try:
+            try:
+                fcntl.ioctl(destfp.fileno(), FICLONE, srcfp.fileno())
+                method = 'reflink'
+            except IOError, e:
+                if e.errno not in [errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL]:
+                    raise
+            if not method and copy_file_range_sparse(srcfp.fileno(), destfp.fileno(), os.fstat(srcfp.fileno()).st_size):
+                method = 'copy_file_range'
+        finally:
+            srcfp.close()
+            destfp.close()
+        if not method:
+            run_cmd('cp', '--sparse=always', src, dest)
+            method = 'cp'
+        os.unlink(src)
+
+    logging.info('Moved %s to %s (%s)' % (src, dest, method))
+    return method
 
 def log_no_such_method(*args, **kwargs):
     logging.debug('No such method')
@@ -23,11 +23,11 @@ import logging
 import os
 import optparse
 import textwrap
-import urllib
 import VMBuilder
 import VMBuilder.util      as util
 import VMBuilder.log       as log
 import VMBuilder.disk      as disk
+import VMBuilder.mirror    as mirror
 from   VMBuilder.disk      import Disk, Filesystem
 from   VMBuilder.exception import VMBuilderException, VMBuilderUserError
 _ = gettext
@@ -88,10 +88,10 @@ class VM(object):
         self.add_clean_cmd('rm', log.logfile)
 
     def distro_help(self):
-        return 'Distro. Valid options: %s' % " ".join(VMBuilder.distros.keys())
+        return 'Distro. Valid options: %s' % " ".join(VMBuilder.available_distros())
 
     def hypervisor_help(self):
-        return 'Hypervisor. Valid options: %s' % " ".join(VMBuilder.hypervisors.keys())
+        return 'Hypervisor. Valid options: %s' % " ".join(VMBuilder.available_hypervisors())
 
     def register_setting(self, *args, **kwargs):
         return self.optparser.add_option(*args, **kwargs)
@@ -146,14 +146,10 @@ class VM(object):
         else:
             testurl = 'http://archive.ubuntu.com/'
 
-        try:
-            logging.debug('Testing access to %s' % testurl)
-            testnet = urllib.urlopen(testurl)
-        except IOError:
+        logging.debug('Testing access to %s' % testurl)
+        if mirror.probe(testurl, max_bytes=1) is None:
             raise VMBuilderUserError('Could not connect to %s. Please check your connectivity and try again.' % testurl)
 
-        testnet.close()
-
     def create(self):
         """
         The core vm creation method